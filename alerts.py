@@ -0,0 +1,310 @@
+import json
+import os
+import shlex
+import subprocess
+import threading
+from warnings import warn
+
+from lazy import LazyModule
+
+email_message = LazyModule('email.message')
+smtplib = LazyModule('smtplib')
+
+# rules and sinks, e.g.
+# {
+#     "rules": [
+#         {"name": "cheap", "price_below": 30},
+#         {"name": "sale", "price_drop_percent": 20, "url": "https://..."},
+#         {"name": "my size", "size": "M", "store": "online"}
+#     ],
+#     "sinks": [
+#         {"file": "alerts.jsonl"},
+#         {"command": "notify-send zared"},
+#         {"smtp": "localhost:1025", "from": "zared@localhost",
+#          "to": ["me@localhost"]}
+#     ]
+# }
+FILENAME = 'alerts.json'
+
+
+class Rule:
+    """
+    A condition on an item's latest price / availability. Rules are
+    evaluated on each update against the item's previous state, and only
+    fire when their condition becomes true, not on every update while it
+    stays true.
+
+    Attributes:
+        name (str)
+        url (str or None): only items whose canonical url starts with this
+            (so a url without its #selectedColor= covers every color)
+    """
+
+    def __init__(self, name, url=None):
+        self.name = name
+        self.url = url
+
+    def applies_to(self, canonical_url):
+        return self.url is None or canonical_url.startswith(self.url)
+
+    def evaluate(self, previous, current):
+        """
+        alert details if the rule fires going from the previous state to
+        the current one (both as written by Item.write_state, previous may
+        be None), else None
+        """
+        raise NotImplementedError
+
+
+class PriceBelow(Rule):
+
+    def __init__(self, name, price_below, url=None):
+        super().__init__(name, url)
+        self.price_below = price_below
+
+    def evaluate(self, previous, current):
+        if current['price'] >= self.price_below or (
+                previous is not None and
+                previous['price'] < self.price_below
+        ):
+            return None
+        return {
+            'message': 'price {price} is below {threshold}'.format(
+                price=current['price'], threshold=self.price_below
+            ),
+            'price': current['price'],
+        }
+
+
+class PriceDrop(Rule):
+    """
+    fires when the price drops by at least price_drop_percent since the
+    last update
+    """
+
+    def __init__(self, name, price_drop_percent, url=None):
+        super().__init__(name, url)
+        self.price_drop_percent = price_drop_percent
+
+    def evaluate(self, previous, current):
+        if previous is None or current['price'] > previous['price'] * (
+                1 - self.price_drop_percent / 100.0
+        ):
+            return None
+        return {
+            'message': 'price dropped from {previous} to {price}'.format(
+                previous=previous['price'], price=current['price']
+            ),
+            'price': current['price'],
+            'previous_price': previous['price'],
+        }
+
+
+class SizeAvailable(Rule):
+    """
+    fires when a size comes in stock online ('online'), at a given store
+    (its id), or anywhere (None)
+    """
+
+    def __init__(self, name, size, store=None, url=None):
+        super().__init__(name, url)
+        self.size = size
+        self.store = store
+
+    def locations(self, state):
+        if state is None:
+            return set()
+        return {
+            size_availability['location']
+            for size_availability in state['availability'].values()
+            if size_availability['available'] is True and
+            size_availability['size'] == self.size and (
+                self.store is None or
+                (self.store == 'online' and
+                 size_availability['location'] == 'online') or
+                size_availability['store_id'] == self.store
+            )
+        }
+
+    def evaluate(self, previous, current):
+        locations = self.locations(current) - self.locations(previous)
+        if len(locations) == 0:
+            return None
+        return {
+            'message': 'size {size} is available at {locations}'.format(
+                size=self.size, locations=', '.join(sorted(locations))
+            ),
+            'size': self.size,
+            'locations': sorted(locations),
+        }
+
+
+def rule_from_config(config):
+    config = dict(config)
+    name = config.pop('name', None)
+    if 'price_below' in config:
+        rule = PriceBelow(name, **config)
+    elif 'price_drop_percent' in config:
+        rule = PriceDrop(name, **config)
+    elif 'size' in config:
+        rule = SizeAvailable(name, **config)
+    else:
+        raise ValueError('Unknown alert rule: {config}'.format(config=config))
+    if rule.name is None:
+        rule.name = json.dumps(config, sort_keys=True)
+    return rule
+
+
+class FileSink:
+    """
+    appends each alert to a file, as a json line
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+
+    def send(self, alert):
+        with self.lock, open(self.filename, 'a') as f:
+            print(json.dumps(alert), file=f)
+
+
+class CommandSink:
+    """
+    runs a command for each alert, with the alert as json on its stdin
+    """
+
+    def __init__(self, command):
+        self.command = shlex.split(command)
+
+    def send(self, alert):
+        subprocess.run(
+            self.command,
+            input=json.dumps(alert).encode('utf-8'),
+            timeout=60,
+            check=True
+        )
+
+
+class SmtpSink:
+    """
+    emails each alert through an SMTP server, e.g. a local relay or
+    `python -m smtpd -n -c DebuggingServer localhost:1025` for testing
+    """
+
+    def __init__(self, smtp, to, sender='zared@localhost'):
+        host, _, port = smtp.partition(':')
+        self.host = host
+        self.port = int(port or 25)
+        self.to = [to] if isinstance(to, str) else list(to)
+        self.sender = sender
+
+    def send(self, alert):
+        message = email_message.EmailMessage()
+        message['Subject'] = 'zared: {name}: {message}'.format(
+            name=alert['item_name'], message=alert['message']
+        )
+        message['From'] = self.sender
+        message['To'] = ', '.join(self.to)
+        message.set_content(json.dumps(alert, indent=4))
+        with smtplib.SMTP(self.host, self.port, timeout=30) as smtp:
+            smtp.send_message(message)
+
+
+def sink_from_config(config):
+    if 'file' in config:
+        return FileSink(config['file'])
+    if 'command' in config:
+        return CommandSink(config['command'])
+    if 'smtp' in config:
+        return SmtpSink(
+            config['smtp'],
+            config['to'],
+            config.get('from', 'zared@localhost')
+        )
+    raise ValueError('Unknown alert sink: {config}'.format(config=config))
+
+
+class Alerter:
+    """
+    Evaluates every rule on each update and sends the alerts that fire to
+    every sink. A sink that fails only gets a warning, so that alerting
+    never stops an update.
+
+    Attributes:
+        rules ([Rule])
+        sinks ([FileSink / CommandSink / SmtpSink])
+    """
+
+    def __init__(self, rules, sinks):
+        self.rules = rules
+        self.sinks = sinks
+
+    @staticmethod
+    def from_file(filename=FILENAME):
+        with open(filename, 'r') as f:
+            config = json.load(f)
+        return Alerter(
+            [rule_from_config(rule) for rule in config.get('rules', [])],
+            [sink_from_config(sink) for sink in config.get('sinks', [])]
+        )
+
+    def evaluate(self, item, previous, current):
+        """
+        the alerts that fire for an item going from its previous state to
+        the current one
+        """
+        alerts = []
+        for rule in self.rules:
+            if not rule.applies_to(item.canonical_url):
+                continue
+            details = rule.evaluate(previous, current)
+            if details is not None:
+                alerts.append(dict(
+                    details,
+                    rule=rule.name,
+                    canonical_url=item.canonical_url,
+                    item_name=item.name,
+                    timestamp=current['last_checked']
+                ))
+        return alerts
+
+    def send(self, alerts):
+        for alert in alerts:
+            for sink in self.sinks:
+                try:
+                    sink.send(alert)
+                except Exception as e:
+                    warn('Could not send alert to {sink}: {error}'.format(
+                        sink=type(sink).__name__, error=e
+                    ))
+
+    def check(self, item, previous, current):
+        alerts = self.evaluate(item, previous, current)
+        self.send(alerts)
+        return alerts
+
+
+_alerter = None
+_alerter_loaded = False
+_alerter_lock = threading.Lock()
+
+
+def get_alerter():
+    """
+    the alerter configured in FILENAME, or None if there is no such file
+    """
+    global _alerter, _alerter_loaded
+    with _alerter_lock:
+        if not _alerter_loaded:
+            _alerter = Alerter.from_file() \
+                if os.path.exists(FILENAME) else None
+            _alerter_loaded = True
+        return _alerter
+
+
+def set_alerter(alerter):
+    global _alerter, _alerter_loaded
+    with _alerter_lock:
+        _alerter = alerter
+        _alerter_loaded = True
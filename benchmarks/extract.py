@@ -0,0 +1,69 @@
+"""
+Compare the full BeautifulSoup parse with the text scan used by updates,
+over saved item pages:
+
+    curl [url_to_zara_item_page] -o pages/item.html
+    python benchmarks/extract.py pages/*.html
+"""
+import argparse
+import os
+import sys
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from item import Item
+
+
+def peak_memory(extract, html):
+    tracemalloc.start()
+    extract(html)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def benchmark(filenames, repeat):
+    print('{:<40} {:>12} {:>12} {:>12} {:>12}'.format(
+        'page', 'parse (ms)', 'scan (ms)', 'parse (KiB)', 'scan (KiB)'
+    ))
+    totals = [0.0, 0.0, 0, 0]
+    for filename in filenames:
+        with open(filename, 'r') as f:
+            html = f.read()
+        scanned = Item.scan_update_data(html)
+        if scanned is None or scanned != Item.parse_update_data(html):
+            print('{}: scan does not match full parse'.format(filename))
+            continue
+        results = [
+            min(timeit.repeat(
+                lambda: extract(html), number=1, repeat=repeat
+            )) * 1000
+            for extract in (Item.parse_update_data, Item.scan_update_data)
+        ] + [
+            peak_memory(extract, html) / 1024
+            for extract in (Item.parse_update_data, Item.scan_update_data)
+        ]
+        totals = [total + result for total, result in zip(totals, results)]
+        print('{:<40} {:>12.2f} {:>12.2f} {:>12.0f} {:>12.0f}'.format(
+            os.path.basename(filename)[:40], *results
+        ))
+    if totals[1] > 0 and totals[3] > 0:
+        print('scan is {:.0f}x faster and uses {:.0f}x less memory'.format(
+            totals[0] / totals[1], totals[2] / totals[3]
+        ))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('pages', nargs='+', help='saved item pages')
+    parser.add_argument(
+        '--repeat',
+        help='Best of how many runs per page',
+        action='store',
+        type=int,
+        default=5
+    )
+    args = parser.parse_args()
+    benchmark(args.pages, args.repeat)
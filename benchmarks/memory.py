@@ -0,0 +1,115 @@
+"""
+Memory used by items' history once loaded, as read from disk and in the
+compact form items hold it in (see history.MEMORY_TYPES), offline, over
+synthetic items with long histories:
+
+    python benchmarks/memory.py --items 10 --history-days 365
+
+The items are cloned from one added from the local stub in
+benchmarks/stub.py, as in benchmarks/suite.py.
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPOSITORY)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from stub import StubServer
+from suite import PART_NUMBER_BASE, STORES, clone_items
+
+
+def frame_bytes(df):
+    return int(df.memory_usage(index=True, deep=True).sum())
+
+
+def run(items, history_days, fixtures):
+    """
+    {kind: (rows, bytes as read, bytes in memory)} over `items` items
+    """
+    directory = tempfile.mkdtemp(prefix='zared_memory_')
+    os.chdir(directory)
+    with open('stores.json', 'w') as f:
+        json.dump(STORES, f)
+    import history
+    from item import Item
+    from zared import Zared
+    history.set_backend(history.CsvHistory())
+    server = StubServer(fixtures=fixtures).start()
+    Item.STORE_AVAILABILITY_URL = server.stock_url_template()
+    try:
+        template = Item.from_url(
+            server.product_url(PART_NUMBER_BASE + items), 'black'
+        )
+        filepath = template.filepath
+        with open(filepath + '/' + template.json_filename(), 'r') as f:
+            template_json = json.load(f)
+        state = template.read_state()
+        shutil.rmtree(Item.PATH)
+        os.makedirs(filepath)
+        clone_items(
+            template_json, state, filepath, server, items, history_days
+        )
+
+        zared = Zared()
+        zared.stock_take()
+        totals = {kind: [0, 0, 0] for kind in history.KINDS}
+        for zared_row in zared.zared.to_dict('records'):
+            item = Item.from_disk(filepath, zared_row['filename'], lazy=True)
+            for kind, attribute in (
+                    ('price', 'price_history'),
+                    ('availability', 'availability')
+            ):
+                raw = history.get_backend().read(item, kind)
+                totals[kind][0] += len(raw)
+                totals[kind][1] += frame_bytes(raw)
+                totals[kind][2] += frame_bytes(getattr(item, attribute))
+    finally:
+        server.stop()
+        os.chdir(REPOSITORY)
+        shutil.rmtree(directory)
+    return {kind: tuple(total) for kind, total in totals.items()}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--items',
+        help='Number of items',
+        action='store',
+        type=int,
+        default=10
+    )
+    parser.add_argument(
+        '--history-days',
+        help='Days of hourly history per item',
+        action='store',
+        type=int,
+        default=365
+    )
+    parser.add_argument(
+        '--fixtures',
+        help='Directory of recorded pages for the stub to serve',
+        action='store',
+        default=None
+    )
+    args = parser.parse_args()
+
+    results = run(args.items, args.history_days, args.fixtures)
+    print('{kind:<14} {rows:>10} {raw:>12} {compact:>12} {ratio:>7}'.format(
+        kind='history', rows='rows', raw='as read', compact='in memory',
+        ratio='ratio'
+    ))
+    for kind, (rows, raw, compact) in sorted(results.items()):
+        print('{kind:<14} {rows:>10} {raw:>10.1f}MB {compact:>10.1f}MB '
+              '{ratio:>6.1f}x'.format(
+                  kind=kind,
+                  rows=rows,
+                  raw=raw / 1e6,
+                  compact=compact / 1e6,
+                  ratio=raw / max(compact, 1)
+              ))
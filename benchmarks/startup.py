@@ -0,0 +1,137 @@
+"""
+Time how long quick zared commands take to start, from
+`python -X importtime`, and check that they do not import any of the heavy
+modules only needed to fetch or analyse items:
+
+    python benchmarks/startup.py --budget 0.5
+
+Exits with status 1 if a command takes longer than the budget (median of
+`--repeat` runs) or imports one of HEAVY_MODULES, so that it can guard
+against regressions.
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ZARED = os.path.join(REPOSITORY, 'zared.py')
+HEAVY_MODULES = [
+    'arrow', 'bs4', 'lxml', 'numpy', 'pandas', 'pyarrow', 'requests',
+    'unidecode',
+]
+COMMANDS = [
+    ['--help'],
+    ['--list'],
+    ['--status', 'https://www.zara.com/us/en/item-p00000000.html'],
+]
+
+
+def import_times(stderr):
+    """
+    {module: (self microseconds, cumulative microseconds)} from the
+    output of -X importtime
+    """
+    times = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, module = line[len('import time:'):]\
+            .split('|')
+        times[module.strip()] = (int(self_us), int(cumulative_us))
+    return times
+
+
+def run(command, repeat):
+    wall_times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        process = subprocess.run(
+            [sys.executable, '-X', 'importtime', ZARED] + command,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            universal_newlines=True
+        )
+        wall_times.append(time.perf_counter() - start)
+    times = import_times(process.stderr)
+    return {
+        'command': ' '.join(command),
+        'returncode': process.returncode,
+        'seconds': sorted(wall_times)[len(wall_times) // 2],
+        'import_seconds': sum(
+            self_us for self_us, _ in times.values()
+        ) / 1e6,
+        'heavy_imports': sorted(
+            module for module in times if module in HEAVY_MODULES
+        ),
+        'slowest_imports': sorted(
+            times.items(), key=lambda module: module[1][0], reverse=True
+        )[:5],
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--budget',
+        help='Seconds each command may take to run',
+        action='store',
+        type=float,
+        default=0.5
+    )
+    parser.add_argument(
+        '--repeat',
+        help='Runs per command (the median is reported)',
+        action='store',
+        type=int,
+        default=5
+    )
+    parser.add_argument(
+        '--json',
+        help='Print the results as json',
+        action='store_true'
+    )
+    args = parser.parse_args()
+
+    # an empty catalog, so that nothing but startup is measured
+    directory = tempfile.mkdtemp(prefix='zared_startup_')
+    os.chdir(directory)
+    with open('stores.json', 'w') as f:
+        json.dump([], f)
+    try:
+        results = [run(command, args.repeat) for command in COMMANDS]
+    finally:
+        os.chdir(REPOSITORY)
+        shutil.rmtree(directory)
+
+    failed = False
+    if args.json is True:
+        print(json.dumps(results, indent=4))
+    for result in results:
+        problems = []
+        if result['returncode'] != 0:
+            problems.append('exited with {returncode}'.format(**result))
+        if result['seconds'] > args.budget:
+            problems.append('over the {budget}s budget'.format(
+                budget=args.budget
+            ))
+        if len(result['heavy_imports']) > 0:
+            problems.append('imports ' + ', '.join(result['heavy_imports']))
+        failed = failed or len(problems) > 0
+        if args.json is False:
+            print('{command:<64} {seconds:>7.3f}s  (imports {imports:.3f}s)'
+                  '  {status}'.format(
+                      command=result['command'][:64],
+                      seconds=result['seconds'],
+                      imports=result['import_seconds'],
+                      status='; '.join(problems) or 'ok'
+                  ))
+            for module, (self_us, _) in result['slowest_imports']:
+                print('    {module:<40} {ms:>8.1f} ms'.format(
+                    module=module, ms=self_us / 1000
+                ))
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,332 @@
+"""
+A local stand-in for zara.com and the itxrest stock api, so that zared can
+be benchmarked without touching either.
+
+Product pages are served at /us/en/item-p{part_number}.html and stock at
+/stock/V{year}/{part_number}. Pages and stock responses recorded with
+`python benchmarks/stub.py --record [url_to_zara_item_page] [fixtures]` are
+replayed (cycling through them, with the part number and canonical url
+rewritten so that every part number is a distinct item); otherwise
+synthetic ones shaped like the real thing are generated.
+
+    python benchmarks/stub.py --serve [fixtures] --port 8765
+"""
+import argparse
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
+import os
+import re
+from socketserver import ThreadingMixIn
+import sys
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+import zlib
+
+COLORS = [
+    ('001', 'Black', [(1, 'S'), (2, 'M'), (3, 'L')]),
+    ('002', 'Blue', [(4, 'S'), (5, 'M'), (6, 'L')]),
+]
+PAGE_TEMPLATE = (
+    '<!DOCTYPE html><html><head>'
+    '<link rel="canonical" href="{canonical_url}"/>'
+    '<link class="_seoImg" href="//static.zara.net/{part_number}.jpg?ts=1"/>'
+    '</head><body>'
+    '<div class="breadcrumbs"><ul><li>ZARA</li>'
+    '<li><a href="#">WOMAN</a></li><li><a href="#">DRESSES</a></li>'
+    '</ul></div>'
+    '<h1 class="product-name">Dress {part_number}</h1>'
+    '<span class="_colorName">Black</span>'
+    '<p class="reference">Ref. {part_number}</p>'
+    '<p class="description">Synthetic dress for benchmarking.</p>'
+    '<div hidden>"zara:///1/products?partNumber={part_number}"</div>'
+    '<script type="text/javascript">'
+    'window.zara.appConfig = {{}}; window.zara.dataLayer = {data_layer};\n'
+    '</script>'
+    '{padding}'
+    '</body></html>'
+)
+# real product pages are a few hundred KB, mostly markup we never look at
+PADDING = '<div class="filler"><span>&nbsp;</span></div>' * 4000
+
+
+def synthetic_data_layer(part_number, price):
+    return {
+        'product': {
+            'detail': {
+                'colors': [
+                    {
+                        'id': color_id,
+                        'name': name,
+                        'sizes': [
+                            {
+                                'id': size_id,
+                                'name': size,
+                                'availability': (
+                                    'in_stock'
+                                    if (part_number + size_id) % 3
+                                    else 'out_of_stock'
+                                )
+                            }
+                            for size_id, size in sizes
+                        ]
+                    }
+                    for color_id, name, sizes in COLORS
+                ],
+                'detailedComposition': {
+                    'parts': [{
+                        'description': 'OUTER SHELL',
+                        'components': [
+                            {'percentage': '100%', 'material': 'cotton'}
+                        ],
+                        'areas': [],
+                        'microcontents': [],
+                        'reinforcements': []
+                    }],
+                    'exceptions': []
+                },
+                'care': [{'description': 'Machine wash at max. 30C'}]
+            }
+        },
+        'productMetaData': [
+            {'price': price}
+            for _, _, sizes in COLORS
+            for _ in sizes
+        ]
+    }
+
+
+def synthetic_page(canonical_url, part_number, price):
+    return PAGE_TEMPLATE.format(
+        canonical_url=canonical_url,
+        part_number=part_number,
+        data_layer=json.dumps(synthetic_data_layer(part_number, price)),
+        padding=PADDING
+    )
+
+
+def synthetic_stock(part_number, store_ids):
+    return {
+        'stocks': [
+            {
+                'physicalStoreId': store_id,
+                'sizeStocks': [
+                    {
+                        'sizeId': size_id,
+                        'quantity': (part_number + size_id + store_id) % 4
+                    }
+                    for _, _, sizes in COLORS
+                    for size_id, _ in sizes
+                ]
+            }
+            for store_id in store_ids
+        ]
+    }
+
+
+def load_fixtures(path):
+    """
+    recorded (page, stock) pairs from path/pages/*.html and the matching
+    path/stock/*.json
+    """
+    if path is None or not os.path.isdir(path + '/pages'):
+        return []
+    fixtures = []
+    for filename in sorted(os.listdir(path + '/pages')):
+        if not filename.endswith('.html'):
+            continue
+        name = filename[:-5]
+        with open(path + '/pages/' + filename, 'r') as f:
+            page = f.read()
+        with open(path + '/stock/' + name + '.json', 'r') as f:
+            stock = f.read()
+        part_number = re.search(
+            r'"zara:///1/products\?partNumber=(\d+)"', page
+        ).group(1)
+        canonical_url = re.search(
+            r'<link[^>]*rel="canonical"[^>]*href="([^"]*)"', page
+        ).group(1)
+        fixtures.append((page, stock, part_number, canonical_url))
+    return fixtures
+
+
+def record(url, path):
+    """
+    save a real product page and its stock response as fixtures
+    """
+    sys.path.insert(
+        0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    )
+    import fetch
+    from item import Item
+    page = fetch.get(url).text
+    update_data = Item.scan_update_data(page)
+    stock = json.dumps({
+        'stocks': Item.get_store_stocks(update_data['part_number'])
+    })
+    os.makedirs(path + '/pages', exist_ok=True)
+    os.makedirs(path + '/stock', exist_ok=True)
+    with open(path + '/pages/' + update_data['part_number'] + '.html',
+              'w') as f:
+        f.write(page)
+    with open(path + '/stock/' + update_data['part_number'] + '.json',
+              'w') as f:
+        f.write(stock)
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class StubServer:
+    """
+    Attributes:
+        url (str): where the server is listening, e.g. http://127.0.0.1:8765
+        fixtures ([(page, stock, part_number, canonical_url)])
+        price (float): price on every synthetic page; change it to simulate
+            price changes
+        latency (float): seconds to wait before answering each request
+        requests (dict(kind: count)): requests served, by kind (page, stock)
+        bytes_sent (int)
+    """
+
+    def __init__(self, fixtures=None, port=0, latency=0.0):
+        self.fixtures = load_fixtures(fixtures)
+        self.price = 29.95
+        self.latency = latency
+        self.requests = {}
+        self.bytes_sent = 0
+        self.lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                server.handle(self)
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.url = 'http://127.0.0.1:{port}'.format(
+            port=self.httpd.server_address[1]
+        )
+
+    def product_url(self, part_number):
+        return self.url + '/us/en/item-p{part_number}.html'.format(
+            part_number=part_number
+        )
+
+    def stock_url_template(self):
+        """
+        for Item.STORE_AVAILABILITY_URL
+        """
+        return self.url + (
+            '/stock/V{year}/{part_number}?physicalStoreId={store_ids}'
+            '&ajax=true'
+        )
+
+    def page(self, part_number):
+        if len(self.fixtures) == 0:
+            return synthetic_page(
+                self.product_url(part_number), part_number, self.price
+            )
+        page, _, recorded_part_number, canonical_url = \
+            self.fixtures[part_number % len(self.fixtures)]
+        return page.replace(canonical_url, self.product_url(part_number))\
+                   .replace(
+                       'partNumber=' + recorded_part_number,
+                       'partNumber={}'.format(part_number)
+                   )
+
+    def stock(self, part_number, store_ids):
+        if len(self.fixtures) == 0:
+            return json.dumps(synthetic_stock(part_number, store_ids))
+        return self.fixtures[part_number % len(self.fixtures)][1]
+
+    def handle(self, request):
+        if self.latency > 0:
+            time.sleep(self.latency)
+        url = urlparse(request.path)
+        page = re.match(r'/us/en/item-p(\d+)\.html$', url.path)
+        stock = re.match(r'/stock/V\d+/(\d+)$', url.path)
+        if page is not None:
+            kind = 'page'
+            body = self.page(int(page.group(1)))
+            content_type = 'text/html; charset=utf-8'
+        elif stock is not None:
+            kind = 'stock'
+            store_ids = [
+                int(store_id)
+                for store_id in parse_qs(url.query).get(
+                    'physicalStoreId', [''])[0].split(',')
+                if store_id != ''
+            ]
+            body = self.stock(int(stock.group(1)), store_ids)
+            content_type = 'application/json'
+        else:
+            request.send_error(404)
+            return
+        body = body.encode('utf-8')
+        etag = '"{:x}"'.format(zlib.crc32(body))
+        with self.lock:
+            self.requests[kind] = self.requests.get(kind, 0) + 1
+        if kind == 'page' and request.headers.get('If-None-Match') == etag:
+            request.send_response(304)
+            request.send_header('ETag', etag)
+            request.end_headers()
+            return
+        request.send_response(200)
+        request.send_header('Content-Type', content_type)
+        request.send_header('Content-Length', str(len(body)))
+        if kind == 'page':
+            request.send_header('ETag', etag)
+        request.end_headers()
+        request.wfile.write(body)
+        with self.lock:
+            self.bytes_sent += len(body)
+
+    def start(self):
+        thread = threading.Thread(target=self.httpd.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--serve',
+        help='Serve pages (from this fixtures directory, if given)',
+        nargs='?',
+        const='',
+        action='store'
+    )
+    parser.add_argument('--port', action='store', type=int, default=8765)
+    parser.add_argument(
+        '--latency',
+        help='Seconds to wait before each response',
+        action='store',
+        type=float,
+        default=0.0
+    )
+    parser.add_argument(
+        '--record',
+        help='Save a real item page and its stock as fixtures: URL DIRECTORY',
+        nargs=2,
+        action='store'
+    )
+    args = parser.parse_args()
+
+    if args.record is not None:
+        record(*args.record)
+    elif args.serve is not None:
+        server = StubServer(
+            fixtures=args.serve or None, port=args.port, latency=args.latency
+        )
+        print('Serving at {url}'.format(url=server.url))
+        server.httpd.serve_forever()
@@ -0,0 +1,382 @@
+"""
+Offline benchmarks of zared's main operations, run against the local stub
+in benchmarks/stub.py over synthetic catalogs with long histories:
+
+    python benchmarks/suite.py --items 10 100 1000 --history-days 7
+
+Each catalog is built in a temporary directory. A sample of the items is
+added with Item.from_url, the rest are cloned from it on disk along with
+`--history-days` of hourly price / availability history.
+
+Every measurement is appended to benchmarks/results.jsonl, tagged with the
+current git commit, and compared with the last recorded run of the same
+measurement from a different commit, so that regressions show up.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPOSITORY)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from stub import StubServer
+
+RESULTS_FILENAME = os.path.join(REPOSITORY, 'benchmarks', 'results.jsonl')
+# first part number used for synthetic items
+PART_NUMBER_BASE = 1000000
+STORES = [
+    {
+        'id': 10000 + i,
+        'addressLines': ['{} Benchmark Avenue'.format(i + 1), 'New York'],
+        'latitude': 40.7 + i / 100.0,
+        'longitude': -74.0 + i / 100.0,
+    }
+    for i in range(3)
+]
+
+
+def git_commit():
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=REPOSITORY
+        ).decode().strip()
+        dirty = subprocess.call(
+            ['git', 'diff', '--quiet', 'HEAD', '--', '*.py'], cwd=REPOSITORY
+        ) != 0
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, dirty
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    function(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+def result(benchmark, settings, latencies=None, seconds=None, count=None,
+           **extra):
+    """
+    a measurement, either of individual calls (latencies, in seconds) or of
+    `count` items processed in `seconds`
+    """
+    measurement = dict(settings, benchmark=benchmark)
+    if latencies is not None:
+        seconds = sum(latencies)
+        count = len(latencies)
+        measurement.update({
+            'p50_ms': percentile(latencies, 0.5) * 1000,
+            'p95_ms': percentile(latencies, 0.95) * 1000,
+            'max_ms': max(latencies) * 1000,
+        })
+    measurement.update({
+        'count': count,
+        'seconds': seconds,
+        'items_per_second': count / seconds if seconds > 0 else None,
+    })
+    measurement.update(extra)
+    return measurement
+
+
+def clone_items(template, state, filepath, server, count, history_days):
+    """
+    write `count` items like the template (an item's json and state) straight
+    to disk, each with `history_days` of hourly history
+    """
+    size_availabilities = list(state['availability'].values())
+    now = int(time.time())
+    timestamps = range(now - history_days * 24 * 60 * 60, now, 60 * 60)
+    for i in range(count):
+        part_number = PART_NUMBER_BASE + i
+        filename = 'dress_{part_number}_black'.format(part_number=part_number)
+        item = dict(
+            template,
+            canonical_url=server.product_url(part_number) +
+            '#selectedColor=001',
+            part_number=str(part_number),
+            reference_id='Ref. {part_number}'.format(part_number=part_number),
+            name='Dress {part_number} BLACK'.format(part_number=part_number),
+            filename=filename
+        )
+        with open(filepath + '/' + filename + '.json', 'w') as f:
+            json.dump(item, f)
+        with open(filepath + '/price_' + filename + '.csv', 'w') \
+                as f:
+            f.write('timestamp,human_timestamp,price\n')
+            for timestamp in timestamps:
+                f.write('{timestamp},{timestamp},{price}\n'.format(
+                    timestamp=timestamp, price=state['price']
+                ))
+        with open(
+                filepath + '/availability_' + filename + '.csv', 'w'
+        ) as f:
+            f.write(
+                'timestamp,human_timestamp,location,store_id,size,size_id,'
+                'available,quantity\n'
+            )
+            for timestamp in timestamps:
+                for size_availability in size_availabilities:
+                    f.write(
+                        '{timestamp},{timestamp},{location},{store_id},'
+                        '{size},{size_id},{available},{quantity}\n'.format(
+                            timestamp=timestamp,
+                            **dict(
+                                size_availability,
+                                store_id=(
+                                    size_availability['store_id']
+                                    if size_availability['store_id']
+                                    is not None else ''
+                                ),
+                                quantity=(
+                                    size_availability['quantity']
+                                    if size_availability['quantity']
+                                    is not None else ''
+                                )
+                            )
+                        )
+                    )
+        with open(filepath + '/' + filename + '.state', 'w') as f:
+            json.dump(dict(state, last_checked=timestamps[-1]), f)
+
+
+def run(items, history_days, workers, sample, fixtures):
+    """
+    every benchmark, over a catalog of `items` items
+    """
+    settings = {
+        'items': items,
+        'history_days': history_days,
+        'workers': workers,
+    }
+    directory = tempfile.mkdtemp(prefix='zared_benchmark_')
+    os.chdir(directory)
+    with open('stores.json', 'w') as f:
+        json.dump(STORES, f)
+    # imported here, now that there is a stores.json to read; the modules
+    # zared only imports when first used are imported up front, so that the
+    # first measurement does not include importing them
+    import arrow
+    import bs4
+    import pandas
+    import requests
+    import fetch
+    import history
+    import metrics
+    from item import Item
+    from pipeline import UpdatePipeline
+    from zared import Zared
+    history.set_backend(history.CsvHistory())
+    server = StubServer(fixtures=fixtures).start()
+    Item.STORE_AVAILABILITY_URL = server.stock_url_template()
+    results = []
+    try:
+        sample = min(sample, items)
+        from_url_latencies = []
+        for i in range(sample):
+            fetch.client.new_run()
+            from_url_latencies.append(timed(
+                Item.from_url,
+                server.product_url(PART_NUMBER_BASE + items + i),
+                'black'
+            ))
+        results.append(result('Item.from_url', settings, from_url_latencies))
+
+        # the catalog is made of clones of the last item added, on their own
+        template = Item.from_url(
+            server.product_url(PART_NUMBER_BASE + items + sample), 'black'
+        )
+        filepath = template.filepath
+        with open(filepath + '/' + template.json_filename(), 'r') as f:
+            template_json = json.load(f)
+        state = template.read_state()
+        shutil.rmtree(Item.PATH)
+        os.makedirs(filepath)
+        clone_items(
+            template_json, state, filepath, server, items, history_days
+        )
+
+        zared = Zared()
+        results.append(result(
+            'Zared.stock_take (cold)', settings,
+            seconds=timed(zared.stock_take), count=items
+        ))
+        results.append(result(
+            'Zared.stock_take (warm)', settings,
+            seconds=timed(zared.stock_take), count=items
+        ))
+
+        update_latencies = []
+        for _, zared_row in zared.zared.iloc[:sample].iterrows():
+            fetch.client.new_run()
+            item = Item.from_disk(
+                Item.FILEPATH.format(
+                    audience_segment=zared_row['audience_segment'],
+                    type=zared_row['type']
+                ),
+                zared_row['filename'],
+                lazy=True
+            )
+            update_latencies.append(timed(item.update))
+        results.append(result('Item.update', settings, update_latencies))
+
+        for benchmark in (
+                'Zared.update_all (cold cache)',
+                'Zared.update_all (revalidated)'
+        ):
+            requests_before = dict(server.requests)
+            bytes_before = server.bytes_sent
+            results.append(result(
+                benchmark, settings,
+                seconds=timed(zared.update_all, workers=workers),
+                count=items,
+                requests=sum(server.requests.values()) -
+                sum(requests_before.values()),
+                bytes_downloaded=server.bytes_sent - bytes_before,
+                failed=metrics.collector.summary()['failed']
+            ))
+
+        # from a cold cache again, so that every page is parsed
+        shutil.rmtree(fetch.client.cache_path, ignore_errors=True)
+        requests_before = dict(server.requests)
+        bytes_before = server.bytes_sent
+        results.append(result(
+            'Zared.update_all (pipelined, cold cache)', settings,
+            seconds=timed(
+                zared.update_all,
+                pipeline=UpdatePipeline(zared, fetchers=workers)
+            ),
+            count=items,
+            requests=sum(server.requests.values()) -
+            sum(requests_before.values()),
+            bytes_downloaded=server.bytes_sent - bytes_before,
+            failed=metrics.collector.summary()['failed']
+        ))
+    finally:
+        server.stop()
+        os.chdir(REPOSITORY)
+        shutil.rmtree(directory)
+    return results
+
+
+def previous_results():
+    try:
+        with open(RESULTS_FILENAME, 'r') as f:
+            return [json.loads(line) for line in f if line.strip()]
+    except FileNotFoundError:
+        return []
+
+
+def report(results, previous):
+    key_fields = ('benchmark', 'items', 'history_days', 'workers')
+    print('{:<40} {:>6} {:>10} {:>10} {:>10} {:>8} {:>12}'.format(
+        'benchmark', 'items', 'seconds', 'items/s', 'p95 (ms)', 'failed',
+        'vs previous'
+    ))
+    for measurement in results:
+        earlier = [
+            other
+            for other in previous
+            if all(other.get(k) == measurement[k] for k in key_fields) and
+            other.get('commit') != measurement['commit']
+        ]
+        change = ''
+        if len(earlier) > 0 and earlier[-1]['items_per_second']:
+            change = '{:+.0%}'.format(
+                measurement['items_per_second'] /
+                earlier[-1]['items_per_second'] - 1
+            )
+        print('{:<40} {:>6} {:>10.3f} {:>10.1f} {:>10} {:>8} {:>12}'.format(
+            measurement['benchmark'],
+            measurement['items'],
+            measurement['seconds'],
+            measurement['items_per_second'] or 0,
+            '{:.1f}'.format(measurement['p95_ms'])
+            if 'p95_ms' in measurement else '',
+            measurement.get('failed', ''),
+            change
+        ))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--items',
+        help='Catalog sizes to benchmark',
+        nargs='+',
+        type=int,
+        default=[10, 100, 1000]
+    )
+    parser.add_argument(
+        '--history-days',
+        help='Days of hourly history per item',
+        action='store',
+        type=int,
+        default=7
+    )
+    parser.add_argument(
+        '--workers',
+        help='Workers for Zared.update_all',
+        action='store',
+        type=int,
+        default=8
+    )
+    parser.add_argument(
+        '--sample',
+        help='Items to time individually for Item.from_url / Item.update',
+        action='store',
+        type=int,
+        default=20
+    )
+    parser.add_argument(
+        '--fixtures',
+        help='Directory of recorded pages / stock to replay (see stub.py)',
+        action='store'
+    )
+    parser.add_argument(
+        '--no-save',
+        help='Do not append the results to ' + RESULTS_FILENAME,
+        action='store_true'
+    )
+    args = parser.parse_args()
+
+    commit, dirty = git_commit()
+    run_info = {
+        'commit': commit,
+        'dirty': dirty,
+        'timestamp': int(time.time()),
+        'python': platform.python_version(),
+    }
+    previous = previous_results()
+    results = []
+    for items in args.items:
+        results += [
+            dict(measurement, **run_info)
+            for measurement in run(
+                items, args.history_days, args.workers, args.sample,
+                args.fixtures
+            )
+        ]
+    report(results, previous)
+    failed = sum(measurement.get('failed', 0) for measurement in results)
+    if failed > 0:
+        # a run whose updates failed is fast for the wrong reasons, and
+        # would make a misleading baseline
+        sys.exit('{failed} updates failed, results not saved'.format(
+            failed=failed
+        ))
+    if args.no_save is False:
+        with open(RESULTS_FILENAME, 'a') as f:
+            for measurement in results:
+                print(json.dumps(measurement), file=f)
@@ -0,0 +1,200 @@
+import os
+import sqlite3
+import threading
+
+from lazy import LazyModule
+
+pd = LazyModule('pandas')
+
+
+def connect(filename, journal_mode=None):
+    """
+    a connection to the sqlite database shared by the catalog and the
+    summary, in `journal_mode`: by default WAL, unless the database already
+    has tables and is in another mode, as sharded workers (see
+    Zared.run_sharded) leave it, so that other commands do not switch it
+    back under them
+    """
+    connection = sqlite3.connect(
+        filename, timeout=30, check_same_thread=False
+    )
+    if journal_mode is None:
+        current, = connection.execute('PRAGMA journal_mode').fetchone()
+        tables, = connection.execute(
+            'SELECT count(*) FROM sqlite_master'
+        ).fetchone()
+        journal_mode = 'WAL' if tables == 0 else current
+    journal_mode, = connection.execute(
+        'PRAGMA journal_mode={mode}'.format(mode=journal_mode)
+    ).fetchone()
+    # without WAL, commits are only safe from power loss when fully synced
+    connection.execute('PRAGMA synchronous={synchronous}'.format(
+        synchronous='NORMAL' if journal_mode.lower() == 'wal' else 'FULL'
+    ))
+    return connection
+
+
+class Catalog:
+    """
+    The catalog of tracked items, kept in sqlite so that single rows can be
+    written (and committed) as they change instead of rewriting the whole
+    catalog, with indices for the ways items are selected.
+
+    The database is in WAL mode, so readers are never blocked by an update
+    run writing to it, except for sharded workers, which need a rollback
+    journal to share it between hosts (see `connect`).
+
+    Attributes:
+        filename (str)
+        index (str): name of the primary key column
+        columns ([str]): every other column
+    """
+
+    FILENAME = 'zared.db'
+    INDEXED_COLUMNS = [
+        ('audience_segment', 'type'),
+        ('last_updated',),
+        ('bought',),
+        ('ignore',),
+    ]
+    COLUMN_TYPES = {
+        'added': 'INTEGER',
+        'last_updated': 'INTEGER',
+        'bought': 'INTEGER',
+        'ignore': 'INTEGER',
+    }
+    BOOLEAN_COLUMNS = ['bought', 'ignore']
+
+    def __init__(self, index, columns, filename=FILENAME, journal_mode=None):
+        self.filename = filename
+        self.index = index
+        self.columns = columns
+        self.lock = threading.Lock()
+        self.connection = connect(filename, journal_mode)
+        with self.lock, self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS items ({columns})'.format(
+                    columns=', '.join(
+                        ['"{index}" TEXT PRIMARY KEY'.format(index=index)] + [
+                            '"{column}" {type}'.format(
+                                column=column,
+                                type=self.COLUMN_TYPES.get(column, 'TEXT')
+                            )
+                            for column in columns
+                        ]
+                    )
+                )
+            )
+            for indexed_columns in self.INDEXED_COLUMNS:
+                self.connection.execute(
+                    'CREATE INDEX IF NOT EXISTS "items_{name}" '
+                    'ON items ({columns})'.format(
+                        name='_'.join(indexed_columns),
+                        columns=', '.join(
+                            '"{column}"'.format(column=column)
+                            for column in indexed_columns
+                        )
+                    )
+                )
+
+    @staticmethod
+    def exists(filename=FILENAME):
+        return os.path.exists(filename)
+
+    @staticmethod
+    def to_sql_value(value):
+        if value is None or (isinstance(value, float) and value != value):
+            return None
+        if hasattr(value, 'item'):
+            # numpy scalars
+            return value.item()
+        if isinstance(value, (bool, int, float, str)):
+            return value
+        return str(value)
+
+    def to_DataFrame(self):
+        with self.lock:
+            df = pd.read_sql_query(
+                'SELECT * FROM items', self.connection, index_col=self.index
+            )
+        for column in self.BOOLEAN_COLUMNS:
+            df[column] = df[column].astype(bool)
+        return df.reindex(columns=self.columns)
+
+    def rows(self, where='', parameters=()):
+        """
+        the rows matching an sql condition, as dicts, without pandas
+        """
+        with self.lock:
+            cursor = self.connection.execute(
+                'SELECT * FROM items {where}'.format(
+                    where='WHERE ' + where if where else ''
+                ),
+                parameters
+            )
+            columns = [column[0] for column in cursor.description]
+            rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
+        for row in rows:
+            for column in self.BOOLEAN_COLUMNS:
+                row[column] = bool(row[column])
+        return rows
+
+    def upsert(self, df):
+        """
+        insert or replace every row of df, in one transaction
+        """
+        columns = [self.index] + self.columns
+        rows = [
+            [self.to_sql_value(value) for value in row]
+            for row in df.reset_index()
+                         .reindex(columns=columns)
+                         .itertuples(index=False, name=None)
+        ]
+        with self.lock, self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO items ({columns}) '
+                'VALUES ({values})'.format(
+                    columns=', '.join(
+                        '"{column}"'.format(column=column)
+                        for column in columns
+                    ),
+                    values=', '.join('?' for _ in columns)
+                ),
+                rows
+            )
+
+    def update(self, key, **values):
+        """
+        set some columns of one row, committed immediately
+        """
+        with self.lock, self.connection:
+            self.connection.execute(
+                'UPDATE items SET {assignments} '
+                'WHERE "{index}" = ?'.format(
+                    assignments=', '.join(
+                        '"{column}" = ?'.format(column=column)
+                        for column in values
+                    ),
+                    index=self.index
+                ),
+                [self.to_sql_value(value) for value in values.values()] +
+                [key]
+            )
+
+    def update_many(self, column, values):
+        """
+        set one column of many rows, {key: value}, in one transaction
+        """
+        with self.lock, self.connection:
+            self.connection.executemany(
+                'UPDATE items SET "{column}" = ? '
+                'WHERE "{index}" = ?'.format(column=column, index=self.index),
+                [
+                    [self.to_sql_value(value), key]
+                    for key, value in values.items()
+                ]
+            )
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
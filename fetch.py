@@ -0,0 +1,227 @@
+from hashlib import sha1
+import json
+import os
+import threading
+import time
+from urllib.parse import urldefrag, urlparse
+
+from lazy import LazyModule
+import metrics
+
+requests = LazyModule('requests')
+requests_adapters = LazyModule('requests.adapters')
+
+# requests per second allowed against each host, shared by all threads
+HOST_RATE_LIMITS = {
+    'www.zara.com': 2.0,
+    'itxrest.inditex.com': 4.0,
+}
+# (connect, read) seconds
+TIMEOUT = (10, 30)
+# kept-alive connections per host, enough for one per update worker
+POOL_SIZE = 16
+CACHE_PATH = 'cache/'
+
+
+class RateLimiter:
+    """
+    Spaces out requests so that no host sees more than its configured
+    number of requests per second, however many threads are fetching.
+
+    Attributes:
+        rates (dict(host: requests per second))
+        default_rate (float or None): used for hosts not in `rates`,
+            None means unlimited
+    """
+
+    def __init__(self, rates=None, default_rate=None):
+        self.rates = dict(rates or {})
+        self.default_rate = default_rate
+        self.next_slots = {}
+        self.lock = threading.Lock()
+
+    def set_rate(self, host, rate):
+        with self.lock:
+            self.rates[host] = rate
+
+    def wait(self, url):
+        host = urlparse(url).hostname
+        with self.lock:
+            rate = self.rates.get(host, self.default_rate)
+            if not rate:
+                return
+            now = time.monotonic()
+            slot = max(now, self.next_slots.get(host, now))
+            self.next_slots[host] = slot + 1.0 / rate
+        if slot > now:
+            metrics.count('rate_limit_wait_seconds', slot - now, host=host)
+            time.sleep(slot - now)
+
+
+class Client:
+    """
+    A pooled, keep-alive HTTP session shared by every thread, with
+    conditional revalidation of pages against what was extracted from
+    them last time.
+
+    Validators and extracted payloads are kept in `cache_path`, one json
+    file per url, so that they survive between runs. Within a run, each
+    page is downloaded and parsed at most once: results are memoised by
+    url without its fragment, so every `#selectedColor=` variant of a
+    product shares one fetch. Call `new_run` to start afresh.
+
+    Attributes:
+        session (requests.Session)
+        rate_limiter (RateLimiter)
+        timeout ((connect, read))
+        cache_path (str)
+    """
+
+    def __init__(self, rate_limiter, timeout=TIMEOUT, pool_size=POOL_SIZE,
+                 cache_path=CACHE_PATH):
+        self.rate_limiter = rate_limiter
+        self.timeout = timeout
+        self.cache_path = cache_path
+        self.pool_size = pool_size
+        self.session_lock = threading.Lock()
+        self.run_cache = {}
+        self.run_cache_locks = {}
+        self.run_cache_lock = threading.Lock()
+
+    def __getattr__(self, name):
+        # the session is only set up when first needed, so that commands
+        # that never fetch anything do not import requests
+        if name == 'session':
+            with self.session_lock:
+                if 'session' not in self.__dict__:
+                    session = requests.Session()
+                    adapter = requests_adapters.HTTPAdapter(
+                        pool_connections=self.pool_size,
+                        pool_maxsize=self.pool_size
+                    )
+                    session.mount('https://', adapter)
+                    session.mount('http://', adapter)
+                    self.session = session
+            return self.session
+        raise AttributeError(name)
+
+    def new_run(self):
+        with self.run_cache_lock:
+            self.run_cache = {}
+            self.run_cache_locks = {}
+
+    def memoised(self, key, produce):
+        """
+        produce() once per key per run; threads asking for a key that is
+        still being produced wait for it rather than fetching it again
+        """
+        with self.run_cache_lock:
+            if key in self.run_cache:
+                return self.run_cache[key]
+            key_lock = self.run_cache_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            with self.run_cache_lock:
+                if key in self.run_cache:
+                    return self.run_cache[key]
+            value = produce()
+            with self.run_cache_lock:
+                self.run_cache[key] = value
+        return value
+
+    def get_parsed(self, url, parse):
+        """
+        parse(response) for url, downloading and parsing it once per run;
+        an error response raises requests.HTTPError rather than being parsed
+        """
+        url = urldefrag(url)[0]
+
+        def get_and_parse():
+            response = self.get(url)
+            response.raise_for_status()
+            return parse(response)
+
+        return self.memoised(('parsed', url, parse), get_and_parse)
+
+    def get(self, url, **kwargs):
+        self.rate_limiter.wait(url)
+        kwargs.setdefault('timeout', self.timeout)
+        host = urlparse(url).hostname
+        try:
+            response = self.session.get(url, **kwargs)
+        except requests.RequestException as e:
+            metrics.count('http_errors', host=host, error=type(e).__name__)
+            raise
+        metrics.count(
+            'http_responses', host=host, status=response.status_code
+        )
+        metrics.count(
+            'bytes_downloaded', len(response.content), host=host
+        )
+        return response
+
+    def cache_filename(self, url):
+        return self.cache_path + sha1(url.encode('utf-8')).hexdigest() + \
+            '.json'
+
+    def load_cache_entry(self, url):
+        try:
+            with open(self.cache_filename(url), 'r') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def save_cache_entry(self, url, entry):
+        os.makedirs(self.cache_path, exist_ok=True)
+        filename = self.cache_filename(url)
+        # write then rename, so that concurrent readers never see half a file
+        temp_filename = '{filename}.{pid}.{thread}'.format(
+            filename=filename,
+            pid=os.getpid(),
+            thread=threading.get_ident()
+        )
+        with open(temp_filename, 'w') as f:
+            json.dump(entry, f)
+        os.replace(temp_filename, filename)
+
+    def get_extracted(self, url, extract):
+        """
+        fetch url and return extract(response), unless the server says the
+        page has not changed since we last saw it, in which case the
+        payload extracted last time is returned without parsing anything;
+        extract must return something json serialisable
+        """
+        url = urldefrag(url)[0]
+        return self.memoised(
+            ('extracted', url, extract),
+            lambda: self.revalidate(url, extract)
+        )
+
+    def revalidate(self, url, extract):
+        entry = self.load_cache_entry(url)
+        headers = {}
+        if entry is not None:
+            if entry.get('etag') is not None:
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified') is not None:
+                headers['If-Modified-Since'] = entry['last_modified']
+        with metrics.phase('page_fetch'):
+            response = self.get(url, headers=headers)
+        if response.status_code == 304 and entry is not None:
+            return entry['extracted']
+        response.raise_for_status()
+        extracted = extract(response)
+        if 'ETag' in response.headers or 'Last-Modified' in response.headers:
+            self.save_cache_entry(url, {
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+                'extracted': extracted
+            })
+        return extracted
+
+
+rate_limiter = RateLimiter(HOST_RATE_LIMITS)
+client = Client(rate_limiter)
+
+
+def get(url, **kwargs):
+    return client.get(url, **kwargs)
@@ -0,0 +1,670 @@
+from contextlib import contextmanager
+import os
+import threading
+
+from lazy import LazyModule, installed
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+arrow = LazyModule('arrow')
+pd = LazyModule('pandas')
+if installed('pyarrow'):
+    pa = LazyModule('pyarrow')
+    ds = LazyModule('pyarrow.dataset')
+    pq = LazyModule('pyarrow.parquet')
+else:
+    pa = None
+
+KINDS = ('price', 'availability')
+# rows per chunk when streaming history across many items
+CHUNK_ROWS = 100000
+# how history is held in memory: values repeated on every row are
+# categoricals, and human_timestamp, which only restates timestamp, is left
+# out (see human_timestamps)
+MEMORY_TYPES = {
+    'price': {
+        'timestamp': 'int64',
+        'price': 'float64',
+    },
+    'availability': {
+        'timestamp': 'int64',
+        'location': 'category',
+        'store_id': 'category',
+        'size': 'category',
+        'size_id': 'category',
+        'available': 'boolean',
+        'quantity': 'Int32',
+    },
+}
+
+
+def compact(df, kind):
+    """
+    a history frame (as read from disk, or built from a snapshot) in its
+    in-memory form, see MEMORY_TYPES
+    """
+    df = df.reindex(columns=list(MEMORY_TYPES[kind]))
+    if kind == 'availability':
+        # ids as integers, rather than floats because of missing values,
+        # before they become categories
+        df = df.astype({'store_id': 'Int64', 'size_id': 'Int64'})
+    return df.astype(MEMORY_TYPES[kind])
+
+
+def human_timestamps(timestamps):
+    """
+    the local times of epoch timestamps, as recorded next to them on disk
+    """
+    local_times = {
+        timestamp: str(arrow.get(int(timestamp)).to('local'))
+        for timestamp in pd.unique(timestamps)
+    }
+    return timestamps.map(local_times)
+
+
+def with_human_timestamp(df):
+    if 'human_timestamp' in df.columns and \
+            df['human_timestamp'].notnull().all():
+        return df
+    return df.assign(human_timestamp=human_timestamps(df['timestamp']))
+
+
+def filtered(df, start=None, end=None, locations=None, sizes=None):
+    """
+    the rows of a history frame within [start, end] (epoch timestamps) and,
+    for availability, at one of the locations and of one of the sizes given
+    """
+    mask = pd.Series(True, index=df.index)
+    if start is not None:
+        mask &= df['timestamp'] >= start
+    if end is not None:
+        mask &= df['timestamp'] <= end
+    if locations is not None:
+        mask &= df['location'].isin(locations)
+    if sizes is not None:
+        mask &= df['size'].isin(sizes)
+    return df[mask]
+
+
+def chunks(frames, chunk_rows=CHUNK_ROWS):
+    """
+    frames regrouped into frames of about chunk_rows rows, so that many
+    small ones (e.g. one per item) come out in few, and memory stays bounded
+    by the chunk size and the largest frame given
+    """
+    buffer = []
+    rows = 0
+    for frame in frames:
+        if len(frame) == 0:
+            continue
+        buffer.append(frame)
+        rows += len(frame)
+        if rows >= chunk_rows:
+            yield pd.concat(buffer, axis=0, ignore_index=True)
+            buffer = []
+            rows = 0
+    if len(buffer) > 0:
+        yield pd.concat(buffer, axis=0, ignore_index=True)
+
+
+def latest(df, key):
+    """
+    the last row of a time-ordered history frame for each key (e.g.
+    location / store / size), or the last row if key is empty
+    """
+    if len(key) == 0:
+        return df.tail(1)
+    return df.groupby(key, dropna=False, observed=True, sort=False).tail(1)
+
+
+@contextmanager
+def locked(filename):
+    """
+    a file opened for appending, with an exclusive lock on it (where the
+    platform has them) between processes appending to it and retention
+    rewriting it; if it was replaced while waiting, the new file is locked
+    """
+    while True:
+        f = open(filename, 'a', newline='')
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            if os.path.samestat(os.fstat(f.fileno()), os.stat(filename)):
+                break
+        except FileNotFoundError:
+            pass
+        f.close()
+    try:
+        yield f
+    finally:
+        f.close()
+
+
+def last_line(f):
+    """
+    the last non-empty line of a file opened in binary mode, read backwards
+    from the end a block at a time
+    """
+    end = f.seek(0, os.SEEK_END)
+    block_size = 1024
+    while True:
+        start = max(end - block_size, 0)
+        f.seek(start)
+        lines = f.read(end - start).splitlines()
+        lines = [line for line in lines if line.strip()]
+        if start == 0 or len(lines) > 1:
+            return lines[-1] if len(lines) > 0 else b''
+        block_size *= 2
+
+
+class CsvHistory:
+    """
+    The original layout: one price_*.csv and one availability_*.csv next to
+    each item's json, appended to as text.
+    """
+
+    @staticmethod
+    def filename(filepath, filename, kind):
+        return filepath + '/' + kind + '_' + filename + '.csv'
+
+    def files(self, filepath, filename, kind):
+        return [self.filename(filepath, filename, kind)]
+
+    def read(self, item, kind):
+        return pd.read_csv(
+            self.filename(item.filepath, item.filename, kind)
+        ).reindex(columns=item.history_columns(kind))
+
+    def timestamp_range(self, item, kind):
+        return self.file_timestamp_range(
+            self.filename(item.filepath, item.filename, kind)
+        )
+
+    @staticmethod
+    def file_timestamp_range(filename):
+        """
+        first and last recorded timestamps, from the first and last lines of
+        the file only; rows are appended in time order
+        """
+        with open(filename, 'rb') as f:
+            f.readline()
+            first = f.readline().split(b',')[0].strip()
+            if len(first) == 0:
+                return None, None
+            last = last_line(f).split(b',')[0]
+        return int(float(first)), int(float(last))
+
+    def stream(self, kind, items, start=None, end=None, locations=None,
+               sizes=None, chunk_rows=CHUNK_ROWS):
+        """
+        the history of many items, (filepath, filename) pairs, as frames
+        with an added filename column, read chunk_rows lines at a time.
+        Files are in time order, so those entirely outside [start, end] are
+        skipped after reading their first and last lines, and the others
+        are only read up to end.
+        """
+        for filepath, filename in items:
+            history_filename = self.filename(filepath, filename, kind)
+            try:
+                first, last = self.file_timestamp_range(history_filename)
+            except FileNotFoundError:
+                continue
+            if first is None or (start is not None and last < start) or \
+                    (end is not None and first > end):
+                continue
+            for chunk in pd.read_csv(
+                    history_filename,
+                    usecols=lambda column: column in MEMORY_TYPES[kind],
+                    chunksize=chunk_rows
+            ):
+                yield filtered(
+                    chunk, start, end, locations, sizes
+                ).assign(filename=filename)
+                if end is not None and chunk['timestamp'].iloc[-1] > end:
+                    break
+
+    def write(self, item, kind, df):
+        with_human_timestamp(df).reindex(
+            columns=item.history_columns(kind)
+        ).to_csv(
+            item.filepath + '/' + item.history_filename(kind),
+            index=False
+        )
+
+    def append(self, item, kind, df):
+        with locked(item.filepath + '/' + item.history_filename(kind)) as f:
+            with_human_timestamp(df).reindex(
+                columns=item.history_columns(kind)
+            ).to_csv(f, index=None, header=None)
+
+    def remove_before(self, kind, items, before, key):
+        """
+        drop the rows of many items, (filepath, filename) pairs, recorded
+        before the timestamp before, except the latest one per key, which
+        still holds at before; the files are rewritten as they were read,
+        under the lock appends take
+        """
+        for filepath, filename in items:
+            history_filename = self.filename(filepath, filename, kind)
+            if not os.path.exists(history_filename):
+                continue
+            with locked(history_filename):
+                rows = pd.read_csv(
+                    history_filename, dtype=str, keep_default_na=False
+                )
+                old = rows['timestamp'].astype(float) < before
+                remove = old & ~rows.index.isin(latest(rows[old], key).index)
+                if not remove.any():
+                    continue
+                rows[~remove].to_csv(history_filename + '.tmp', index=False)
+                os.replace(history_filename + '.tmp', history_filename)
+
+
+class ColumnarHistory:
+    """
+    History for every item kept in typed, compressed parquet files,
+    partitioned by kind, audience segment, type and month:
+
+        history/{kind}/{audience_segment}/{type}/{YYYY-MM}.parquet
+
+    with an added `filename` column identifying the item. Updates go to a
+    small per-item csv log in the partition's log/ directory, which
+    `compact` folds into the parquet files. Reads combine both, so nothing
+    is lost between compactions.
+
+    Logs are appended to under a lock (see `locked`), which compaction
+    takes to rename each log out of the way before reading it, and parquet
+    files are replaced atomically, so it is safe to run while items are
+    being updated; rows seen twice mid-compaction are dropped on read.
+    """
+
+    PATH = 'history/'
+    # where item json lives, as items/{audience_segment}/{type}
+    ITEMS_PATH = 'items/'
+    LOG_DIRECTORY = 'log'
+    COMPACTING_SUFFIX = '.compacting'
+    COLUMN_TYPES = {
+        'price': {
+            'timestamp': 'int64',
+            'human_timestamp': 'string',
+            'price': 'float64',
+        },
+        'availability': {
+            'timestamp': 'int64',
+            'human_timestamp': 'string',
+            'location': 'string',
+            'store_id': 'Int64',
+            'size': 'string',
+            'size_id': 'Int64',
+            'available': 'boolean',
+            'quantity': 'Int64',
+        },
+    }
+
+    def __init__(self, path=PATH):
+        if pa is None:
+            raise ImportError(
+                'pyarrow is needed for the columnar history store'
+            )
+        self.path = path
+        self.compaction_lock = threading.Lock()
+
+    def partition(self, item):
+        return self.filepath_partition(item.filepath)
+
+    def filepath_partition(self, filepath):
+        return os.path.relpath(filepath, self.ITEMS_PATH)
+
+    def log_filename(self, kind, partition, filename):
+        return self.log_path(kind, partition) + '/' + filename + '.csv'
+
+    def files(self, filepath, filename, kind):
+        """
+        every file that may hold some of an item's history
+        """
+        partition = self.filepath_partition(filepath)
+        log_filename = self.log_filename(kind, partition, filename)
+        return self.parquet_filenames(kind, partition) + [
+            log_filename, log_filename + self.COMPACTING_SUFFIX
+        ]
+
+    def timestamp_range(self, item, kind):
+        partition = self.partition(item)
+        parquet_filenames = self.parquet_filenames(kind, partition)
+        timestamps = []
+        if len(parquet_filenames) > 0:
+            timestamps.append(ds.dataset(
+                parquet_filenames, format='parquet'
+            ).to_table(
+                columns=['timestamp'],
+                filter=ds.field('filename') == item.filename
+            ).to_pandas()['timestamp'])
+        log_filename = self.log_filename(kind, partition, item.filename)
+        for filename in (
+                log_filename, log_filename + self.COMPACTING_SUFFIX
+        ):
+            if os.path.exists(filename):
+                timestamps.append(self.read_log(kind, filename)['timestamp'])
+        timestamps = pd.concat(timestamps) if len(timestamps) > 0 \
+            else pd.Series([])
+        if len(timestamps) == 0:
+            return None, None
+        return int(timestamps.min()), int(timestamps.max())
+
+    def partition_path(self, kind, partition):
+        return self.path + kind + '/' + partition
+
+    def log_path(self, kind, partition):
+        return self.partition_path(kind, partition) + '/' + \
+            self.LOG_DIRECTORY
+
+    def typed(self, kind, df):
+        columns = self.COLUMN_TYPES[kind]
+        df = df.reindex(columns=list(columns))
+        df['human_timestamp'] = df['human_timestamp'].astype(str)
+        return df.astype(columns)
+
+    def read(self, item, kind):
+        partition = self.partition(item)
+        parquet_filenames = self.parquet_filenames(kind, partition)
+        frames = []
+        if len(parquet_filenames) > 0:
+            frames.append(ds.dataset(
+                parquet_filenames, format='parquet'
+            ).to_table(
+                columns=list(self.COLUMN_TYPES[kind]),
+                filter=ds.field('filename') == item.filename
+            ).to_pandas())
+        log_filename = self.log_filename(kind, partition, item.filename)
+        for filename in (
+                log_filename, log_filename + self.COMPACTING_SUFFIX
+        ):
+            if os.path.exists(filename):
+                frames.append(self.read_log(kind, filename))
+        if len(frames) == 0:
+            return pd.DataFrame(columns=item.history_columns(kind))
+        return pd.concat(
+            [self.typed(kind, frame) for frame in frames], axis=0
+        ).drop_duplicates()\
+         .sort_values('timestamp', kind='mergesort')\
+         .reset_index(drop=True)\
+         .reindex(columns=item.history_columns(kind))
+
+    def read_log(self, kind, filename):
+        return pd.read_csv(
+            filename, header=None, names=list(self.COLUMN_TYPES[kind])
+        )
+
+    def stream(self, kind, items, start=None, end=None, locations=None,
+               sizes=None, chunk_rows=CHUNK_ROWS):
+        """
+        the history of many items, (filepath, filename) pairs, as frames
+        with an added filename column. Monthly files outside [start, end]
+        are not opened, and the filters are pushed down to the others, which
+        are read a batch of at most chunk_rows rows at a time.
+        """
+        columns = list(MEMORY_TYPES[kind]) + ['filename']
+        filenames_by_partition = self.filenames_by_partition(items)
+        first_month = arrow.get(start).format('YYYY-MM') \
+            if start is not None else None
+        last_month = arrow.get(end).format('YYYY-MM') \
+            if end is not None else None
+        for partition, filenames in sorted(filenames_by_partition.items()):
+            parquet_filenames = [
+                filename
+                for filename in self.parquet_filenames(kind, partition)
+                if (first_month is None or
+                    os.path.basename(filename)[:7] >= first_month) and
+                (last_month is None or
+                 os.path.basename(filename)[:7] <= last_month)
+            ]
+            condition = ds.field('filename').isin(filenames)
+            if start is not None:
+                condition &= ds.field('timestamp') >= start
+            if end is not None:
+                condition &= ds.field('timestamp') <= end
+            if locations is not None:
+                condition &= ds.field('location').isin(list(locations))
+            if sizes is not None:
+                condition &= ds.field('size').isin(list(sizes))
+            dataset = ds.dataset(parquet_filenames, format='parquet') \
+                if len(parquet_filenames) > 0 else None
+            if dataset is not None:
+                for batch in dataset.to_batches(
+                        columns=columns,
+                        filter=condition,
+                        batch_size=chunk_rows
+                ):
+                    if batch.num_rows > 0:
+                        yield batch.to_pandas()
+            for filename in filenames:
+                log_filename = self.log_filename(kind, partition, filename)
+                for suffix in ('', self.COMPACTING_SUFFIX):
+                    if not os.path.exists(log_filename + suffix):
+                        continue
+                    log = filtered(
+                        self.typed(
+                            kind, self.read_log(kind, log_filename + suffix)
+                        ),
+                        start, end, locations, sizes
+                    ).assign(filename=filename).reindex(columns=columns)
+                    if suffix == self.COMPACTING_SUFFIX and \
+                            dataset is not None and len(log) > 0:
+                        # mid-compaction, some of these may already be in
+                        # the parquet files
+                        log = self.not_in(dataset, log, filename)
+                    yield log
+
+    def filenames_by_partition(self, items):
+        filenames_by_partition = {}
+        for filepath, filename in items:
+            filenames_by_partition.setdefault(
+                self.filepath_partition(filepath), []
+            ).append(filename)
+        return filenames_by_partition
+
+    @staticmethod
+    def not_in(dataset, log, filename):
+        """
+        the rows of an item's log that its parquet rows do not already have
+        """
+        compacted = dataset.to_table(
+            columns=list(log.columns),
+            filter=(ds.field('filename') == filename) &
+            (ds.field('timestamp') >= int(log['timestamp'].min()))
+        ).to_pandas()
+        seen = set(compacted.astype(str).itertuples(index=False, name=None))
+        return log[[
+            row not in seen
+            for row in log.astype(str).itertuples(index=False, name=None)
+        ]]
+
+    def write(self, item, kind, df):
+        self.append(item, kind, df)
+
+    def append(self, item, kind, df):
+        log_path = self.log_path(kind, self.partition(item))
+        os.makedirs(log_path, exist_ok=True)
+        with locked(self.log_filename(
+                kind, self.partition(item), item.filename
+        )) as f:
+            with_human_timestamp(df).reindex(
+                columns=list(self.COLUMN_TYPES[kind])
+            ).to_csv(f, index=None, header=None)
+
+    def parquet_filenames(self, kind, partition):
+        partition_path = self.partition_path(kind, partition)
+        if not os.path.isdir(partition_path):
+            return []
+        return sorted(
+            partition_path + '/' + filename
+            for filename in os.listdir(partition_path)
+            if filename.endswith('.parquet')
+        )
+
+    def partitions(self, kind):
+        kind_path = self.path + kind
+        if not os.path.isdir(kind_path):
+            return []
+        return sorted(
+            audience_segment + '/' + category_type
+            for audience_segment in os.listdir(kind_path)
+            for category_type in os.listdir(kind_path + '/' + audience_segment)
+        )
+
+    def compact(self):
+        """
+        fold every log into the monthly parquet files of its partition
+        """
+        with self.compaction_lock:
+            for kind in KINDS:
+                for partition in self.partitions(kind):
+                    self.compact_partition(kind, partition)
+
+    def compact_partition(self, kind, partition):
+        log_path = self.log_path(kind, partition)
+        if not os.path.isdir(log_path):
+            return
+        for filename in os.listdir(log_path):
+            if filename.endswith('.csv'):
+                # under the lock appends take, so that none is still
+                # writing to the log once it has been read
+                with locked(log_path + '/' + filename):
+                    os.replace(
+                        log_path + '/' + filename,
+                        log_path + '/' + filename + self.COMPACTING_SUFFIX
+                    )
+        # including any left behind by a compaction that was interrupted
+        compacting = sorted(
+            filename[:-len(self.COMPACTING_SUFFIX)]
+            for filename in os.listdir(log_path)
+            if filename.endswith(self.COMPACTING_SUFFIX)
+        )
+        if len(compacting) == 0:
+            return
+        new_rows = pd.concat([
+            self.typed(kind, self.read_log(
+                kind, log_path + '/' + filename + self.COMPACTING_SUFFIX
+            )).assign(filename=filename[:-4])
+            for filename in compacting
+        ], axis=0)
+        months = new_rows['timestamp'].map(
+            lambda timestamp: arrow.get(timestamp).format('YYYY-MM')
+        )
+        for month, month_rows in new_rows.groupby(months):
+            self.write_month(kind, partition, month, month_rows)
+        for filename in compacting:
+            os.remove(log_path + '/' + filename + self.COMPACTING_SUFFIX)
+
+    def write_month(self, kind, partition, month, new_rows):
+        filename = self.partition_path(kind, partition) + '/' + month + \
+            '.parquet'
+        frames = [new_rows]
+        if os.path.exists(filename):
+            frames.insert(0, pq.read_table(filename).to_pandas())
+        # sorted by item, so that row group statistics let reads of one item
+        # skip everything else
+        month_rows = pd.concat(frames, axis=0)\
+                       .drop_duplicates()\
+                       .sort_values(['filename', 'timestamp'])
+        self.write_parquet(filename, month_rows)
+
+    @staticmethod
+    def write_parquet(filename, rows):
+        temp_filename = filename + '.tmp'
+        pq.write_table(
+            pa.Table.from_pandas(rows, preserve_index=False),
+            temp_filename,
+            row_group_size=50000
+        )
+        os.replace(temp_filename, filename)
+
+    def remove_before(self, kind, items, before, key):
+        """
+        drop the rows of many items, (filepath, filename) pairs, recorded
+        before the timestamp before, except the latest one per key, which
+        still holds at before. Logs are compacted first, and only the
+        monthly files up to before are rewritten, each at most once.
+        """
+        last_month = arrow.get(before - 1).format('YYYY-MM')
+        with self.compaction_lock:
+            for partition, filenames in sorted(
+                    self.filenames_by_partition(items).items()
+            ):
+                self.compact_partition(kind, partition)
+                month_filenames = [
+                    filename
+                    for filename in self.parquet_filenames(kind, partition)
+                    if os.path.basename(filename)[:7] <= last_month
+                ]
+                if len(month_filenames) == 0:
+                    continue
+                # the timestamp of each item's latest row per key, across
+                # every month, reading only the columns that takes
+                latest_rows = pd.concat([
+                    pq.read_table(
+                        filename,
+                        columns=['filename', 'timestamp'] + key,
+                        filters=[
+                            ('filename', 'in', filenames),
+                            ('timestamp', '<', before)
+                        ]
+                    ).to_pandas()
+                    for filename in month_filenames
+                ])
+                if len(latest_rows) == 0:
+                    continue
+                latest_rows = latest_rows.groupby(
+                    ['filename'] + key, dropna=False, observed=True
+                )['timestamp'].max().reset_index()
+                for filename in month_filenames:
+                    self.remove_from_month(
+                        filename, filenames, before, key, latest_rows
+                    )
+
+    def remove_from_month(self, filename, filenames, before, key,
+                          latest_rows):
+        rows = pq.read_table(filename).to_pandas()
+        old = rows['filename'].isin(filenames) & (rows['timestamp'] < before)
+        kept = rows[old].reset_index().merge(
+            latest_rows, on=['filename'] + key + ['timestamp']
+        )['index']
+        remove = old & ~rows.index.isin(kept)
+        if remove.any():
+            # replaced, even when nothing is left, rather than deleted, so
+            # that reads listing the partition's files still find it
+            self.write_parquet(filename, rows[~remove])
+
+    def migrate_from_csv(self, items):
+        """
+        copy the csv history of every item given into this store and compact
+        it; the csv files are left where they are
+        """
+        csv_history = CsvHistory()
+        for item in items:
+            for kind in KINDS:
+                self.append(item, kind, csv_history.read(item, kind))
+        self.compact()
+
+
+_backend = None
+
+
+def get_backend():
+    """
+    the columnar store once history has been migrated to it (i.e. its
+    directory exists), otherwise the csv files
+    """
+    global _backend
+    if _backend is None:
+        _backend = ColumnarHistory() \
+            if os.path.isdir(ColumnarHistory.PATH) else CsvHistory()
+    return _backend
+
+
+def set_backend(backend):
+    global _backend
+    _backend = backend
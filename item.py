@@ -3,20 +3,22 @@ import json
 import os
 import pickle
 import re
-import requests
-from unidecode import unidecode
-from urllib.parse import quote, urlparse
+from urllib.parse import quote, urljoin, urlparse
 from warnings import warn
 
-import arrow
-from bs4 import BeautifulSoup
-import pandas as pd
+import alerts
+import fetch
+import history
+from lazy import LazyModule
+import metrics
+import stores
+import summary
 
-with open('stores.json', 'r') as f:
-    STORE_IDS = {
-        store['id']: ' '.join(store['addressLines'])
-        for store in json.load(f)
-    }
+# imported when first used, see lazy.py
+arrow = LazyModule('arrow')
+bs4 = LazyModule('bs4')
+pd = LazyModule('pandas')
+unidecode = LazyModule('unidecode')
 
 
 class Item:
@@ -34,14 +36,38 @@ class Item:
         care (str)
         category ((audience_segment, type))
         price_history
-            (pd.DataFrame((timestamp, human_timestamp, price)))
+            (pd.DataFrame((timestamp, price)))
         availability
             (pd.DataFrame((
-                timestamp, human_timestamp, location, size, available
+                timestamp, location, store_id, size, size_id, available,
+                quantity
             )))
         bought (bool)
         ignore (bool)
+        locations ([str] or None): named locations whose nearest stores
+            are tracked for this item, None for every tracked store
+        first_recorded (int): when the item was first recorded, once
+            retention has removed its oldest history (see retention.py)
+        rolled_up_until (int): history before this has been rolled up into
+            daily rows by retention
         filename (str)
+
+    Items loaded with `Item.from_disk(..., lazy=True)` only read their json
+    metadata; price_history and availability are read from disk the first
+    time they are accessed.
+
+    History is held in memory in compact, typed frames (see
+    history.MEMORY_TYPES): timestamps are epoch integers, repeated strings
+    and ids are categoricals, and the human_timestamp recorded on disk is
+    left out; `history.human_timestamps(item.price_history['timestamp'])`
+    derives it when needed.
+
+    The price and availability seen by the last update are kept in a small
+    state file next to the item's json. With `Item.RECORDING = 'changes'`,
+    updates use it to record only rows that changed (and, for sizes /
+    stores that disappeared, a row with no `available` value);
+    `price_as_of` and `availability_as_of` rebuild the full picture at any
+    point in time from either kind of history.
     """
 
     PATH = 'items/'
@@ -59,11 +85,35 @@ class Item:
         '{part_number}?physicalStoreId={store_ids}&ajax=true'
     )
     COLOR_ANCHOR = '#selectedColor={color_id}'
+    DATA_LAYER_MARKER = 'window.zara.dataLayer = '
+    PART_NUMBER_PATTERN = r'"zara:///1/products\?partNumber=(\d+)"'
+    # path of an item page, as linked from category listings
+    ITEM_PATH_PATTERN = r'-p\d+\.html$'
+    # 'snapshots' records every price / availability on every update,
+    # 'changes' only what differs from the last update
+    RECORDING = 'snapshots'
+    AVAILABILITY_KEY = ['location', 'store_id', 'size_id']
+    # store ids per stock request, to keep urls and responses small
+    STOCK_BATCH_SIZE = 20
 
     def __init__(self, **kwargs):
         assert 'canonical_url' in kwargs, 'item url not provided'
         self.__dict__.update(kwargs)
 
+    def __getattr__(self, name):
+        # only called for attributes that have not been set, i.e. history
+        # that a lazily loaded item has not read yet
+        if name == 'price_history':
+            self.price_history = self.read_price_history()
+            return self.price_history
+        if name == 'availability':
+            self.availability = self.read_availability()
+            return self.availability
+        raise AttributeError(name)
+
+    def history_loaded(self, name):
+        return name in self.__dict__
+
     def filename_prefixes(self):
         return (
             'bought_' if self.bought is True else ''
@@ -85,13 +135,121 @@ class Item:
     def price_filename(self):
         return self.filename_prefixes() + 'price_' + self.filename + '.csv'
 
+    def history_filename(self, kind):
+        return self.price_filename() if kind == 'price' \
+            else self.availability_filename()
+
+    def history_columns(self, kind):
+        return self.PRICE_HISTORY_COLUMNS if kind == 'price' \
+            else self.AVAILABILITY_COLUMNS
+
+    def state_filename(self):
+        return self.filename + '.state'
+
+    def read_state(self):
+        try:
+            with open(self.filepath + '/' + self.state_filename(), 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    @staticmethod
+    def state(timestamp, price, size_availabilities):
+        return {
+            'last_checked': timestamp,
+            'price': price,
+            'availability': {
+                Item.availability_key(size_availability): size_availability
+                for size_availability in size_availabilities
+            }
+        }
+
+    def write_state(self, timestamp, price, size_availabilities):
+        filename = self.filepath + '/' + self.state_filename()
+        with open(filename + '.tmp', 'w') as f:
+            json.dump(self.state(timestamp, price, size_availabilities), f)
+        os.replace(filename + '.tmp', filename)
+
+    def timestamp_range(self):
+        """
+        first and last recorded prices' timestamps, without reading the
+        whole history unless it has already been read; the first is kept
+        in the item's json once retention has removed it from history
+        """
+        if self.history_loaded('price_history'):
+            timestamps = self.price_history['timestamp']
+            first, last = timestamps.min(), timestamps.max()
+        else:
+            first, last = history.get_backend().timestamp_range(self, 'price')
+        first_recorded = self.__dict__.get('first_recorded')
+        if first_recorded is not None and (
+                first is None or pd.isnull(first) or first_recorded < first
+        ):
+            first = first_recorded
+        return first, last
+
+    def last_checked(self):
+        """
+        when the item was last updated, even if nothing was recorded then
+        """
+        state = self.read_state()
+        _, last_recorded = self.timestamp_range()
+        if state is None:
+            return last_recorded
+        return max(state['last_checked'], last_recorded)
+
+    @staticmethod
+    def availability_key(size_availability):
+        return '{location}|{store_id}|{size_id}'.format(**size_availability)
+
+    @staticmethod
+    def availability_changes(state, size_availabilities):
+        previous = state['availability'] if state is not None else {}
+        current = {
+            Item.availability_key(size_availability): size_availability
+            for size_availability in size_availabilities
+        }
+        return [
+            size_availability
+            for key, size_availability in current.items()
+            if previous.get(key) != size_availability
+        ] + [
+            # no longer listed, so no longer available either way
+            dict(size_availability, available=None, quantity=None)
+            for key, size_availability in previous.items()
+            if key not in current and
+            size_availability['available'] is not None
+        ]
+
+    def price_as_of(self, timestamp):
+        prices = self.price_history[
+            self.price_history['timestamp'] <= timestamp
+        ]
+        if len(prices) == 0:
+            return None
+        return float(
+            prices.sort_values('timestamp', kind='mergesort')['price']
+                  .iloc[-1]
+        )
+
+    def availability_as_of(self, timestamp):
+        """
+        the latest known availability of every size / location at timestamp
+        """
+        availability = self.availability[
+            self.availability['timestamp'] <= timestamp
+        ].sort_values('timestamp', kind='mergesort')\
+         .drop_duplicates(subset=self.AVAILABILITY_KEY, keep='last')
+        return availability[availability['available'].notnull()]\
+            .reset_index(drop=True)
+
     def to_disk(self):
         self.filepath = self.FILEPATH.format(
             audience_segment=self.category[0].lower(),
             type=self.category[1].lower()
         )
         os.makedirs(self.filepath, exist_ok=True)
-        self.filename = unidecode(
+        self.filename = unidecode.unidecode(
             self.name.lower().replace(' ', '_')
         )
         if self.json_filename() in os.listdir(self.filepath):
@@ -100,36 +258,54 @@ class Item:
                 '_{time}'.format(time=arrow.now().timestamp)
             )
 
-        to_archive = self.__dict__.copy()
-        to_archive.pop('price_history')\
-                  .to_csv(
-                      self.filepath + '/' + self.price_filename(), index=False
-                  )
-        to_archive.pop('availability')\
-                  .to_csv(
-                      self.filepath + '/' + self.availability_filename(),
-                      index=False
-                  )
-        with open(self.filepath + '/' + self.json_filename(), 'w') as f:
-            print(json.dumps(to_archive), file=f)
-
-    @staticmethod
-    def from_disk(filepath, filename):
+        history_backend = history.get_backend()
+        history_backend.write(self, 'price', self.price_history)
+        history_backend.write(self, 'availability', self.availability)
+        self.write_json()
+
+    def write_json(self):
+        metadata = {
+            name: value for name, value in self.__dict__.items()
+            if name not in ('price_history', 'availability')
+        }
+        filename = self.filepath + '/' + self.json_filename()
+        with open(filename + '.tmp', 'w') as f:
+            print(json.dumps(metadata), file=f)
+        os.replace(filename + '.tmp', filename)
+
+    def read_price_history(self):
+        return history.compact(
+            history.get_backend().read(self, 'price'), 'price'
+        )
+
+    def read_availability(self):
+        return history.compact(
+            history.get_backend().read(self, 'availability'), 'availability'
+        )
+
+    @staticmethod
+    def from_disk(filepath, filename, lazy=False):
         with open(filepath + '/' + filename + '.json', 'r') as f:
             item = Item(**json.load(f))
-        item.price_history = pd.read_csv(
-            filepath + '/price_' + filename + '.csv'
-        ).reindex(columns=Item.PRICE_HISTORY_COLUMNS)
-        item.availability = pd.read_csv(
-            filepath + '/availability_' + filename + '.csv'
-        ).reindex(columns=Item.AVAILABILITY_COLUMNS)
+        item.filepath = filepath
+        item.filename = filename
+        if lazy is False:
+            item.price_history = item.read_price_history()
+            item.availability = item.read_availability()
         return item
 
+    @staticmethod
+    def parse_page(response):
+        return bs4.BeautifulSoup(response.text, 'lxml')
+
     @staticmethod
     def get_soup(url, color=None):
+        """
+        the page is the same for every color (the color anchor is never
+        sent to the server), so it is fetched and parsed only once per run
+        """
         color_id = None
-        response = requests.get(url)
-        soup = BeautifulSoup(response.text, 'lxml')
+        soup = fetch.client.get_parsed(url, Item.parse_page)
         if color is not None:
             data = Item.get_data_layer(soup)
             colors = {
@@ -138,13 +314,57 @@ class Item:
             }
             if color.lower() in colors:
                 color_id = colors.get(color.lower())
-                url += Item.COLOR_ANCHOR.format(color_id=color_id)
-                response = requests.get(url)
-                soup = BeautifulSoup(response.text, 'lxml')
             else:
                 color = None
         return soup, color, color_id
 
+    @staticmethod
+    def extract_update_data(response):
+        return Item.scan_update_data(response.text) or \
+            Item.parse_update_data(response.text)
+
+    @staticmethod
+    def scan_update_data(html):
+        """
+        pick the data layer and part number straight out of the page text,
+        without building a tree; None if the page is not laid out as expected
+        """
+        with metrics.phase('parse'):
+            start = html.find(Item.DATA_LAYER_MARKER)
+            part_number = re.search(Item.PART_NUMBER_PATTERN, html)
+        if start == -1 or part_number is None:
+            return None
+        try:
+            with metrics.phase('extract'):
+                data_layer, _ = json.JSONDecoder().raw_decode(
+                    html, start + len(Item.DATA_LAYER_MARKER)
+                )
+        except ValueError:
+            return None
+        return {
+            'data_layer': data_layer,
+            'part_number': part_number.group(1)
+        }
+
+    @staticmethod
+    def parse_update_data(html):
+        with metrics.phase('parse'):
+            soup = bs4.BeautifulSoup(html, 'lxml')
+        with metrics.phase('extract'):
+            return {
+                'data_layer': Item.get_data_layer(soup),
+                'part_number': Item.get_part_number(soup)
+            }
+
+    @staticmethod
+    def get_update_data(url):
+        """
+        the parts of an item page that an update needs; if the page has not
+        changed since the last update, this is served from the fetch cache
+        without re-parsing
+        """
+        return fetch.client.get_extracted(url, Item.extract_update_data)
+
     @staticmethod
     def get_data_layer(soup):
         return json.loads(re.match(
@@ -165,7 +385,7 @@ class Item:
     @staticmethod
     def get_part_number(soup):
         return re.search(
-            r'"zara:///1/products\?partNumber=(\d+)"',
+            Item.PART_NUMBER_PATTERN,
             soup.text
         ).groups(1)[0]
 
@@ -342,15 +562,41 @@ class Item:
         }], columns=Item.PRICE_HISTORY_COLUMNS)
 
     @staticmethod
-    def get_size_availabilities(soup, data, color_id=None):
-        response = requests.get(
-            Item.STORE_AVAILABILITY_URL.format(
-                year=arrow.now().year,
-                part_number=Item.get_part_number(soup),
-                store_ids=quote(','.join(map(str, STORE_IDS.keys())))
-            )
-        )
-        stocks = json.loads(response.text).get('stocks') or []
+    def parse_stocks(response):
+        return json.loads(response.text).get('stocks') or []
+
+    @staticmethod
+    def get_store_stocks(part_number, store_ids=None):
+        """
+        store stock of every size of every color of a product, at the given
+        stores (default: every tracked store), STOCK_BATCH_SIZE stores per
+        request; the stock api is keyed by part number, so all the colors
+        of a product tracked in one run share the same requests
+        """
+        if store_ids is None:
+            store_ids = stores.get_registry().store_ids()
+        store_ids = sorted(store_ids)
+        stocks = []
+        for start in range(0, len(store_ids), Item.STOCK_BATCH_SIZE):
+            with metrics.phase('stock_fetch'):
+                stocks += fetch.client.get_parsed(
+                    Item.STORE_AVAILABILITY_URL.format(
+                        year=arrow.now().year,
+                        part_number=part_number,
+                        store_ids=quote(','.join(map(
+                            str,
+                            store_ids[start:start + Item.STOCK_BATCH_SIZE]
+                        )))
+                    ),
+                    Item.parse_stocks
+                )
+        return stocks
+
+    @staticmethod
+    def get_size_availabilities(part_number, data, color_id=None,
+                                store_ids=None):
+        registry = stores.get_registry()
+        stocks = Item.get_store_stocks(part_number, store_ids)
         sizes = [
             color
             for color in data['product']['detail']['colors']
@@ -366,14 +612,14 @@ class Item:
                 'store_id': None,
                 'size': size['name'],
                 'size_id': size['id'],
-                'available': size['availability'] is 'in_stock',
+                'available': size['availability'] == 'in_stock',
                 'quantity': None
             }
             for size in sizes
         ] + [
             # physical store stock
             {
-                'location': STORE_IDS[store['physicalStoreId']],
+                'location': registry.address(store['physicalStoreId']),
                 'store_id': store['physicalStoreId'],
                 'size': size_ids_to_names[size['sizeId']],
                 'size_id': size['sizeId'],
@@ -382,6 +628,8 @@ class Item:
             }
             for store in stocks
             for size in store['sizeStocks']
+            # other colors' sizes come back in the same response
+            if size['sizeId'] in size_ids_to_names
         ]
 
     @staticmethod
@@ -396,11 +644,23 @@ class Item:
         return df.reindex(columns=Item.AVAILABILITY_COLUMNS)
 
     @staticmethod
-    def from_url(url, color=None):
+    def fetch(url, color=None, locations=None):
+        """
+        an item read from its page, and the (timestamp, price,
+        size_availabilities) to write as its state once it is saved,
+        without writing anything to disk; locations limits the stores
+        tracked for the item to the nearest ones of those locations (see
+        stores.StoreRegistry)
+        """
         now_human = arrow.now()
         now = now_human.timestamp
         soup, color, color_id = Item.get_soup(url, color)
         data_layer = Item.get_data_layer(soup)
+        price = Item.get_price(data_layer)
+        size_availabilities = Item.get_size_availabilities(
+            Item.get_part_number(soup), data_layer, color_id=color_id,
+            store_ids=stores.get_registry().store_ids(locations)
+        )
         item = Item(
             reference_id=Item.get_reference_id(soup),
             part_number=Item.get_part_number(soup),
@@ -414,66 +674,175 @@ class Item:
             composition=Item.get_composition(data_layer),
             care=Item.get_care(data_layer),
             category=Item.get_category(soup),
-            price_history=Item.price_to_DataFrame(
+            price_history=history.compact(Item.price_to_DataFrame(
                 timestamp=now,
                 human_timestamp=now_human,
-                price=Item.get_price(data_layer)
-            ),
-            availability=Item.availability_to_DataFrame(
+                price=price
+            ), 'price'),
+            availability=history.compact(Item.availability_to_DataFrame(
                 timestamp=now,
                 human_timestamp=now_human,
-                size_availabilities=Item.get_size_availabilities(
-                    soup, data_layer, color_id=color_id
-                )
-            ),
+                size_availabilities=size_availabilities
+            ), 'availability'),
             bought=False,
-            ignore=False
+            ignore=False,
+            locations=locations
+        )
+        return item, (now, price, size_availabilities)
+
+    def save(self, timestamp, price, size_availabilities):
+        """
+        write a newly fetched item, its state and its summary
+        """
+        self.to_disk()
+        self.write_state(timestamp, price, size_availabilities)
+        summary.get_store().record(
+            self.canonical_url, timestamp, price, size_availabilities
         )
-        item.to_disk()
+
+    @staticmethod
+    def from_url(url, color=None, locations=None):
+        item, state = Item.fetch(url, color, locations)
+        item.save(*state)
         return item
 
+    @staticmethod
+    def get_listing_urls(soup, url):
+        """
+        the item pages linked from a category listing page, in order, without
+        their query strings / fragments
+        """
+        item_urls = []
+        seen = set()
+        for link in soup.find_all('a', href=True):
+            item_url = urlparse(urljoin(url, link['href']))
+            if re.search(Item.ITEM_PATH_PATTERN, item_url.path) is None:
+                continue
+            item_url = item_url._replace(query='', fragment='').geturl()
+            if item_url not in seen:
+                seen.add(item_url)
+                item_urls.append(item_url)
+        return item_urls
+
+    @staticmethod
+    def listing_urls(url):
+        return Item.get_listing_urls(
+            fetch.client.get_parsed(url, Item.parse_page), url
+        )
+
     def update(self, in_memory_update=True, on_disk_update=True):
-        now_human = arrow.now()
-        now = now_human.timestamp
-        soup, color, color_id = self.get_soup(self.canonical_url, self.color)
-        data_layer = self.get_data_layer(soup)
-        price = self.get_price(data_layer)
-        size_availabilities = self.get_size_availabilities(
-            soup, data_layer, color_id=self.color_id
+        self.record(
+            *self.take_snapshot(),
+            in_memory_update=in_memory_update,
+            on_disk_update=on_disk_update
         )
-        new_price_history = self.price_to_DataFrame(
-            timestamp=now,
-            human_timestamp=now_human,
-            price=price
+
+    def take_snapshot(self, get_update_data=None):
+        """
+        (time, last state, price, size availabilities) of the item now,
+        fetched but not yet recorded; get_update_data(url) defaults to
+        Item.get_update_data
+        """
+        now_human = arrow.now()
+        update_data = (get_update_data or self.get_update_data)(
+            self.canonical_url
         )
-        new_availability = self.availability_to_DataFrame(
-            timestamp=now,
-            human_timestamp=now_human,
-            size_availabilities=size_availabilities
+        # the last update's price / availability, for recording changes
+        # only and for alerts
+        state = self.read_state()
+        price, size_availabilities = self.get_snapshot(update_data)
+        return now_human, state, price, size_availabilities
+
+    def get_snapshot(self, update_data):
+        """
+        the price and size availabilities of the item now, from the data
+        its page gave (see get_update_data) and the stock api
+        """
+        data_layer = update_data['data_layer']
+        size_availabilities = self.get_size_availabilities(
+            update_data['part_number'], data_layer, color_id=self.color_id,
+            store_ids=stores.get_registry().store_ids(
+                getattr(self, 'locations', None)
+            )
         )
-        if in_memory_update is True:
-            self.price_history = pd.concat((
+        with metrics.phase('dataframe'):
+            price = self.get_price(data_layer)
+        return price, size_availabilities
+
+    def new_history(self, now_human, state, price, size_availabilities):
+        """
+        the (price, availability) rows a snapshot taken at now_human adds to
+        the item's history, given the state recorded by the last update
+        """
+        now = now_human.timestamp
+        with metrics.phase('dataframe'):
+            new_price_history = self.price_to_DataFrame(
+                timestamp=now,
+                human_timestamp=now_human,
+                price=price
+            )
+            new_size_availabilities = size_availabilities
+            if self.RECORDING == 'changes':
+                if state is not None and state['price'] == price:
+                    new_price_history = new_price_history.iloc[:0]
+                new_size_availabilities = self.availability_changes(
+                    state, size_availabilities
+                )
+            new_availability = self.availability_to_DataFrame(
+                timestamp=now,
+                human_timestamp=now_human,
+                size_availabilities=new_size_availabilities
+            )
+        return new_price_history, new_availability
+
+    def record(self, now_human, state, price, size_availabilities,
+               new_history=None, in_memory_update=True, on_disk_update=True,
+               summarise=True):
+        """
+        record a snapshot taken at now_human, given the state recorded by
+        the last update, and its new_history rows if they were already built
+        (e.g. on another thread); with summarise=False, the summary is left
+        for the caller to update (e.g. for many items at once)
+        """
+        now = now_human.timestamp
+        new_price_history, new_availability = new_history or \
+            self.new_history(now_human, state, price, size_availabilities)
+        # history that has not been read yet will include the new rows when
+        # it is, as long as they are written to disk
+        if in_memory_update is True and (
+                on_disk_update is False or
+                self.history_loaded('price_history')
+        ):
+            self.price_history = history.compact(pd.concat((
                 self.price_history,
                 new_price_history
-            ), axis=0)
-            self.availability = pd.concat((
+            ), axis=0), 'price')
+        if in_memory_update is True and (
+                on_disk_update is False or
+                self.history_loaded('availability')
+        ):
+            self.availability = history.compact(pd.concat((
                 self.availability,
                 new_availability
-            ), axis=0)
+            ), axis=0), 'availability')
         if on_disk_update is True:
-            new_price_history.reindex(
-                columns=self.PRICE_HISTORY_COLUMNS
-            ).to_csv(
-                self.filepath + '/' + self.price_filename(),
-                mode='a',
-                index=None,
-                header=None
-            )
-            new_availability.reindex(
-                columns=self.AVAILABILITY_COLUMNS
-            ).to_csv(
-                self.filepath + '/' + self.availability_filename(),
-                mode='a',
-                index=None,
-                header=None
-            )
+            with metrics.phase('history_append'):
+                history_backend = history.get_backend()
+                history_backend.append(self, 'price', new_price_history)
+                history_backend.append(
+                    self, 'availability', new_availability
+                )
+                self.write_state(now, price, size_availabilities)
+            if summarise is True:
+                with metrics.phase('summary_write'):
+                    summary.get_store().record(
+                        self.canonical_url, now, price, size_availabilities
+                    )
+            alerter = alerts.get_alerter()
+            if alerter is not None:
+                with metrics.phase('alerts'):
+                    alerter.check(
+                        self,
+                        state,
+                        self.state(now, price, size_availabilities)
+                    )
@@ -0,0 +1,45 @@
+import importlib
+import importlib.util
+import threading
+
+
+class LazyModule:
+    """
+    Stands in for a module that is only imported the first time one of its
+    attributes is used, so that commands that never use it do not pay for
+    importing it, e.g.
+
+        pd = LazyModule('pandas')
+        pd.DataFrame(...)  # pandas is imported here
+
+    Once imported, the module's attributes are copied over, so using them
+    costs no more than using the module itself.
+    """
+
+    def __init__(self, name):
+        self.__dict__['_lazy_name'] = name
+        self.__dict__['_lazy_module'] = None
+        self.__dict__['_lazy_lock'] = threading.Lock()
+
+    def __getattr__(self, attribute):
+        # only called for attributes that have not been copied over, i.e.
+        # before the module is imported, or ones it does not have
+        module = self._lazy_module
+        if module is None:
+            with self._lazy_lock:
+                if self._lazy_module is None:
+                    module = importlib.import_module(self._lazy_name)
+                    self.__dict__.update(module.__dict__)
+                    self.__dict__['_lazy_module'] = module
+                module = self._lazy_module
+        return getattr(module, attribute)
+
+    def __repr__(self):
+        return '<lazy module {name}>'.format(name=self._lazy_name)
+
+
+def installed(name):
+    """
+    whether a top-level module can be imported, without importing it
+    """
+    return importlib.util.find_spec(name) is not None
@@ -0,0 +1,256 @@
+from contextlib import contextmanager
+import os
+import threading
+import time
+
+# in the order they happen during an update
+PHASES = [
+    'page_fetch', 'parse', 'extract', 'stock_fetch', 'dataframe',
+    'history_append', 'summary_write', 'alerts', 'catalog_write',
+]
+
+
+class Metrics:
+    """
+    Timings and counters for an update run.
+
+    Time spent in each phase of an update is recorded against the item
+    being updated by the current thread (see `start_item`), or against the
+    item given explicitly, and added to per-phase totals either way, so
+    that one can see which phase dominates and which items are slow.
+    Counters are keyed by name and labels, e.g.
+    `count('http_responses', status=200)`.
+
+    Attributes:
+        started (float): when the run started, seconds since the epoch
+        items (dict(canonical_url: dict)): per item phase seconds, attempts
+            and error, for items started during this run
+        phase_seconds (dict(phase: float)): totals over every item
+        phase_max_seconds (dict(phase: float)): slowest single phase
+        counters (dict((name, ((label, value),)): number))
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.new_run()
+
+    def new_run(self):
+        with self.lock:
+            self.started = time.time()
+            self.items = {}
+            self.phase_seconds = {}
+            self.phase_max_seconds = {}
+            self.counters = {}
+
+    def start_item(self, canonical_url):
+        """
+        attribute phases timed from this thread to canonical_url
+        """
+        with self.lock:
+            self.items.setdefault(canonical_url, {
+                'canonical_url': canonical_url,
+                'phases': {},
+                'attempts': 0,
+                'error': None,
+            })
+        self.local.canonical_url = canonical_url
+
+    def finish_item(self, error=None):
+        canonical_url = getattr(self.local, 'canonical_url', None)
+        self.local.canonical_url = None
+        if canonical_url is None:
+            return
+        with self.lock:
+            self.items[canonical_url]['error'] = error
+
+    def attempt(self):
+        canonical_url = getattr(self.local, 'canonical_url', None)
+        if canonical_url is None:
+            return
+        with self.lock:
+            self.items[canonical_url]['attempts'] += 1
+            retry = self.items[canonical_url]['attempts'] > 1
+        if retry:
+            self.count('retries')
+
+    def add_time(self, phase, seconds, canonical_url=None):
+        canonical_url = canonical_url or \
+            getattr(self.local, 'canonical_url', None)
+        with self.lock:
+            self.phase_seconds[phase] = \
+                self.phase_seconds.get(phase, 0.0) + seconds
+            self.phase_max_seconds[phase] = max(
+                self.phase_max_seconds.get(phase, 0.0), seconds
+            )
+            if canonical_url in self.items:
+                phases = self.items[canonical_url]['phases']
+                phases[phase] = phases.get(phase, 0.0) + seconds
+
+    @contextmanager
+    def phase(self, phase, canonical_url=None):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(
+                phase, time.perf_counter() - start, canonical_url
+            )
+
+    def count(self, name, value=1, **labels):
+        key = (name, tuple(sorted(
+            (label, str(label_value))
+            for label, label_value in labels.items()
+        )))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def counter(self, name, **labels):
+        """
+        the total of a counter over every label not given
+        """
+        with self.lock:
+            return sum(
+                value
+                for (counter_name, counter_labels), value
+                in self.counters.items()
+                if counter_name == name and
+                set((label, str(label_value))
+                    for label, label_value in labels.items()) <=
+                set(counter_labels)
+            )
+
+    def item_record(self, canonical_url):
+        with self.lock:
+            record = dict(self.items.get(canonical_url) or {
+                'canonical_url': canonical_url,
+                'phases': {},
+                'attempts': 0,
+                'error': None,
+            })
+            record['phases'] = dict(record['phases'])
+        return record
+
+    def summary(self):
+        with self.lock:
+            return {
+                'started': self.started,
+                'seconds': time.time() - self.started,
+                'items': len(self.items),
+                'failed': sum(
+                    item['error'] is not None
+                    for item in self.items.values()
+                ),
+                'phase_seconds': dict(self.phase_seconds),
+                'phase_max_seconds': dict(self.phase_max_seconds),
+                'counters': [
+                    dict(labels, name=name, value=value)
+                    for (name, labels), value in sorted(self.counters.items())
+                ],
+            }
+
+    def phase_table(self):
+        """
+        lines of total and slowest time per phase, for printing
+        """
+        summary = self.summary()
+        total = sum(summary['phase_seconds'].values())
+        lines = ['{:<16} {:>12} {:>8} {:>12}'.format(
+            'phase', 'seconds', 'share', 'max (ms)'
+        )]
+        for phase in PHASES + sorted(
+                set(summary['phase_seconds']) - set(PHASES)
+        ):
+            if phase not in summary['phase_seconds']:
+                continue
+            lines.append('{:<16} {:>12.3f} {:>8.1%} {:>12.1f}'.format(
+                phase,
+                summary['phase_seconds'][phase],
+                summary['phase_seconds'][phase] / total if total > 0 else 0,
+                summary['phase_max_seconds'][phase] * 1000
+            ))
+        return lines
+
+    def write_prometheus(self, filename, prefix='zared_update', labels=None):
+        """
+        the run's summary in the Prometheus text format, for node_exporter's
+        textfile collector, with `labels` ({label: value}) on every sample;
+        written then renamed, so that it is never scraped half written
+        """
+        summary = self.summary()
+        lines = []
+        extra_labels = tuple(sorted((labels or {}).items()))
+
+        def metric(name, help_text, samples):
+            name = prefix + '_' + name
+            lines.append('# HELP {name} {help_text}'.format(
+                name=name, help_text=help_text
+            ))
+            lines.append('# TYPE {name} gauge'.format(name=name))
+            for labels, value in samples:
+                labels = extra_labels + tuple(labels)
+                lines.append('{name}{labels} {value}'.format(
+                    name=name,
+                    labels='{' + ','.join(
+                        '{label}="{value}"'.format(label=label, value=value)
+                        for label, value in labels
+                    ) + '}' if len(labels) > 0 else '',
+                    value=value
+                ))
+
+        metric(
+            'last_run_timestamp_seconds', 'When the last update run started.',
+            [((), '{:.0f}'.format(summary['started']))]
+        )
+        metric(
+            'duration_seconds', 'How long the last update run took.',
+            [((), '{:.3f}'.format(summary['seconds']))]
+        )
+        metric('items', 'Items attempted by the last update run.', [
+            ((('result', 'updated'),), summary['items'] - summary['failed']),
+            ((('result', 'failed'),), summary['failed']),
+        ])
+        metric(
+            'phase_seconds',
+            'Time spent in each phase by the last update run, over every '
+            'item.',
+            [
+                ((('phase', phase),), '{:.6f}'.format(seconds))
+                for phase, seconds in sorted(summary['phase_seconds'].items())
+            ]
+        )
+        metric(
+            'phase_max_seconds',
+            'Slowest single instance of each phase in the last update run.',
+            [
+                ((('phase', phase),), '{:.6f}'.format(seconds))
+                for phase, seconds in sorted(
+                    summary['phase_max_seconds'].items()
+                )
+            ]
+        )
+        with self.lock:
+            counters = sorted(self.counters.items())
+        for name in sorted({name for (name, _), _ in counters}):
+            metric(name, 'Total over the last update run.', [
+                (labels, value)
+                for (counter_name, labels), value in counters
+                if counter_name == name
+            ])
+        directory = os.path.dirname(filename)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(filename + '.tmp', 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(filename + '.tmp', filename)
+
+
+collector = Metrics()
+
+
+def phase(phase, canonical_url=None):
+    return collector.phase(phase, canonical_url)
+
+
+def count(name, value=1, **labels):
+    collector.count(name, value, **labels)
@@ -0,0 +1,261 @@
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import os
+import queue
+import threading
+import time
+
+import fetch
+from item import Item
+from lazy import LazyModule
+import metrics
+import summary
+
+arrow = LazyModule('arrow')
+
+# sent down the write queue once every fetcher has finished
+DONE = object()
+
+
+def parse_update_data(html):
+    """
+    Item.parse_update_data, in a parser process: returns what it extracted
+    and the seconds spent in each phase, for the caller to add to its own
+    metrics
+    """
+    metrics.collector.new_run()
+    extracted = Item.parse_update_data(html)
+    return extracted, metrics.collector.summary()['phase_seconds']
+
+
+class UpdatePipeline:
+    """
+    An update run as three stages joined by bounded queues, each sized on
+    its own:
+
+    - `fetchers` threads fetch item pages and stock, which mostly waits on
+      the network;
+    - the data layer of pages that changed is scanned out of them by the
+      fetcher, which is quick; only pages the scan cannot read are parsed
+      in full, by a pool of `parsers` processes (started the first time a
+      page needs it), so that parsing is not held to one core by the GIL
+      however many fetches are in flight. Each fetcher waits for its own
+      page, so at most `fetchers` pages are ever queued for parsing;
+    - one writer thread records the snapshots, `batch_size` at a time:
+      history appends and states item by item, then the summaries and the
+      catalog in one transaction each, and the checkpoint and run log.
+
+    Snapshots wait for the writer in a queue of at most `queue_size`, and
+    fetchers block when it is full, so memory stays bounded when writing
+    falls behind.
+
+    Attributes:
+        zared (Zared)
+        fetchers (int)
+        parsers (int): 0 to parse in the fetcher threads too
+        batch_size (int)
+        queue_size (int)
+    """
+
+    FETCHERS = 8
+    BATCH_SIZE = 50
+
+    def __init__(self, zared, fetchers=FETCHERS, parsers=None,
+                 batch_size=BATCH_SIZE, queue_size=None):
+        self.zared = zared
+        self.fetchers = fetchers
+        self.parsers = parsers if parsers is not None else os.cpu_count()
+        self.batch_size = batch_size
+        self.queue_size = queue_size or 2 * batch_size
+        self.executor = None
+        self.executor_lock = threading.Lock()
+
+    def parser_pool(self):
+        with self.executor_lock:
+            if self.executor is None:
+                # started from a fetcher thread, while other threads may
+                # hold locks (imports, sqlite, the http pool) that a plain
+                # fork would copy held; a fork server forks parsers from a
+                # clean process instead (which, as with spawn, re-imports
+                # the main script, so scripts running a pipeline need an
+                # `if __name__ == '__main__'` guard)
+                self.executor = ProcessPoolExecutor(
+                    max_workers=self.parsers,
+                    mp_context=multiprocessing.get_context('forkserver')
+                )
+            return self.executor
+
+    def extract(self, response):
+        """
+        what Item.extract_update_data gives for a page, parsing it in a
+        parser process if scanning it is not enough
+        """
+        extracted = Item.scan_update_data(response.text)
+        if extracted is not None:
+            return extracted
+        if self.parsers == 0:
+            return Item.parse_update_data(response.text)
+        extracted, phase_seconds = self.parser_pool().submit(
+            parse_update_data, response.text
+        ).result()
+        for phase, seconds in phase_seconds.items():
+            metrics.collector.add_time(phase, seconds)
+        return extracted
+
+    def get_update_data(self, url):
+        return fetch.client.get_extracted(url, self.extract)
+
+    def fetch_snapshot(self, zared_row):
+        """
+        (item, time, last state, price, size availabilities, new history
+        rows) of one catalog row, without writing anything
+        """
+        item = self.zared.load_item(zared_row)
+        now_human, state, price, size_availabilities = self.zared.retried(
+            lambda: item.take_snapshot(self.get_update_data)
+        )
+        new_history = item.new_history(
+            now_human, state, price, size_availabilities
+        )
+        return item, now_human, state, price, size_availabilities, \
+            new_history
+
+    def run_fetcher(self, rows, rows_lock, deadline, owns, snapshots):
+        while not self.stopping.is_set():
+            with rows_lock:
+                if deadline is not None and time.monotonic() > deadline:
+                    return
+                try:
+                    _, zared_row = next(rows)
+                except StopIteration:
+                    return
+                if owns is not None and not owns(zared_row.name):
+                    self.skipped += 1
+                    continue
+            snapshot, error = self.zared.try_update_item(
+                zared_row, self.fetch_snapshot
+            )
+            # blocks while the writer is behind
+            snapshots.put((zared_row.name, snapshot, error))
+
+    def write_batch(self, batch, checkpoint, run_log):
+        results = {}
+        recorded = []
+        for canonical_url, snapshot, error in batch:
+            if error is not None:
+                results[canonical_url] = (None, error)
+                continue
+            item, now_human, state, price, size_availabilities, \
+                new_history = snapshot
+            metrics.collector.start_item(canonical_url)
+            try:
+                item.record(
+                    now_human, state, price, size_availabilities,
+                    new_history=new_history,
+                    in_memory_update=False,
+                    summarise=False
+                )
+                metrics.collector.finish_item()
+            except Exception as e:
+                error = '{type}: {error}'.format(
+                    type=type(e).__name__, error=e
+                )
+                metrics.collector.finish_item(error)
+                results[canonical_url] = (None, error)
+                continue
+            recorded.append((
+                canonical_url, now_human.timestamp, price,
+                size_availabilities
+            ))
+            results[canonical_url] = (arrow.now().timestamp, None)
+        if len(recorded) > 0:
+            try:
+                with metrics.phase('summary_write'):
+                    summary.get_store().record_many(recorded)
+                self.zared.record_updates({
+                    canonical_url: results[canonical_url][0]
+                    for canonical_url, _, _, _ in recorded
+                })
+            except Exception as e:
+                # their history is written, but left for the next run to
+                # update again, as when a single update fails at this point
+                error = '{type}: {error}'.format(
+                    type=type(e).__name__, error=e
+                )
+                for canonical_url, _, _, _ in recorded:
+                    results[canonical_url] = (None, error)
+                    metrics.collector.start_item(canonical_url)
+                    metrics.collector.finish_item(error)
+        for canonical_url, result in results.items():
+            self.zared.record_result(
+                checkpoint, canonical_url, result, run_log, record=False
+            )
+            self.attempted += 1
+            self.failed += result[1] is not None
+
+    def run_writer(self, snapshots, checkpoint, run_log):
+        finished = False
+        try:
+            while not finished:
+                batch = [snapshots.get()]
+                # whatever else is already waiting, up to a full batch
+                while len(batch) < self.batch_size:
+                    try:
+                        batch.append(snapshots.get_nowait())
+                    except queue.Empty:
+                        break
+                if batch[-1] is DONE:
+                    batch.pop()
+                    finished = True
+                self.write_batch(batch, checkpoint, run_log)
+        except BaseException as e:
+            self.writer_error = e
+            self.stopping.set()
+            # so that no fetcher is left blocked on a full queue
+            while not finished:
+                finished = snapshots.get() is DONE
+
+    def run(self, to_update, checkpoint, run_log, deadline=None, owns=None):
+        """
+        update the rows of to_update in order, as Zared.update_all does;
+        returns how many were attempted, failed and skipped (not owned)
+        """
+        self.attempted = 0
+        self.failed = 0
+        self.skipped = 0
+        self.writer_error = None
+        self.stopping = threading.Event()
+        rows = to_update.iterrows()
+        rows_lock = threading.Lock()
+        snapshots = queue.Queue(maxsize=self.queue_size)
+        writer = threading.Thread(
+            target=self.run_writer, args=(snapshots, checkpoint, run_log)
+        )
+        fetchers = [
+            threading.Thread(
+                target=self.run_fetcher,
+                args=(rows, rows_lock, deadline, owns, snapshots)
+            )
+            for _ in range(self.fetchers)
+        ]
+        writer.start()
+        try:
+            for fetcher in fetchers:
+                fetcher.start()
+            for fetcher in fetchers:
+                fetcher.join()
+        finally:
+            # interrupted: fetchers finish the item they are on, and what
+            # they fetched is still written
+            self.stopping.set()
+            for fetcher in fetchers:
+                if fetcher.is_alive():
+                    fetcher.join()
+            snapshots.put(DONE)
+            writer.join()
+            if self.executor is not None:
+                self.executor.shutdown()
+                self.executor = None
+        if self.writer_error is not None:
+            raise self.writer_error
+        return self.attempted, self.failed, self.skipped
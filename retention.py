@@ -0,0 +1,275 @@
+import json
+import os
+
+import history
+from lazy import LazyModule
+
+arrow = LazyModule('arrow')
+pd = LazyModule('pandas')
+
+# how long history is kept at each resolution, e.g.
+# {"raw_days": 30, "daily_days": 365, "expired": "archive"}
+FILENAME = 'retention.json'
+# where expired daily rows are moved, under each item's path
+ARCHIVE_PATH = 'archive/'
+DAY = 24 * 60 * 60
+# availability is rolled up per location / store / size, as in
+# Item.AVAILABILITY_KEY
+KEYS = {
+    'price': [],
+    'availability': ['location', 'store_id', 'size_id'],
+}
+ROLLUP_TYPES = {
+    'price': {
+        'day': 'int64',
+        'snapshots': 'int64',
+        'min_price': 'float64',
+        'max_price': 'float64',
+        'last_price': 'float64',
+    },
+    'availability': {
+        'day': 'int64',
+        'location': 'object',
+        'store_id': 'Int64',
+        'size': 'object',
+        'size_id': 'Int64',
+        'snapshots': 'int64',
+        'seconds': 'int64',
+        'in_stock_fraction': 'float64',
+    },
+}
+
+
+class RetentionPolicy:
+    """
+    How long item history is kept at each resolution: every snapshot for
+    raw_days, then one row per day (and location / store / size, for
+    availability) for daily_days, after which the daily rows are moved
+    under ARCHIVE_PATH ('archive') or dropped ('delete'). A tier of None
+    days is kept forever.
+
+    Attributes:
+        raw_days (int or None)
+        daily_days (int or None): counted from now, like raw_days
+        expired (str): 'archive' or 'delete'
+    """
+
+    def __init__(self, raw_days=30, daily_days=365, expired='archive'):
+        if expired not in ('archive', 'delete'):
+            raise ValueError(
+                'Unknown retention for expired history: {expired}'.format(
+                    expired=expired
+                )
+            )
+        if raw_days is None and daily_days is not None:
+            raise ValueError('Raw history kept forever has no daily tier')
+        if raw_days is not None and daily_days is not None and \
+                daily_days < raw_days:
+            raise ValueError('daily_days must be at least raw_days')
+        self.raw_days = raw_days
+        self.daily_days = daily_days
+        self.expired = expired
+
+    @staticmethod
+    def from_file(filename=FILENAME):
+        """
+        the policy in filename, or the default one if there is no such file
+        """
+        if not os.path.exists(filename):
+            return RetentionPolicy()
+        with open(filename, 'r') as f:
+            return RetentionPolicy(**json.load(f))
+
+
+def day_start(timestamp):
+    return int(timestamp) - int(timestamp) % DAY
+
+
+def human_days(days):
+    return days.map({
+        day: arrow.get(int(day)).format('YYYY-MM-DD')
+        for day in pd.unique(days)
+    })
+
+
+def daily_pieces(df, key, since, before):
+    """
+    each row's value holds from its timestamp until the next row of the
+    same key, or before; these spans, from since on and split at (UTC) day
+    boundaries, as rows with an added day and seconds
+    """
+    df = df.sort_values('timestamp', kind='mergesort')
+    following = df.groupby(
+        key, dropna=False, observed=True
+    )['timestamp'].shift(-1) if len(key) > 0 else df['timestamp'].shift(-1)
+    df = df.assign(
+        start=df['timestamp'].clip(lower=since),
+        end=following.fillna(before).clip(upper=before).astype('int64')
+    )
+    df = df[df['end'] > df['start']]
+    df = df.assign(day=[
+        list(range(day_start(start), end, DAY))
+        for start, end in zip(df['start'], df['end'])
+    ]).explode('day')
+    df['day'] = df['day'].astype('int64')
+    return df.assign(seconds=(
+        df['end'].clip(upper=df['day'] + DAY) -
+        df['start'].clip(lower=df['day'])
+    ))
+
+
+def rollup(kind, df, since, before):
+    """
+    daily rows (see ROLLUP_TYPES) of an item's history between since and
+    before, both day boundaries: price min / max / last for price, and the
+    fraction of the time each size was in stock at each location for
+    availability
+    """
+    key = KEYS[kind]
+    pieces = daily_pieces(df, key, since, before)
+    recorded = df[df['timestamp'] >= since]
+    snapshots = recorded.assign(
+        day=recorded['timestamp'] - recorded['timestamp'] % DAY
+    ).groupby(
+        ['day'] + key, dropna=False, observed=True
+    ).size().rename('snapshots')
+    if kind == 'price':
+        daily = pieces.groupby('day').agg(
+            min_price=('price', 'min'),
+            max_price=('price', 'max'),
+            last_price=('price', 'last')
+        )
+    else:
+        # sizes / stores no longer listed count as neither in nor out of
+        # stock
+        pieces = pieces[pieces['available'].notnull()]
+        daily = pieces.assign(
+            in_stock_seconds=pieces['seconds'].where(
+                pieces['available'].astype(bool), 0
+            )
+        ).groupby(
+            ['day'] + key + ['size'], dropna=False, observed=True
+        ).agg(
+            seconds=('seconds', 'sum'),
+            in_stock_seconds=('in_stock_seconds', 'sum')
+        ).reset_index('size')
+        daily['in_stock_fraction'] = \
+            daily['in_stock_seconds'] / daily['seconds']
+    daily = daily.join(snapshots).fillna({'snapshots': 0}).reset_index()
+    for column, column_type in ROLLUP_TYPES[kind].items():
+        if column_type == 'Int64':
+            # categories of ids to their values, then to nullable integers
+            daily[column] = pd.to_numeric(
+                daily[column].astype(object)
+            ).astype('Int64')
+        else:
+            daily[column] = daily[column].astype(column_type)
+    return daily.reindex(columns=list(ROLLUP_TYPES[kind]))
+
+
+def rollup_filename(filepath, filename, kind):
+    return filepath + '/daily_' + kind + '_' + filename + '.csv'
+
+
+def read_rollup(filepath, filename, kind):
+    """
+    an item's daily rows, with a human_day column
+    """
+    try:
+        df = pd.read_csv(rollup_filename(filepath, filename, kind))
+    except FileNotFoundError:
+        df = pd.DataFrame(columns=['human_day'] + list(ROLLUP_TYPES[kind]))
+    return df.reindex(
+        columns=['human_day'] + list(ROLLUP_TYPES[kind])
+    ).astype(ROLLUP_TYPES[kind])
+
+
+def write_rollup(filepath, filename, kind, daily, expire_before=None,
+                 expired='archive'):
+    """
+    add daily rows to an item's, replacing any of the same day and key, and
+    archive or drop those of days before expire_before
+    """
+    key = ['day'] + KEYS[kind]
+    daily = pd.concat(
+        [read_rollup(filepath, filename, kind), daily], axis=0
+    ).reindex(columns=list(ROLLUP_TYPES[kind]))\
+     .drop_duplicates(subset=key, keep='last')\
+     .sort_values(key, kind='mergesort')\
+     .reset_index(drop=True)
+    daily.insert(1, 'human_day', human_days(daily['day']))
+    if expire_before is not None:
+        old = daily['day'] < expire_before
+        if expired == 'archive' and old.any():
+            archive_filename = ARCHIVE_PATH + \
+                rollup_filename(filepath, filename, kind)
+            os.makedirs(os.path.dirname(archive_filename), exist_ok=True)
+            daily[old].to_csv(
+                archive_filename,
+                mode='a',
+                index=False,
+                header=not os.path.exists(archive_filename)
+            )
+        daily = daily[~old]
+    target = rollup_filename(filepath, filename, kind)
+    daily.to_csv(target + '.tmp', index=False)
+    os.replace(target + '.tmp', target)
+
+
+def apply(policy, items, now=None, verbose=False):
+    """
+    roll up and remove the history of every item given that is older than
+    the policy keeps at full resolution, and expire old daily rows.
+
+    For each item, in an order that can be interrupted and run again:
+    its daily rows are written, then its json records when it was first
+    recorded (so that Zared.stock_take still sees when it was added) and
+    up to when it has been rolled up, and then, for every item at once, the
+    raw rows are removed, except the latest one per price / location /
+    store / size, so that Item.price_as_of and Item.availability_as_of
+    still see what held at the start of the raw tier. Updates can run at
+    the same time: they only append rows newer than those removed.
+
+    returns the number of items rolled up
+    """
+    if policy.raw_days is None:
+        return 0
+    now = int(now if now is not None else arrow.now().timestamp)
+    before = day_start(now - policy.raw_days * DAY)
+    expire_before = day_start(now - policy.daily_days * DAY) \
+        if policy.daily_days is not None else None
+    backend = history.get_backend()
+    rolled_up = []
+    for item in items:
+        since = item.__dict__.get('rolled_up_until')
+        if since is not None and since >= before:
+            # rolled up by a run that stopped before removing anything
+            rolled_up.append((item.filepath, item.filename))
+            continue
+        first, _ = item.timestamp_range()
+        if first is None or pd.isnull(first):
+            continue
+        for kind in history.KINDS:
+            frames = list(backend.stream(
+                kind, [(item.filepath, item.filename)], end=before - 1
+            ))
+            if len(frames) == 0:
+                continue
+            old = history.compact(pd.concat(frames, axis=0), kind)
+            write_rollup(
+                item.filepath,
+                item.filename,
+                kind,
+                rollup(kind, old, since or 0, before),
+                expire_before,
+                policy.expired
+            )
+        item.first_recorded = int(first)
+        item.rolled_up_until = before
+        item.write_json()
+        rolled_up.append((item.filepath, item.filename))
+        if verbose is True:
+            print('Rolled up {filename}'.format(filename=item.filename))
+    for kind in history.KINDS:
+        backend.remove_before(kind, rolled_up, before, KEYS[kind])
+    return len(rolled_up)
@@ -0,0 +1,225 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import heapq
+from random import random, uniform
+import time
+import traceback
+
+import fetch
+import history
+from item import Item
+from lazy import LazyModule
+
+arrow = LazyModule('arrow')
+pd = LazyModule('pandas')
+
+
+class Scheduler:
+    """
+    Keeps zared running and polls each item on its own schedule instead of
+    polling everything every hour.
+
+    An item's interval is the time it has recently taken, on average, for
+    its price or availability to change: roughly one poll per change,
+    between MIN_INTERVAL and MAX_INTERVAL. Ignored and bought items are
+    polled every IGNORED_INTERVAL. Every interval is jittered by up to
+    JITTER either way, so polls spread out rather than bunching up.
+
+    Attributes:
+        zared (Zared)
+        workers (int): items polled at once
+        queue ([(due, canonical_url)]): heap of upcoming polls
+        changes (dict(canonical_url: deque(timestamp))): when each item was
+            seen to change, within the last LOOKBACK seconds
+    """
+
+    MIN_INTERVAL = 15 * 60
+    MAX_INTERVAL = 6 * 60 * 60
+    IGNORED_INTERVAL = 24 * 60 * 60
+    LOOKBACK = 7 * 24 * 60 * 60
+    JITTER = 0.1
+    # how often to pick up items added since the daemon started
+    CATALOG_REFRESH_INTERVAL = 10 * 60
+
+    def __init__(self, zared, workers=1):
+        self.zared = zared
+        self.workers = workers
+        self.queue = []
+        self.changes = {}
+
+    @staticmethod
+    def filepath(zared_row):
+        return Item.FILEPATH.format(
+            audience_segment=zared_row['audience_segment'],
+            type=zared_row['type']
+        )
+
+    @staticmethod
+    def item(zared_row):
+        return Item.from_disk(
+            Scheduler.filepath(zared_row), zared_row['filename'], lazy=True
+        )
+
+    @staticmethod
+    def recent_history(kind, filepath, filename, since):
+        """
+        an item's history since `since`, without reading what came before
+        """
+        frames = list(history.get_backend().stream(
+            kind, [(filepath, filename)], start=since
+        ))
+        return history.compact(
+            pd.concat(frames) if len(frames) > 0 else pd.DataFrame(), kind
+        )
+
+    @staticmethod
+    def history_changes(filepath, filename, since):
+        """
+        timestamps since `since` at which the item's price or any
+        size / location's availability changed, from its recorded history
+        (a change at the very start of the window, from a value recorded
+        before it, is not seen)
+        """
+        prices = Scheduler.recent_history(
+            'price', filepath, filename, since
+        ).sort_values('timestamp', kind='mergesort')
+        price_changes = prices['timestamp'][
+            prices['price'].ne(prices['price'].shift()) &
+            prices['price'].shift().notnull()
+        ]
+        availability = Scheduler.recent_history(
+            'availability', filepath, filename, since
+        ).sort_values(
+            Item.AVAILABILITY_KEY + ['timestamp'], kind='mergesort'
+        )
+        previous = availability.groupby(
+            Item.AVAILABILITY_KEY, dropna=False, observed=True
+        )['available'].shift()
+        availability_changes = availability['timestamp'][
+            (availability['available'].ne(previous) & previous.notnull())
+            .fillna(False).astype(bool)
+        ]
+        changes = pd.concat([price_changes, availability_changes])
+        return sorted(set(
+            int(timestamp) for timestamp in changes if timestamp >= since
+        ))
+
+    @staticmethod
+    def state_changed(before, after):
+        if before is None or after is None:
+            return False
+        return before['price'] != after['price'] or {
+            key: size_availability['available']
+            for key, size_availability in before['availability'].items()
+        } != {
+            key: size_availability['available']
+            for key, size_availability in after['availability'].items()
+        }
+
+    def interval(self, canonical_url):
+        zared_row = self.zared.zared.loc[canonical_url]
+        if zared_row['ignore'] or zared_row['bought']:
+            return self.IGNORED_INTERVAL
+        changes = self.changes[canonical_url]
+        while len(changes) > 0 and \
+                changes[0] < arrow.now().timestamp - self.LOOKBACK:
+            changes.popleft()
+        if len(changes) == 0:
+            return self.MAX_INTERVAL
+        return min(
+            max(self.LOOKBACK / len(changes), self.MIN_INTERVAL),
+            self.MAX_INTERVAL
+        )
+
+    def schedule(self, canonical_url, after):
+        interval = self.interval(canonical_url)
+        heapq.heappush(self.queue, (
+            after + interval * uniform(1 - self.JITTER, 1 + self.JITTER),
+            canonical_url
+        ))
+
+    def add_items(self):
+        """
+        schedule every catalog item that is not scheduled yet, from when it
+        was last updated; overdue items are spread over the next
+        MIN_INTERVAL
+        """
+        now = arrow.now().timestamp
+        for canonical_url, zared_row in self.zared.zared.iterrows():
+            if canonical_url in self.changes:
+                continue
+            try:
+                self.changes[canonical_url] = deque(self.history_changes(
+                    self.filepath(zared_row), zared_row['filename'],
+                    now - self.LOOKBACK
+                ))
+            except Exception:
+                traceback.print_exc()
+                self.changes[canonical_url] = deque()
+            self.schedule(canonical_url, zared_row['last_updated'])
+        self.queue = [
+            (
+                due if due > now
+                else now + random() * self.MIN_INTERVAL,
+                canonical_url
+            )
+            for due, canonical_url in self.queue
+        ]
+        heapq.heapify(self.queue)
+
+    def poll(self, canonical_url):
+        """
+        update one item, returning when it was updated and whether anything
+        changed
+        """
+        item = self.item(self.zared.zared.loc[canonical_url])
+        before = item.read_state()
+        item.update(in_memory_update=False)
+        return arrow.now().timestamp, self.state_changed(
+            before, item.read_state()
+        )
+
+    def run_due(self, executor):
+        now = arrow.now().timestamp
+        due_urls = []
+        while len(self.queue) > 0 and self.queue[0][0] <= now:
+            canonical_url = heapq.heappop(self.queue)[1]
+            if canonical_url in self.zared.zared.index:
+                due_urls.append(canonical_url)
+            else:
+                # no longer in the catalog
+                self.changes.pop(canonical_url, None)
+        fetch.client.new_run()
+        futures = {
+            canonical_url: executor.submit(self.poll, canonical_url)
+            for canonical_url in due_urls
+        }
+        for canonical_url, future in futures.items():
+            try:
+                timestamp, changed = future.result()
+            except Exception:
+                traceback.print_exc()
+                self.schedule(canonical_url, arrow.now().timestamp)
+                continue
+            if changed:
+                self.changes[canonical_url].append(timestamp)
+            self.zared.record_update(canonical_url, timestamp)
+            self.schedule(canonical_url, timestamp)
+
+    def run(self):
+        catalog_refreshed = 0
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while True:
+                if time.monotonic() - catalog_refreshed > \
+                        self.CATALOG_REFRESH_INTERVAL:
+                    self.zared.zared = self.zared.catalog.to_DataFrame()
+                    self.add_items()
+                    catalog_refreshed = time.monotonic()
+                if len(self.queue) == 0:
+                    time.sleep(self.CATALOG_REFRESH_INTERVAL)
+                    continue
+                wait = self.queue[0][0] - arrow.now().timestamp
+                if wait > 0:
+                    time.sleep(min(wait, self.CATALOG_REFRESH_INTERVAL))
+                    continue
+                self.run_due(executor)
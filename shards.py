@@ -0,0 +1,270 @@
+import bisect
+import hashlib
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+
+def hash_key(key):
+    return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:16], 16)
+
+
+class HashRing:
+    """
+    Consistent hashing of keys onto nodes: each node is placed at `replicas`
+    points on a ring, and a key belongs to the first node point after its
+    own, so that adding or removing a node only moves the keys of the part
+    of the ring it takes or leaves.
+    """
+
+    def __init__(self, nodes, replicas=100):
+        points = sorted(
+            (hash_key('{node}#{replica}'.format(node=node, replica=replica)),
+             node)
+            for node in nodes
+            for replica in range(replicas)
+        )
+        self.hashes = [point for point, _ in points]
+        self.nodes = [node for _, node in points]
+
+    def node(self, key):
+        if len(self.nodes) == 0:
+            return None
+        index = bisect.bisect(self.hashes, hash_key(key)) % len(self.hashes)
+        return self.nodes[index]
+
+
+class ShardCoordinator:
+    """
+    Splits the catalog between update workers, in one or more processes on
+    one or more hosts sharing the catalog's directory.
+
+    Each item belongs to one of `shards` shards, by a hash of its canonical
+    url. Shards are spread over the live workers by consistent hashing, and
+    a worker only updates the items of the shards it holds a lease on, so
+    no two workers fetch the same item. Leases are kept in a small sqlite
+    database (in rollback journal mode, which, unlike WAL, works between
+    hosts on a shared filesystem with working locks) and renewed every
+    lease_seconds / 3 by a heartbeat thread, which also hands over shards
+    the ring now gives to other workers and takes those it gives to this
+    one. A worker that dies stops renewing its leases, and once they expire
+    its shards are taken over by the others. Hosts' clocks are assumed to
+    be in sync (e.g. by NTP).
+
+    Unless given one, a worker takes the first id of host, host-2, host-3...
+    that no live worker holds, counting as dead the workers registered from
+    this host whose process is gone, so that a worker restarted in place of
+    one that stopped or crashed gets the same id (and with it the same
+    checkpoint and metrics file; see Zared.run_sharded).
+
+    Attributes:
+        worker (str): this worker's id; None until started, if not given
+        shards (int)
+        lease_seconds (float)
+        held (set(int)): the shards this worker holds a lease on
+        held_until (float): when those leases expire, less a margin
+    """
+
+    FILENAME = 'leases.db'
+    SHARDS = 64
+    LEASE_SECONDS = 60
+
+    def __init__(self, worker=None, filename=FILENAME, shards=SHARDS,
+                 lease_seconds=LEASE_SECONDS):
+        self.worker = worker
+        self.shards = shards
+        self.lease_seconds = lease_seconds
+        self.held = set()
+        self.held_until = 0
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.heartbeat = None
+        self.connection = sqlite3.connect(
+            filename, timeout=30, check_same_thread=False,
+            isolation_level=None
+        )
+        with self.lock:
+            self.connection.execute('PRAGMA journal_mode=DELETE')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS workers '
+                '(worker TEXT PRIMARY KEY, host TEXT, pid INTEGER, '
+                'expires REAL)'
+            )
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS shards '
+                '(shard INTEGER PRIMARY KEY, owner TEXT, expires REAL)'
+            )
+            self.connection.executemany(
+                'INSERT OR IGNORE INTO shards (shard, owner, expires) '
+                'VALUES (?, NULL, 0)',
+                [(shard,) for shard in range(shards)]
+            )
+
+    def shard(self, canonical_url):
+        return hash_key(canonical_url) % self.shards
+
+    def owns(self, canonical_url):
+        """
+        whether this worker may update an item now
+        """
+        return time.time() < self.held_until and \
+            self.shard(canonical_url) in self.held
+
+    def rebalance(self):
+        """
+        renew this worker's registration and leases, release the shards the
+        ring gives to other live workers, and take the free or expired
+        shards it gives to this one; returns the shards held
+        """
+        now = time.time()
+        expires = now + self.lease_seconds
+        with self.lock:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO workers (worker, host, pid, expires) '
+                'VALUES (?, ?, ?, ?)',
+                (self.worker, socket.gethostname(), os.getpid(), expires)
+            )
+            live = [
+                worker for worker, in self.connection.execute(
+                    'SELECT worker FROM workers WHERE expires > ?', (now,)
+                )
+            ]
+            ring = HashRing(live)
+            wanted = [
+                shard for shard in range(self.shards)
+                if ring.node(str(shard)) == self.worker
+            ]
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                self.connection.execute(
+                    'UPDATE shards SET owner = NULL, expires = 0 '
+                    'WHERE owner = ? AND shard NOT IN ({wanted})'.format(
+                        wanted=', '.join('?' for _ in wanted)
+                    ),
+                    [self.worker] + wanted
+                )
+                self.connection.executemany(
+                    'UPDATE shards SET owner = ?, expires = ? '
+                    'WHERE shard = ? AND '
+                    '(owner IS NULL OR owner = ? OR expires < ?)',
+                    [
+                        (self.worker, expires, shard, self.worker, now)
+                        for shard in wanted
+                    ]
+                )
+                held = {
+                    shard for shard, in self.connection.execute(
+                        'SELECT shard FROM shards WHERE owner = ?',
+                        (self.worker,)
+                    )
+                }
+                self.connection.execute('COMMIT')
+            except BaseException:
+                self.connection.execute('ROLLBACK')
+                raise
+        # stop starting updates a little before the leases run out, in case
+        # the next heartbeat is late
+        self.held = held
+        self.held_until = expires - self.lease_seconds / 3
+        return held
+
+    @staticmethod
+    def running(pid):
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            # someone else's
+            return True
+        return True
+
+    def claim_worker(self):
+        """
+        register as the first free id of host, host-2, host-3...
+        """
+        host = socket.gethostname()
+        now = time.time()
+        with self.lock:
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                taken = {
+                    worker
+                    for worker, worker_host, pid in self.connection.execute(
+                        'SELECT worker, host, pid FROM workers '
+                        'WHERE expires > ?',
+                        (now,)
+                    )
+                    if worker_host != host or self.running(pid)
+                }
+                number = 1
+                while True:
+                    worker = host if number == 1 else '{host}-{number}'.format(
+                        host=host, number=number
+                    )
+                    if worker not in taken:
+                        break
+                    number += 1
+                self.connection.execute(
+                    'INSERT OR REPLACE INTO workers '
+                    '(worker, host, pid, expires) VALUES (?, ?, ?, ?)',
+                    (worker, host, os.getpid(), now + self.lease_seconds)
+                )
+                self.connection.execute('COMMIT')
+            except BaseException:
+                self.connection.execute('ROLLBACK')
+                raise
+        self.worker = worker
+
+    def run_heartbeat(self):
+        while not self.stopping.wait(self.lease_seconds / 3):
+            try:
+                self.rebalance()
+            except sqlite3.Error:
+                # e.g. the database is busy; the leases are still good
+                # until held_until, and the next heartbeat will try again
+                continue
+
+    def start(self):
+        if self.worker is None:
+            self.claim_worker()
+        self.stopping.clear()
+        self.rebalance()
+        self.heartbeat = threading.Thread(
+            target=self.run_heartbeat, daemon=True
+        )
+        self.heartbeat.start()
+
+    def stop(self):
+        """
+        stop renewing, and hand every shard back straight away rather than
+        when the leases expire
+        """
+        self.stopping.set()
+        if self.heartbeat is not None:
+            self.heartbeat.join()
+        self.held = set()
+        self.held_until = 0
+        with self.lock:
+            self.connection.execute(
+                'UPDATE shards SET owner = NULL, expires = 0 '
+                'WHERE owner = ?',
+                (self.worker,)
+            )
+            self.connection.execute(
+                'DELETE FROM workers WHERE worker = ?', (self.worker,)
+            )
+
+    def status(self):
+        """
+        [(worker, shards held, lease expiry)] of every worker holding shards
+        """
+        with self.lock:
+            return self.connection.execute(
+                'SELECT owner, count(*), max(expires) FROM shards '
+                'WHERE owner IS NOT NULL AND expires > ? '
+                'GROUP BY owner ORDER BY owner',
+                (time.time(),)
+            ).fetchall()
@@ -0,0 +1,212 @@
+import glob
+import heapq
+import json
+from math import asin, cos, radians, sin, sqrt
+import os
+import threading
+
+# the original single store-locator dump, tracked as region 'default'
+FILENAME = 'stores.json'
+# one store-locator dump per region, e.g. stores/nyc.json, stores/paris.json
+PATH = 'stores/'
+# named points to track the nearest stores of, e.g.
+# {"home": {"latitude": 40.7, "longitude": -74.0, "stores": 5,
+#           "regions": ["nyc"]}}
+LOCATIONS_FILENAME = 'locations.json'
+EARTH_RADIUS_KM = 6371.0
+
+
+def to_xyz(latitude, longitude):
+    """
+    a point on the unit sphere; straight-line distances between these
+    order points the same way as great-circle distances do, without any
+    trouble at the poles or the antimeridian
+    """
+    latitude = radians(latitude)
+    longitude = radians(longitude)
+    return (
+        cos(latitude) * cos(longitude),
+        cos(latitude) * sin(longitude),
+        sin(latitude)
+    )
+
+
+def chord_to_km(chord):
+    return 2 * EARTH_RADIUS_KM * asin(min(chord / 2, 1.0))
+
+
+class KdTree:
+    """
+    A 3-d tree over points on the unit sphere, for nearest-N queries.
+
+    Nodes are (point, value, axis, left, right) tuples.
+    """
+
+    def __init__(self, points):
+        """
+        points: [((x, y, z), value)]
+        """
+        self.root = self.build(list(points), 0)
+
+    def build(self, points, depth):
+        if len(points) == 0:
+            return None
+        axis = depth % 3
+        points.sort(key=lambda point: point[0][axis])
+        middle = len(points) // 2
+        return (
+            points[middle][0],
+            points[middle][1],
+            axis,
+            self.build(points[:middle], depth + 1),
+            self.build(points[middle + 1:], depth + 1)
+        )
+
+    def nearest(self, point, count):
+        """
+        [(distance, value)] of the count nearest points, nearest first
+        """
+        # max-heap of the best so far, as (-squared distance, tiebreak, value)
+        best = []
+
+        def visit(node):
+            if node is None:
+                return
+            node_point, value, axis, left, right = node
+            squared = sum((a - b) ** 2 for a, b in zip(point, node_point))
+            if len(best) < count:
+                heapq.heappush(best, (-squared, id(node), value))
+            elif squared < -best[0][0]:
+                heapq.heapreplace(best, (-squared, id(node), value))
+            difference = point[axis] - node_point[axis]
+            near, far = (left, right) if difference < 0 else (right, left)
+            visit(near)
+            if len(best) < count or difference ** 2 < -best[0][0]:
+                visit(far)
+
+        if count > 0:
+            visit(self.root)
+        return [
+            (sqrt(-negative_squared), value)
+            for negative_squared, _, value in sorted(best, reverse=True)
+        ]
+
+
+class StoreRegistry:
+    """
+    Every store from the store-locator dumps of one or more regions, with a
+    spatial index per region, and the named locations whose nearest stores
+    are tracked.
+
+    Attributes:
+        stores (dict(store id: store)): each store is a dict of id, address,
+            latitude, longitude and region
+        locations (dict(name: location)): each location is a dict of
+            latitude, longitude, stores (how many of the nearest to track)
+            and optionally regions (only track stores in those)
+        trees (dict(region: KdTree))
+    """
+
+    def __init__(self, stores, locations=None):
+        self.stores = {store['id']: store for store in stores}
+        self.locations = locations or {}
+        regions = {}
+        for store in self.stores.values():
+            if store['latitude'] is None or store['longitude'] is None:
+                continue
+            regions.setdefault(store['region'], []).append((
+                to_xyz(store['latitude'], store['longitude']), store['id']
+            ))
+        self.trees = {
+            region: KdTree(points) for region, points in regions.items()
+        }
+
+    @staticmethod
+    def read_dump(filename, region):
+        with open(filename, 'r') as f:
+            return [
+                {
+                    'id': store['id'],
+                    'address': ' '.join(store['addressLines']),
+                    'latitude': store.get('latitude'),
+                    'longitude': store.get('longitude'),
+                    'region': region,
+                }
+                for store in json.load(f)
+            ]
+
+    @staticmethod
+    def from_disk():
+        stores = []
+        if os.path.exists(FILENAME):
+            stores += StoreRegistry.read_dump(FILENAME, 'default')
+        for filename in sorted(glob.glob(PATH + '*.json')):
+            stores += StoreRegistry.read_dump(
+                filename, os.path.basename(filename)[:-len('.json')]
+            )
+        locations = {}
+        if os.path.exists(LOCATIONS_FILENAME):
+            with open(LOCATIONS_FILENAME, 'r') as f:
+                locations = json.load(f)
+        return StoreRegistry(stores, locations)
+
+    def address(self, store_id):
+        return self.stores[store_id]['address']
+
+    def nearest(self, latitude, longitude, count, regions=None):
+        """
+        [(distance in km, store)] of the count stores nearest to a point,
+        among those of the given regions (default every region)
+        """
+        point = to_xyz(latitude, longitude)
+        candidates = []
+        for region, tree in self.trees.items():
+            if regions is None or region in regions:
+                candidates += tree.nearest(point, count)
+        return [
+            (chord_to_km(chord), self.stores[store_id])
+            for chord, store_id in sorted(candidates)[:count]
+        ]
+
+    def store_ids(self, locations=None):
+        """
+        ids of the stores tracked for the named locations (default every
+        location); every store if no locations are configured
+        """
+        if len(self.locations) == 0:
+            return sorted(self.stores)
+        store_ids = set()
+        for name in (locations or self.locations):
+            location = self.locations[name]
+            store_ids.update(
+                store['id']
+                for _, store in self.nearest(
+                    location['latitude'],
+                    location['longitude'],
+                    location.get('stores', 5),
+                    location.get('regions')
+                )
+            )
+        return sorted(store_ids)
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_registry():
+    """
+    the stores and locations in the current directory, read the first time
+    they are needed
+    """
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = StoreRegistry.from_disk()
+        return _registry
+
+
+def set_registry(registry):
+    global _registry
+    with _registry_lock:
+        _registry = registry
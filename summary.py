@@ -0,0 +1,323 @@
+import json
+import threading
+
+from catalog import connect
+from lazy import LazyModule
+
+pd = LazyModule('pandas')
+
+
+class Summary:
+    """
+    The latest state of every item, kept next to the catalog (in the same
+    sqlite database) and updated from each new snapshot as it is taken, so
+    that questions like "what dropped in price" or "what is back in stock"
+    are answered from one row per item instead of every item's history.
+
+    Columns:
+        canonical_url
+        price (float): as of the last update
+        previous_price (float): before the last price change, if any
+        min_price, max_price (float): all time
+        price_changed (int): timestamp of the last price change, or of the
+            first price seen
+        last_checked (int)
+        in_stock (str): json of {location: [sizes in stock]}
+        in_stock_count (int): size / location combinations in stock
+        last_restock (int): last time a size came (back) in stock anywhere
+    """
+
+    FILENAME = 'zared.db'
+    COLUMNS = [
+        'canonical_url', 'price', 'previous_price', 'min_price', 'max_price',
+        'price_changed', 'last_checked', 'in_stock', 'in_stock_count',
+        'last_restock',
+    ]
+    COLUMN_TYPES = {
+        'canonical_url': 'TEXT PRIMARY KEY',
+        'price': 'REAL',
+        'previous_price': 'REAL',
+        'min_price': 'REAL',
+        'max_price': 'REAL',
+        'price_changed': 'INTEGER',
+        'last_checked': 'INTEGER',
+        'in_stock': 'TEXT',
+        'in_stock_count': 'INTEGER',
+        'last_restock': 'INTEGER',
+    }
+    INDEXED_COLUMNS = ['price_changed', 'last_restock']
+
+    def __init__(self, filename=FILENAME, journal_mode=None):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.connection = connect(filename, journal_mode)
+        with self.lock, self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS summaries ({columns})'.format(
+                    columns=', '.join(
+                        '"{column}" {type}'.format(
+                            column=column, type=self.COLUMN_TYPES[column]
+                        )
+                        for column in self.COLUMNS
+                    )
+                )
+            )
+            for column in self.INDEXED_COLUMNS:
+                self.connection.execute(
+                    'CREATE INDEX IF NOT EXISTS "summaries_{column}" '
+                    'ON summaries ("{column}")'.format(column=column)
+                )
+
+    @staticmethod
+    def in_stock(size_availabilities):
+        """
+        {location: [sizes]} of the sizes available in each location
+        """
+        in_stock = {}
+        for size_availability in size_availabilities:
+            if size_availability['available'] is True:
+                in_stock.setdefault(size_availability['location'], [])\
+                        .append(size_availability['size'])
+        return {
+            location: sorted(set(sizes))
+            for location, sizes in in_stock.items()
+        }
+
+    @staticmethod
+    def in_stock_pairs(in_stock):
+        return {
+            (location, size)
+            for location, sizes in in_stock.items()
+            for size in sizes
+        }
+
+    def get(self, canonical_url):
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT {columns} FROM summaries '
+                'WHERE canonical_url = ?'.format(
+                    columns=', '.join(
+                        '"{column}"'.format(column=column)
+                        for column in self.COLUMNS
+                    )
+                ),
+                [canonical_url]
+            ).fetchone()
+        if row is None:
+            return None
+        row = dict(zip(self.COLUMNS, row))
+        row['in_stock'] = json.loads(row['in_stock'])
+        return row
+
+    def put(self, row):
+        self.put_many([row])
+
+    def put_many(self, rows):
+        """
+        write many rows, in one transaction
+        """
+        with self.lock, self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO summaries ({columns}) '
+                'VALUES ({values})'.format(
+                    columns=', '.join(
+                        '"{column}"'.format(column=column)
+                        for column in self.COLUMNS
+                    ),
+                    values=', '.join('?' for _ in self.COLUMNS)
+                ),
+                [
+                    [
+                        json.dumps(row[column], sort_keys=True)
+                        if column == 'in_stock' else row[column]
+                        for column in self.COLUMNS
+                    ]
+                    for row in rows
+                ]
+            )
+
+    def record(self, canonical_url, timestamp, price, size_availabilities):
+        """
+        fold one new snapshot into the item's summary
+        """
+        self.put(self.fold(
+            self.get(canonical_url),
+            canonical_url, timestamp, price, size_availabilities
+        ))
+
+    def record_many(self, snapshots):
+        """
+        fold many items' new snapshots, (canonical_url, timestamp, price,
+        size_availabilities), into their summaries, written in one
+        transaction
+        """
+        self.put_many([
+            self.fold(self.get(snapshot[0]), *snapshot)
+            for snapshot in snapshots
+        ])
+
+    def fold(self, row, canonical_url, timestamp, price,
+             size_availabilities):
+        """
+        an item's summary row (None if it has none yet) with a new snapshot
+        folded in
+        """
+        in_stock = self.in_stock(size_availabilities)
+        if row is None:
+            row = {
+                'canonical_url': canonical_url,
+                'price': price,
+                'previous_price': None,
+                'min_price': price,
+                'max_price': price,
+                'price_changed': timestamp,
+                'last_restock': None,
+            }
+        else:
+            if row['price'] != price:
+                row['previous_price'] = row['price']
+                row['price'] = price
+                row['price_changed'] = timestamp
+            row['min_price'] = min(row['min_price'], price)
+            row['max_price'] = max(row['max_price'], price)
+            if len(
+                    self.in_stock_pairs(in_stock) -
+                    self.in_stock_pairs(row['in_stock'])
+            ) > 0:
+                row['last_restock'] = timestamp
+        row.update({
+            'last_checked': timestamp,
+            'in_stock': in_stock,
+            'in_stock_count': len(self.in_stock_pairs(in_stock)),
+        })
+        return row
+
+    def rebuild(self, item):
+        """
+        an item's summary from its whole history, for items recorded before
+        summaries were kept
+        """
+        prices = item.price_history.sort_values(
+            'timestamp', kind='mergesort'
+        ).reset_index(drop=True)
+        if len(prices) == 0:
+            return
+        changes = prices[
+            prices['price'].ne(prices['price'].shift()) &
+            prices['price'].shift().notnull()
+        ]
+        availability = item.availability.sort_values(
+            item.AVAILABILITY_KEY + ['timestamp'], kind='mergesort'
+        )
+        previous = availability.groupby(
+            item.AVAILABILITY_KEY, dropna=False, observed=True
+        )['available'].shift()
+        restocks = availability['timestamp'][
+            (availability['available'].eq(True) & previous.eq(False))
+            .fillna(False).astype(bool)
+        ]
+        last_checked = max(
+            int(prices['timestamp'].iloc[-1]),
+            int(item.last_checked())
+        )
+        latest = item.availability_as_of(last_checked)
+        in_stock = self.in_stock([
+            {
+                'location': size_availability['location'],
+                'size': size_availability['size'],
+                'available': bool(size_availability['available']),
+            }
+            for size_availability in latest.to_dict('records')
+        ])
+        self.put({
+            'canonical_url': item.canonical_url,
+            'price': float(prices['price'].iloc[-1]),
+            'previous_price': (
+                float(prices['price'].shift().loc[changes.index[-1]])
+                if len(changes) > 0 else None
+            ),
+            'min_price': float(prices['price'].min()),
+            'max_price': float(prices['price'].max()),
+            'price_changed': int(
+                changes['timestamp'].iloc[-1] if len(changes) > 0
+                else prices['timestamp'].iloc[0]
+            ),
+            'last_checked': last_checked,
+            'in_stock': in_stock,
+            'in_stock_count': len(self.in_stock_pairs(in_stock)),
+            'last_restock': (
+                int(restocks.max()) if len(restocks) > 0 else None
+            ),
+        })
+
+    def query(self, dropped_since=None, restocked_since=None,
+              audience_segment=None, category_type=None, ignored=False,
+              bought=False):
+        """
+        summaries of catalog items, most recently changed first: those whose
+        price dropped since `dropped_since` and / or that came back in stock
+        since `restocked_since` (timestamps), if given
+        """
+        conditions = []
+        parameters = []
+        if dropped_since is not None:
+            conditions.append(
+                's.price_changed >= ? AND s.price < s.previous_price'
+            )
+            parameters.append(dropped_since)
+        if restocked_since is not None:
+            conditions.append('s.last_restock >= ?')
+            parameters.append(restocked_since)
+        if audience_segment is not None:
+            conditions.append('lower(i.audience_segment) = ?')
+            parameters.append(audience_segment.lower())
+        if category_type is not None:
+            conditions.append('lower(i.type) = ?')
+            parameters.append(category_type.lower())
+        if ignored is False:
+            conditions.append('NOT i."ignore"')
+        if bought is False:
+            conditions.append('NOT i.bought')
+        with self.lock:
+            summaries = pd.read_sql_query(
+                'SELECT s.*, i.audience_segment, i.type, i.filename '
+                'FROM summaries s JOIN items i '
+                'ON s.canonical_url = i.canonical_url '
+                '{where} '
+                'ORDER BY max(s.price_changed, '
+                'coalesce(s.last_restock, 0)) DESC'.format(
+                    where='WHERE ' + ' AND '.join(conditions)
+                    if len(conditions) > 0 else ''
+                ),
+                self.connection,
+                params=parameters,
+                index_col='canonical_url'
+            )
+        summaries['in_stock'] = summaries['in_stock'].map(json.loads)
+        return summaries
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    """
+    the summary table of the catalog in the current directory, opened the
+    first time it is needed
+    """
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = Summary()
+        return _store
+
+
+def set_store(store):
+    global _store
+    with _store_lock:
+        _store = store
@@ -0,0 +1,110 @@
+"""
+What the tests share. Run them from the repository root:
+
+    python -m unittest discover tests
+"""
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPOSITORY)
+sys.path.insert(0, os.path.join(REPOSITORY, 'benchmarks'))
+
+import alerts
+import fetch
+import history
+from item import Item
+import stores
+import summary
+
+PART_NUMBER = '12345678'
+
+
+def data_layer(availability):
+    """
+    a page's data layer for one black color, with size S in stock and size
+    M `availability`; decoded from json, as it is from a page, so that its
+    strings are not the interned literals of this file
+    """
+    return json.loads(json.dumps({
+        'product': {
+            'detail': {
+                'colors': [{
+                    'id': '001',
+                    'name': 'black',
+                    'sizes': [
+                        {'id': 1, 'name': 'S', 'availability': 'in_stock'},
+                        {'id': 2, 'name': 'M', 'availability': availability},
+                    ]
+                }]
+            }
+        }
+    }))
+
+
+def size_availabilities(availability):
+    """
+    the online size availabilities of data_layer(availability)
+    """
+    return Item.get_size_availabilities(
+        PART_NUMBER, data_layer(availability), color_id='001', store_ids=[]
+    )
+
+
+class DirectoryTest(unittest.TestCase):
+    """
+    runs each test in a new, empty working directory, as zared runs in the
+    directory holding its catalog, with the module-wide stores, summary,
+    history backend and alerter starting afresh
+    """
+
+    def setUp(self):
+        self.previous_directory = os.getcwd()
+        self.directory = tempfile.mkdtemp(prefix='zared_test_')
+        os.chdir(self.directory)
+        self.reset()
+        stores.set_registry(stores.StoreRegistry([]))
+
+    def tearDown(self):
+        store = summary._store
+        if store is not None:
+            store.close()
+        self.reset()
+        os.chdir(self.previous_directory)
+        shutil.rmtree(self.directory)
+
+    @staticmethod
+    def reset():
+        stores.set_registry(None)
+        summary.set_store(None)
+        history.set_backend(None)
+        alerts.set_alerter(None)
+        fetch.client.new_run()
+
+
+class StubTest(DirectoryTest):
+    """
+    a DirectoryTest with the local stub of benchmarks/stub.py serving item
+    pages and stock for one store
+    """
+
+    STORES = [{'id': 10000, 'addressLines': ['1 Test Street']}]
+
+    def setUp(self):
+        from stub import StubServer
+        super().setUp()
+        with open(stores.FILENAME, 'w') as f:
+            json.dump(self.STORES, f)
+        stores.set_registry(None)
+        self.server = StubServer().start()
+        self.stock_url = Item.STORE_AVAILABILITY_URL
+        Item.STORE_AVAILABILITY_URL = self.server.stock_url_template()
+
+    def tearDown(self):
+        Item.STORE_AVAILABILITY_URL = self.stock_url
+        self.server.stop()
+        super().tearDown()
@@ -0,0 +1,32 @@
+import unittest
+
+from helpers import DirectoryTest, size_availabilities
+
+import alerts
+from item import Item
+
+
+class OnlineSizeAvailableTest(DirectoryTest):
+
+    def state(self, timestamp, availability):
+        return Item.state(timestamp, 29.95, size_availabilities(availability))
+
+    def test_in_stock_online_is_available(self):
+        availability = self.state(1, 'in_stock')['availability']
+        self.assertTrue(all(
+            size_availability['available'] is True
+            for size_availability in availability.values()
+        ))
+
+    def test_alert_fires_when_size_comes_in_stock_online(self):
+        rule = alerts.rule_from_config({'size': 'M', 'store': 'online'})
+        previous = self.state(1, 'out_of_stock')
+        current = self.state(2, 'in_stock')
+        self.assertEqual(
+            rule.evaluate(previous, current)['locations'], ['online']
+        )
+        self.assertIsNone(rule.evaluate(current, current))
+
+
+if __name__ == '__main__':
+    unittest.main()
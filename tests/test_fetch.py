@@ -0,0 +1,32 @@
+import unittest
+
+from helpers import StubTest
+
+import fetch
+
+
+class GetParsedTest(StubTest):
+
+    def test_error_response_is_not_parsed(self):
+        parsed = []
+        with self.assertRaises(fetch.requests.HTTPError):
+            fetch.client.get_parsed(
+                self.server.url + '/missing', parsed.append
+            )
+        self.assertEqual(parsed, [])
+
+    def test_page_is_parsed_once_per_run(self):
+        url = self.server.product_url(1)
+        parsed = []
+
+        def parse(response):
+            parsed.append(response.status_code)
+            return len(parsed)
+
+        self.assertEqual(fetch.client.get_parsed(url, parse), 1)
+        self.assertEqual(fetch.client.get_parsed(url, parse), 1)
+        self.assertEqual(parsed, [200])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+import unittest
+
+from helpers import DirectoryTest, size_availabilities
+
+import history
+from item import Item
+from lazy import LazyModule
+
+arrow = LazyModule('arrow')
+pd = LazyModule('pandas')
+
+URL = 'https://www.zara.com/us/en/item-p12345678.html'
+PRICE = 29.95
+
+
+class ChangesOnlyTest(DirectoryTest):
+    """
+    items recorded with only what changed tell the same availability at
+    any time as items recorded in full
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.recording = Item.RECORDING
+        self.snapshots = [
+            (100, size_availabilities('out_of_stock')),
+            (200, size_availabilities('out_of_stock')),
+            (300, size_availabilities('in_stock')),
+            # size M is no longer listed
+            (400, size_availabilities('in_stock')[:1]),
+        ]
+
+    def tearDown(self):
+        Item.RECORDING = self.recording
+        super().tearDown()
+
+    def recorded(self, recording):
+        Item.RECORDING = recording
+        item = Item(
+            canonical_url=URL,
+            price_history=history.compact(pd.DataFrame(), 'price'),
+            availability=history.compact(pd.DataFrame(), 'availability')
+        )
+        state = None
+        for timestamp, sas in self.snapshots:
+            item.record(
+                arrow.get(timestamp), state, PRICE, sas,
+                on_disk_update=False
+            )
+            state = Item.state(timestamp, PRICE, sas)
+        return item
+
+    def available(self, item, timestamp):
+        return {
+            row.size: bool(row.available)
+            for row in item.availability_as_of(timestamp).itertuples()
+        }
+
+    def test_only_changes_are_recorded(self):
+        self.assertEqual(len(self.recorded('changes').availability), 4)
+        self.assertEqual(len(self.recorded('all').availability), 7)
+
+    def test_availability_as_of(self):
+        changes = self.recorded('changes')
+        for timestamp, expected in [
+                (50, {}),
+                (100, {'S': True, 'M': False}),
+                (250, {'S': True, 'M': False}),
+                (300, {'S': True, 'M': True}),
+                (400, {'S': True}),
+        ]:
+            self.assertEqual(self.available(changes, timestamp), expected)
+
+    def test_same_as_recording_everything(self):
+        changes = self.recorded('changes')
+        everything = self.recorded('all')
+        for timestamp in [100, 150, 200, 300, 350]:
+            self.assertEqual(
+                self.available(changes, timestamp),
+                self.available(everything, timestamp)
+            )
+
+    def test_price_as_of(self):
+        changes = self.recorded('changes')
+        self.assertEqual(len(changes.price_history), 1)
+        self.assertIsNone(changes.price_as_of(50))
+        self.assertEqual(changes.price_as_of(400), PRICE)
+
+
+if __name__ == '__main__':
+    unittest.main()
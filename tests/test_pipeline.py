@@ -0,0 +1,54 @@
+import unittest
+
+from helpers import DirectoryTest
+
+from pipeline import UpdatePipeline
+from stub import synthetic_page
+
+URL = 'https://www.zara.com/us/en/item-p12345678.html'
+
+
+class Page:
+
+    def __init__(self, text):
+        self.text = text
+
+
+class ExtractTest(DirectoryTest):
+
+    def setUp(self):
+        super().setUp()
+        self.page = synthetic_page(URL, 12345678, 29.95)
+        # as the page text has it, but not as the scan looks for it
+        self.unscannable_page = self.page.replace(
+            '"zara:///1/products?partNumber=12345678"',
+            '&quot;zara:///1/products?partNumber=12345678&quot;'
+        )
+
+    def test_scanned_pages_start_no_parsers(self):
+        pipeline = UpdatePipeline(None, parsers=1)
+        extracted = pipeline.extract(Page(self.page))
+        self.assertEqual(extracted['part_number'], '12345678')
+        self.assertIsNone(pipeline.executor)
+
+    def test_other_pages_are_parsed_by_a_parser(self):
+        pipeline = UpdatePipeline(None, parsers=1)
+        try:
+            extracted = pipeline.extract(Page(self.unscannable_page))
+            self.assertIsNotNone(pipeline.executor)
+        finally:
+            if pipeline.executor is not None:
+                pipeline.executor.shutdown()
+        self.assertEqual(
+            extracted, pipeline.extract(Page(self.page))
+        )
+
+    def test_other_pages_are_parsed_in_place_without_parsers(self):
+        pipeline = UpdatePipeline(None, parsers=0)
+        extracted = pipeline.extract(Page(self.unscannable_page))
+        self.assertIsNone(pipeline.executor)
+        self.assertEqual(extracted['part_number'], '12345678')
+
+
+if __name__ == '__main__':
+    unittest.main()
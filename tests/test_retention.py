@@ -0,0 +1,98 @@
+import os
+import unittest
+
+from helpers import DirectoryTest
+
+import history
+from item import Item
+from lazy import LazyModule
+import retention
+from retention import DAY
+
+pd = LazyModule('pandas')
+
+HOUR = 60 * 60
+SINCE = 10 * DAY
+BEFORE = 12 * DAY
+
+
+def availability(rows):
+    return history.compact(pd.DataFrame([
+        {
+            'timestamp': timestamp, 'location': 'online', 'store_id': None,
+            'size': size, 'size_id': size_id, 'available': available,
+            'quantity': None
+        }
+        for timestamp, size, size_id, available in rows
+    ]), 'availability')
+
+
+class RollupTest(DirectoryTest):
+
+    def test_daily_prices(self):
+        prices = history.compact(pd.DataFrame({
+            # the price before since still holds at its start
+            'timestamp': [
+                SINCE - 12 * HOUR, SINCE + 6 * HOUR, SINCE + 18 * HOUR,
+                SINCE + DAY + 12 * HOUR
+            ],
+            'price': [10.0, 20.0, 15.0, 30.0],
+        }), 'price')
+        daily = retention.rollup('price', prices, SINCE, BEFORE)
+        self.assertEqual(daily['day'].tolist(), [SINCE, SINCE + DAY])
+        self.assertEqual(daily['snapshots'].tolist(), [2, 1])
+        self.assertEqual(daily['min_price'].tolist(), [10.0, 15.0])
+        self.assertEqual(daily['max_price'].tolist(), [20.0, 30.0])
+        self.assertEqual(daily['last_price'].tolist(), [15.0, 30.0])
+
+    def test_time_weighted_in_stock_fraction(self):
+        daily = retention.rollup('availability', availability([
+            (SINCE, 'S', 1, True),
+            (SINCE + 18 * HOUR, 'S', 1, False),
+            # no longer listed, so neither in nor out of stock
+            (SINCE + DAY + 12 * HOUR, 'S', 1, None),
+            (SINCE, 'M', 2, True),
+        ]), SINCE, BEFORE).sort_values(['size_id', 'day'])
+        self.assertEqual(daily['size'].tolist(), ['S', 'S', 'M', 'M'])
+        self.assertEqual(
+            daily['in_stock_fraction'].tolist(), [0.75, 0.0, 1.0, 1.0]
+        )
+        self.assertEqual(
+            daily['seconds'].tolist(), [DAY, DAY // 2, DAY, DAY]
+        )
+        self.assertEqual(daily['snapshots'].tolist(), [2, 1, 1, 0])
+
+
+class RemoveBeforeTest(DirectoryTest):
+
+    FILEPATH = 'items/woman/dresses'
+    FILENAME = 'dress'
+
+    def test_latest_old_row_per_key_is_kept(self):
+        os.makedirs(self.FILEPATH)
+        filename = history.CsvHistory.filename(
+            self.FILEPATH, self.FILENAME, 'availability'
+        )
+        availability([
+            (1, 'S', 1, True),
+            (2, 'S', 1, False),
+            (1, 'M', 2, True),
+            (5, 'S', 1, True),
+            (5, 'M', 2, False),
+        ]).reindex(columns=Item.AVAILABILITY_COLUMNS).to_csv(
+            filename, index=False
+        )
+        history.CsvHistory().remove_before(
+            'availability', [(self.FILEPATH, self.FILENAME)], 3,
+            retention.KEYS['availability']
+        )
+        rows = pd.read_csv(filename)
+        self.assertEqual(
+            list(zip(rows['timestamp'], rows['size'], rows['available'])),
+            [(2, 'S', False), (1, 'M', True), (5, 'S', True),
+             (5, 'M', False)]
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+import os
+import unittest
+
+from helpers import DirectoryTest
+
+import history
+from item import Item
+from scheduler import Scheduler
+
+FILEPATH = 'items/woman/dresses'
+FILENAME = 'dress'
+DAY = 24 * 60 * 60
+
+
+class HistoryChangesTest(DirectoryTest):
+
+    def write(self, kind, rows):
+        os.makedirs(FILEPATH, exist_ok=True)
+        columns = Item.PRICE_HISTORY_COLUMNS if kind == 'price' \
+            else Item.AVAILABILITY_COLUMNS
+        with open(history.CsvHistory.filename(
+                FILEPATH, FILENAME, kind), 'w') as f:
+            print(','.join(columns), file=f)
+            for row in rows:
+                print(','.join(str(value) for value in row), file=f)
+
+    def availability(self, timestamp, available):
+        return (timestamp, '', 'online', '', 'M', 2, available, '')
+
+    def setUp(self):
+        super().setUp()
+        self.now = 100 * DAY
+        self.since = self.now - Scheduler.LOOKBACK
+        self.write('price', [
+            # changes before the window are not counted
+            (self.now - 30 * DAY, '', 10.0),
+            (self.now - 20 * DAY, '', 20.0),
+            (self.now - 6 * DAY, '', 20.0),
+            (self.now - 5 * DAY, '', 15.0),
+            (self.now - DAY, '', 15.0),
+        ])
+        self.write('availability', [
+            self.availability(self.now - 30 * DAY, True),
+            self.availability(self.now - 20 * DAY, False),
+            self.availability(self.now - 6 * DAY, False),
+            self.availability(self.now - 3 * DAY, True),
+        ])
+
+    def test_changes_within_the_window(self):
+        self.assertEqual(
+            Scheduler.history_changes(FILEPATH, FILENAME, self.since),
+            [self.now - 5 * DAY, self.now - 3 * DAY]
+        )
+
+    def test_no_history_in_the_window(self):
+        self.assertEqual(
+            Scheduler.history_changes(FILEPATH, FILENAME, self.now + DAY),
+            []
+        )
+
+    def test_no_history_at_all(self):
+        self.assertEqual(
+            Scheduler.history_changes(FILEPATH, 'other', self.since), []
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+import time
+import unittest
+
+from helpers import DirectoryTest
+
+from catalog import Catalog
+from shards import HashRing, ShardCoordinator
+from zared import Zared
+
+KEYS = [str(key) for key in range(1000)]
+
+
+class HashRingTest(DirectoryTest):
+
+    def test_removing_a_node_only_moves_its_keys(self):
+        before = HashRing(['a', 'b', 'c'])
+        after = HashRing(['a', 'b'])
+        for key in KEYS:
+            if before.node(key) != 'c':
+                self.assertEqual(after.node(key), before.node(key))
+            else:
+                self.assertIn(after.node(key), ['a', 'b'])
+
+    def test_every_node_gets_keys(self):
+        ring = HashRing(['a', 'b', 'c'])
+        self.assertEqual({ring.node(key) for key in KEYS}, {'a', 'b', 'c'})
+
+    def test_no_nodes(self):
+        self.assertIsNone(HashRing([]).node('key'))
+
+
+class ShardCoordinatorTest(DirectoryTest):
+
+    def coordinator(self, worker,
+                    lease_seconds=ShardCoordinator.LEASE_SECONDS):
+        return ShardCoordinator(
+            worker, shards=16, lease_seconds=lease_seconds
+        )
+
+    def test_workers_split_the_shards(self):
+        first = self.coordinator('first')
+        second = self.coordinator('second')
+        first.rebalance()
+        second.rebalance()
+        # the first one hands over what the ring now gives the second, who
+        # takes it
+        first.rebalance()
+        second.rebalance()
+        self.assertEqual(first.held & second.held, set())
+        self.assertEqual(first.held | second.held, set(range(16)))
+        self.assertGreater(len(second.held), 0)
+
+    def test_expired_leases_are_taken_over(self):
+        first = self.coordinator('first', lease_seconds=0.5)
+        second = self.coordinator('second', lease_seconds=0.5)
+        first.rebalance()
+        second.rebalance()
+        first.rebalance()
+        # first stops renewing, as if it had died
+        time.sleep(0.6)
+        self.assertEqual(second.rebalance(), set(range(16)))
+        self.assertFalse(any(
+            first.owns(str(key)) for key in KEYS
+        ))
+
+    def test_stopped_worker_hands_back_its_shards(self):
+        first = self.coordinator('first')
+        second = self.coordinator('second')
+        first.start()
+        second.start()
+        first.stop()
+        self.assertEqual(second.rebalance(), set(range(16)))
+        second.stop()
+        self.assertEqual(second.status(), [])
+
+    def test_default_ids_are_reused(self):
+        first = ShardCoordinator(shards=16)
+        second = ShardCoordinator(shards=16)
+        first.start()
+        second.start()
+        self.assertNotEqual(first.worker, second.worker)
+        self.assertTrue(second.worker.startswith(first.worker))
+        second.stop()
+        # started again in its place
+        third = ShardCoordinator(shards=16)
+        third.start()
+        self.assertEqual(third.worker, second.worker)
+        third.stop()
+        first.stop()
+
+
+class ShardedRunTest(DirectoryTest):
+
+    def test_sharded_catalog_is_not_wal(self):
+        Zared().catalog.close()
+        zared = Zared(journal_mode='DELETE')
+        zared.run_sharded(
+            ShardCoordinator('worker', shards=16), rounds=1
+        )
+        zared.catalog.close()
+        # and stays that way for commands run alongside
+        catalog = Catalog(Zared.ZARED_INDEX, Zared.ZARED_COLUMNS)
+        mode, = catalog.connection.execute('PRAGMA journal_mode').fetchone()
+        catalog.close()
+        self.assertEqual(mode, 'delete')
+        self.assertEqual(zared.METRICS_FILENAME, 'zared_worker.prom')
+        self.assertEqual(
+            zared.CHECKPOINT_FILENAME, 'update_checkpoint_worker.jsonl'
+        )
+
+    def test_new_catalog_is_wal(self):
+        zared = Zared()
+        mode, = zared.catalog.connection.execute(
+            'PRAGMA journal_mode'
+        ).fetchone()
+        zared.catalog.close()
+        self.assertEqual(mode, 'wal')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,32 @@
+import unittest
+
+from helpers import DirectoryTest, size_availabilities
+
+import summary
+
+URL = 'https://www.zara.com/us/en/item-p12345678.html'
+
+
+class OnlineStockSummaryTest(DirectoryTest):
+
+    def setUp(self):
+        super().setUp()
+        self.summary = summary.get_store()
+
+    def test_in_stock_lists_online_sizes(self):
+        self.summary.record(URL, 1, 29.95, size_availabilities('in_stock'))
+        row = self.summary.get(URL)
+        self.assertEqual(row['in_stock'], {'online': ['M', 'S']})
+        self.assertEqual(row['in_stock_count'], 2)
+
+    def test_online_restock_sets_last_restock(self):
+        self.summary.record(
+            URL, 1, 29.95, size_availabilities('out_of_stock')
+        )
+        self.assertIsNone(self.summary.get(URL)['last_restock'])
+        self.summary.record(URL, 2, 29.95, size_availabilities('in_stock'))
+        self.assertEqual(self.summary.get(URL)['last_restock'], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,147 @@
+import os
+import unittest
+
+from helpers import DirectoryTest, StubTest
+
+import fetch
+import metrics
+from zared import Zared
+
+
+def http_error(status):
+    response = fetch.requests.Response()
+    response.status_code = status
+    return fetch.requests.HTTPError(response=response)
+
+
+class AddThenUpdateTest(StubTest):
+
+    def assertUpdates(self, zared):
+        added = zared.zared['last_updated'].copy()
+        zared.update_all()
+        summary = metrics.collector.summary()
+        self.assertEqual(summary['items'], len(added))
+        self.assertEqual(summary['failed'], 0)
+        self.assertTrue(
+            (zared.catalog.to_DataFrame()['last_updated'] >= added).all()
+        )
+
+    def test_added_item_updates(self):
+        zared = Zared()
+        zared.add_item(self.server.product_url(1), 'black')
+        self.assertUpdates(zared)
+
+    def test_items_added_together_update(self):
+        zared = Zared()
+        zared.add_items([
+            (self.server.product_url(1), 'black'),
+            (self.server.product_url(2), 'black'),
+        ])
+        self.assertUpdates(zared)
+
+    def test_added_items_update_after_reopening(self):
+        Zared().add_item(self.server.product_url(1), 'black')
+        self.assertUpdates(Zared())
+
+
+class CheckpointTest(StubTest):
+
+    def setUp(self):
+        super().setUp()
+        zared = Zared()
+        zared.add_items([
+            (self.server.product_url(part_number), 'black')
+            for part_number in [1, 2, 3]
+        ])
+        zared.catalog.close()
+
+    def test_interrupted_run_resumes(self):
+        zared = Zared()
+        update_item = zared.update_item
+        updated = []
+
+        def interrupted(zared_row):
+            if len(updated) == 1:
+                raise KeyboardInterrupt
+            updated.append(zared_row.name)
+            return update_item(zared_row)
+
+        zared.update_item = interrupted
+        with self.assertRaises(KeyboardInterrupt):
+            zared.update_all()
+        zared.catalog.close()
+        self.assertTrue(os.path.exists(Zared.CHECKPOINT_FILENAME))
+
+        zared = Zared()
+        resumed = []
+        update_item = zared.update_item
+
+        def recorded(zared_row):
+            resumed.append(zared_row.name)
+            return update_item(zared_row)
+
+        zared.update_item = recorded
+        zared.update_all()
+        zared.catalog.close()
+        self.assertEqual(len(resumed), 2)
+        self.assertNotIn(updated[0], resumed)
+        self.assertFalse(os.path.exists(Zared.CHECKPOINT_FILENAME))
+
+
+class RetryTest(DirectoryTest):
+
+    def setUp(self):
+        super().setUp()
+        self.zared = Zared()
+        self.zared.RETRY_BACKOFF = 0
+
+    def tearDown(self):
+        self.zared.catalog.close()
+        super().tearDown()
+
+    def attempts(self, error):
+        """
+        how many times a fetch always failing with error is tried
+        """
+        attempts = []
+
+        def fetch_snapshot():
+            attempts.append(1)
+            raise error
+
+        with self.assertRaises(type(error)):
+            self.zared.retried(fetch_snapshot)
+        return len(attempts)
+
+    def test_network_errors_are_retried(self):
+        for error in [
+                fetch.requests.ConnectionError(),
+                fetch.requests.Timeout(),
+                TimeoutError(),
+                http_error(429),
+                http_error(503),
+        ]:
+            self.assertEqual(self.attempts(error), Zared.UPDATE_ATTEMPTS)
+
+    def test_other_errors_fail_at_once(self):
+        for error in [
+                http_error(404),
+                http_error(403),
+                fetch.requests.exceptions.InvalidURL(),
+                KeyError('product'),
+        ]:
+            self.assertEqual(self.attempts(error), 1)
+
+    def test_retried_until_it_works(self):
+        errors = [fetch.requests.ConnectionError()]
+
+        def fetch_snapshot():
+            if len(errors) > 0:
+                raise errors.pop()
+            return 'snapshot'
+
+        self.assertEqual(self.zared.retried(fetch_snapshot), 'snapshot')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,14 +1,30 @@
 import argparse
+from collections import OrderedDict
+import json
+from concurrent.futures import (
+    FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+)
 import os
 from random import random
 import sys
 import time
 from warnings import warn
 
-import arrow
-import pandas as pd
-
+from catalog import Catalog
+import fetch
+import history
 from item import *
+from lazy import LazyModule
+import metrics
+from pipeline import UpdatePipeline
+import retention
+from scheduler import Scheduler
+import shards
+import stores
+import summary
+
+arrow = LazyModule('arrow')
+pd = LazyModule('pandas')
 
 
 class Zared:
@@ -20,139 +36,961 @@ class Zared:
         'bought', 'ignore'
     ]
     ZARED_FILENAME = 'zared.csv'
+    MANIFEST_FILENAME = 'manifest.json'
+    # one json line for the run, then one per item as it finishes
+    CHECKPOINT_FILENAME = 'update_checkpoint.jsonl'
+    # an interrupted run older than this is started over, not resumed
+    CHECKPOINT_MAX_AGE = 60 * 60
+    UPDATE_ATTEMPTS = 3
+    # seconds before the first retry, doubling for each one after
+    RETRY_BACKOFF = 5
+    # per item timings and errors, then a summary line, for every run
+    RUN_LOG_FILENAME = 'update_log.jsonl'
+    # the last run's summary, for node_exporter's textfile collector
+    METRICS_FILENAME = 'zared.prom'
+    # added to every metric, e.g. to tell sharded workers apart
+    METRICS_LABELS = {}
+    # items fetched at once when adding many
+    ADD_WORKERS = 8
+    # a sharded worker that is done with its stale items waits this long
+    # before looking again
+    SHARDED_ROUND_SECONDS = 60
 
-    def __init__(self):
-        try:
-            self.zared = pd.read_csv(self.ZARED_FILENAME, index_col=0)
-        except FileNotFoundError:
-            warn('No default Zared file found.')
+    def __init__(self, journal_mode=None):
+        """
+        journal_mode: of the catalog's database (see catalog.connect);
+        'DELETE' for sharded workers on more than one host
+        """
+        new_catalog = not Catalog.exists()
+        self.catalog = Catalog(
+            self.ZARED_INDEX, self.ZARED_COLUMNS, journal_mode=journal_mode
+        )
+        if new_catalog:
+            # carry over a catalog from before it moved to sqlite
+            try:
+                zared = pd.read_csv(self.ZARED_FILENAME, index_col=0)
+                zared.index.name = self.ZARED_INDEX
+                self.catalog.upsert(zared)
+            except FileNotFoundError:
+                warn('No default Zared file found.')
+
+    def __getattr__(self, name):
+        # the catalog is only read into a DataFrame when first needed, so
+        # that quick commands do not have to import pandas
+        if name == 'zared':
+            self.zared = self.catalog.to_DataFrame()
+            return self.zared
+        raise AttributeError(name)
 
     def to_disk(self):
-        self.zared.to_csv(self.ZARED_FILENAME)
+        self.catalog.upsert(self.zared)
+
+    def record_update(self, canonical_url, timestamp):
+        """
+        committed to the catalog straight away, so an interrupted run keeps
+        every update made before it stopped
+        """
+        with metrics.phase('catalog_write', canonical_url):
+            self.zared.loc[canonical_url, 'last_updated'] = timestamp
+            self.catalog.update(canonical_url, last_updated=timestamp)
+
+    def record_updates(self, timestamps):
+        """
+        record_update for many {canonical_url: timestamp}, in one
+        transaction
+        """
+        with metrics.phase('catalog_write'):
+            self.zared.loc[list(timestamps), 'last_updated'] = \
+                list(timestamps.values())
+            self.catalog.update_many('last_updated', timestamps)
+
+    def read_manifest(self):
+        try:
+            with open(self.MANIFEST_FILENAME, 'r') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def write_manifest(self, manifest):
+        with open(self.MANIFEST_FILENAME + '.tmp', 'w') as f:
+            json.dump(manifest, f)
+        os.replace(self.MANIFEST_FILENAME + '.tmp', self.MANIFEST_FILENAME)
+
+    @staticmethod
+    def item_signature(filepath, filename):
+        """
+        sizes and modification times of every file an item's catalog row is
+        built from
+        """
+        signature = []
+        for path in [
+                filepath + '/' + filename + '.json',
+                filepath + '/' + filename + '.state'
+        ] + history.get_backend().files(filepath, filename, 'price'):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            signature.append([path, stat.st_size, stat.st_mtime_ns])
+        return signature
+
+    @staticmethod
+    def item_row(filepath, filename):
+        _, audience_segment, category_type = filepath.split('/')
+        item = Item.from_disk(filepath, filename, lazy=True)
+        added, _ = item.timestamp_range()
+        return {
+            'canonical_url': item.canonical_url,
+            'audience_segment': audience_segment,
+            'type': category_type,
+            'filename': filename,
+            'added': int(added),
+            'last_updated': int(item.last_checked()),
+            'bought': item.bought,
+            'ignore': item.ignore,
+        }
 
     def stock_take(self):
         """
-        update the zared dataframe using what we have on disk
+        update the zared dataframe using what we have on disk; items whose
+        files are unchanged since the last stock take (as recorded in
+        MANIFEST_FILENAME) are not read again
         """
         if getattr(self, 'zared', None) is None or self.zared is None:
             self.zared = pd.DataFrame(columns=self.ZARED_COLUMNS)
-            self.zared.index.name = self.ZARED_INDEX
+        self.zared.index.name = self.ZARED_INDEX
+        manifest = self.read_manifest()
+        new_manifest = {}
         for root, directories, filenames in os.walk(Item.PATH):
-            filenames = [
-                filename[:-5]
-                for filename in filenames
-                if filename.endswith('.json')
-            ]
-            if len(filenames) > 0:
-                _, audience_segment, category_type = root.split('/')
-                added_timestamps = {
-                    filename: pd.read_csv(
-                        root + '/price_' + filename + '.csv'
-                    )['timestamp'].min()
-                    for filename in filenames
-                }
-                last_updated_timestamps = {
-                    filename: pd.read_csv(
-                        root + '/price_' + filename + '.csv'
-                    )['timestamp'].max()
-                    for filename in filenames
-                }
-                metadata = {
-                    filename: Item.from_disk(root, filename)
-                    for filename in filenames
+            for filename in filenames:
+                if not filename.endswith('.json'):
+                    continue
+                filename = filename[:-5]
+                path = root + '/' + filename
+                signature = self.item_signature(root, filename)
+                if manifest.get(path, {}).get('signature') == signature:
+                    new_manifest[path] = manifest[path]
+                else:
+                    new_manifest[path] = {
+                        'signature': signature,
+                        'row': self.item_row(root, filename)
+                    }
+        on_disk = pd.DataFrame(
+            [entry['row'] for entry in new_manifest.values()],
+            columns=[self.ZARED_INDEX] + self.ZARED_COLUMNS
+        )
+        on_disk['added_human'] = on_disk['added'].map(
+            lambda timestamp: arrow.get(timestamp).to('local')
+        )
+        on_disk['last_updated_human'] = on_disk['last_updated'].map(
+            lambda timestamp: arrow.get(timestamp).to('local')
+        )
+        self.zared = pd.concat(
+            [self.zared.reset_index(), on_disk], axis=0
+        ).sort_values('last_updated', ascending=True, kind='mergesort')\
+         .drop_duplicates(subset=self.ZARED_INDEX, keep='last')\
+         .set_index(self.ZARED_INDEX)\
+         .astype({'bought': bool, 'ignore': bool})
+        self.write_manifest(new_manifest)
+        self.to_disk()
+
+    def items(self):
+        for root, directories, filenames in os.walk(Item.PATH):
+            for filename in filenames:
+                if filename.endswith('.json'):
+                    yield Item.from_disk(root, filename[:-5], lazy=True)
+
+    def migrate_history(self):
+        """
+        copy every item's csv history into the columnar store, which is used
+        from then on
+        """
+        columnar_history = history.ColumnarHistory()
+        columnar_history.migrate_from_csv(self.items())
+        history.set_backend(columnar_history)
+
+    def compact_history(self):
+        history.get_backend().compact()
+
+    def apply_retention(self, policy=None, verbose=False):
+        """
+        roll up and expire old history as the policy (default the one in
+        retention.FILENAME) says, see retention.apply; safe to run while
+        items are being updated
+        """
+        if policy is None:
+            policy = retention.RetentionPolicy.from_file()
+        return retention.apply(policy, self.items(), verbose=verbose)
+
+    def history(self, kind, audience_segment=None, category_type=None,
+                start=None, end=None, locations=None, sizes=None,
+                chunk_rows=history.CHUNK_ROWS):
+        """
+        stream the price or availability history of every catalog item (of
+        a segment / type, if given) as compact frames of about chunk_rows
+        rows, with an added canonical_url column, e.g.
+
+            for chunk in zared.history('availability', sizes=['M']):
+                ...
+
+        so that analytics can run over more history than fits in memory.
+        start and end are inclusive epoch timestamps; locations and sizes
+        only apply to availability. The filters are pushed down to the
+        history backend, so files and rows they exclude are not read.
+        """
+        if kind not in history.KINDS:
+            raise ValueError('Unknown history: {kind}'.format(kind=kind))
+        if kind == 'price' and (locations is not None or sizes is not None):
+            raise ValueError('Price history has no locations or sizes')
+        conditions = []
+        parameters = []
+        if audience_segment is not None:
+            conditions.append('lower(audience_segment) = ?')
+            parameters.append(audience_segment.lower())
+        if category_type is not None:
+            conditions.append('lower(type) = ?')
+            parameters.append(category_type.lower())
+        rows = self.catalog.rows(' AND '.join(conditions), parameters)
+        canonical_urls = {
+            row['filename']: row[self.ZARED_INDEX] for row in rows
+        }
+        frames = history.get_backend().stream(
+            kind,
+            [
+                (
+                    Item.FILEPATH.format(
+                        audience_segment=row['audience_segment'].lower(),
+                        type=row['type'].lower()
+                    ),
+                    row['filename']
+                )
+                for row in rows
+            ],
+            start=start,
+            end=end,
+            locations=locations,
+            sizes=sizes,
+            chunk_rows=chunk_rows
+        )
+        for chunk in history.chunks(frames, chunk_rows):
+            yield history.compact(chunk, kind).assign(
+                canonical_url=chunk['filename'].map(canonical_urls)
+                                               .astype('category')
+            )
+
+    def list_items(self):
+        """
+        every catalog row, least recently updated first, read straight from
+        the database
+        """
+        return sorted(
+            self.catalog.rows(),
+            key=lambda row: row['last_updated'] or 0
+        )
+
+    def status(self, url):
+        """
+        the catalog rows and summaries of the item(s) at url (all of its
+        colors, if url has no #selectedColor=), read straight from the
+        database
+        """
+        rows = self.catalog.rows(
+            '"{index}" = ? OR substr("{index}", 1, ?) = ?'.format(
+                index=self.ZARED_INDEX
+            ),
+            (url, len(url) + 1, url + '#')
+        )
+        store = summary.get_store()
+        return [
+            dict(row, summary=store.get(row[self.ZARED_INDEX]))
+            for row in rows
+        ]
+
+    def rebuild_summary(self):
+        """
+        summarise every item from its whole history, e.g. for items added
+        before summaries were kept; updates keep them current after that
+        """
+        store = summary.get_store()
+        for item in self.items():
+            try:
+                store.rebuild(item)
+            except Exception as e:
+                warn('Could not summarise {canonical_url}: {error}'.format(
+                    canonical_url=item.canonical_url,
+                    error=e
+                ))
+
+    def summary(self, dropped_since=None, restocked_since=None,
+                audience_segment=None, category_type=None, ignored=False,
+                bought=False):
+        """
+        see Summary.query; reads only the summary table, never history
+        """
+        return summary.get_store().query(
+            dropped_since=dropped_since,
+            restocked_since=restocked_since,
+            audience_segment=audience_segment,
+            category_type=category_type,
+            ignored=ignored,
+            bought=bought
+        )
+
+    def catalog_row(self, item):
+        row = pd.DataFrame({
+            # as in the item's filepath (see Item.to_disk), which updates
+            # find it by
+            'audience_segment': item.category[0].lower(),
+            'type': item.category[1].lower(),
+            'filename': item.filename,
+            'added': item.price_history['timestamp'].min(),
+            'added_human': arrow.get(
+                item.price_history['timestamp'].min()
+            ).to('local'),
+            'last_updated': item.price_history['timestamp'].max(),
+            'last_updated_human': arrow.get(
+                item.price_history['timestamp'].max()
+            ).to('local'),
+            'bought': item.bought,
+            'ignore': item.ignore,
+        }, index=[item.canonical_url])
+        row.index.name = self.ZARED_INDEX
+        return row
+
+    def add_item(self, url, color=None, locations=None):
+        row = self.catalog_row(Item.from_url(url, color, locations))
+        self.zared = pd.concat([self.zared, row], axis=0)
+        self.catalog.upsert(row)
+
+    @staticmethod
+    def read_url_list(filename):
+        """
+        (url, color) pairs from a file with one url per line, optionally
+        followed by a color; blank lines and lines starting with # are
+        skipped
+        """
+        urls = []
+        with open(filename, 'r') as f:
+            for line in f:
+                fields = line.split(None, 1)
+                if len(fields) == 0 or fields[0].startswith('#'):
+                    continue
+                urls.append((
+                    fields[0],
+                    fields[1].strip() if len(fields) > 1 else None
+                ))
+        return urls
+
+    def add_items(self, urls, workers=ADD_WORKERS, verbose=False,
+                  locations=None):
+        """
+        add many (url, color) items at once: pages are fetched and parsed
+        in parallel, each item is saved as it comes in, and the catalog is
+        written once at the end; items whose canonical_url is already
+        tracked (or that appear twice) are skipped
+        """
+        tracked = set(self.zared.index)
+        # already tracked under the url given, no need to fetch them at all
+        urls = [
+            (url, color)
+            for url, color in OrderedDict.fromkeys(urls)
+            if url not in tracked
+        ]
+        rows = []
+        skipped = 0
+        failed = 0
+        fetch.client.new_run()
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = {
+                    executor.submit(Item.fetch, url, color, locations): url
+                    for url, color in urls
                 }
-                root_df = pd.DataFrame(
-                    [
-                        {
-                            'audience_segment': audience_segment,
-                            'type': category_type,
-                            'filename': filename,
-                            'added': added_timestamps[filename],
-                            'added_human': arrow.get(
-                                added_timestamps[filename]
-                            ).to('local'),
-                            'last_updated': last_updated_timestamps[filename],
-                            'last_updated_human': arrow.get(
-                                last_updated_timestamps[filename]
-                            ).to('local'),
-                            'bought': metadata[filename].bought,
-                            'ignore': metadata[filename].ignore,
-                        }
-                        for filename in filenames
-                    ],
-                    index=[
-                        metadata[filename].canonical_url
-                        for filename in filenames
-                    ]
+                # to_disk picks a filename not yet taken, so items are
+                # saved one at a time, from this thread
+                for future in as_completed(futures):
+                    try:
+                        item, state = future.result()
+                    except Exception as e:
+                        warn('Could not add {url}: {type}: {error}'.format(
+                            url=futures[future],
+                            type=type(e).__name__,
+                            error=e
+                        ))
+                        failed += 1
+                        continue
+                    if item.canonical_url in tracked:
+                        skipped += 1
+                        continue
+                    tracked.add(item.canonical_url)
+                    item.save(*state)
+                    rows.append(self.catalog_row(item))
+        finally:
+            fetch.client.new_run()
+            if len(rows) > 0:
+                added = pd.concat(rows, axis=0)
+                self.zared = pd.concat([self.zared, added], axis=0)
+                self.catalog.upsert(added)
+        if verbose is True:
+            print(
+                '{added} items added, {skipped} already tracked, '
+                '{failed} failed'.format(
+                    added=len(rows),
+                    skipped=skipped,
+                    failed=failed
                 )
-                root_df.index.name = self.ZARED_INDEX
-                self.zared = pd.concat([self.zared, root_df], axis=0)\
-                               .reset_index()\
-                               .sort_values('last_updated', ascending=True)\
-                               .drop_duplicates(
-                                    subset='canonical_url', keep='last'
-                                )\
-                               .set_index('canonical_url')
-        self.to_disk()
+            )
+        return len(rows)
 
-    def add_item(self, url, color=None):
-        item = Item.from_url(url, color)
-        self.zared = pd.concat([
-            self.zared,
-            pd.DataFrame({
-                'audience_segment': item.category[0],
-                'type': item.category[1],
-                'filename': item.filename,
-                'added': item.price_history['timestamp'].min(),
-                'added_human': arrow.get(
-                    item.price_history['timestamp'].min()
-                ).to('local'),
-                'last_updated': item.price_history['timestamp'].max(),
-                'last_updated_human': arrow.get(
-                    item.price_history['timestamp'].max()
-                ).to('local'),
-                'bought': item.bought,
-                'ignore': item.ignore,
-            }, index=[item.canonical_url])
-        ], axis=0)
-        self.to_disk()
+    def update_item(self, zared_row):
+        """
+        fetch and record a new snapshot for one catalog row, returning the
+        time of the update; touches only that item's own files, so it is
+        safe to run from several threads at once. Only fetching is retried:
+        trying to record a snapshot again would append it to history twice.
+        """
+        item = self.load_item(zared_row)
+        item.record(*self.retried(item.take_snapshot))
+        return arrow.now().timestamp
 
-    def update(self, zared_row):
+    @staticmethod
+    def load_item(zared_row):
         filepath = Item.FILEPATH.format(
             audience_segment=zared_row['audience_segment'],
             type=zared_row['type']
         )
-        filename = zared_row['filename']
-        item = Item.from_disk(filepath, filename)
-        item.update()
-        self.zared.loc[zared_row.name, 'last_updated'] = arrow.now().timestamp
+        # update only appends, so there is no need to read any history
+        return Item.from_disk(filepath, zared_row['filename'], lazy=True)
+
+    @staticmethod
+    def retryable(error):
+        """
+        whether trying again might help: connection errors, timeouts, and
+        responses saying to come back later (429) or that the server failed
+        (5xx); not other error responses (a 404 will still be a 404), nor,
+        say, a page laid out differently than expected
+        """
+        if isinstance(error, fetch.requests.HTTPError):
+            status = error.response.status_code \
+                if error.response is not None else None
+            return status == 429 or (status is not None and status >= 500)
+        return isinstance(error, (
+            fetch.requests.ConnectionError,
+            fetch.requests.Timeout,
+            fetch.requests.exceptions.ChunkedEncodingError,
+            TimeoutError,
+        ))
+
+    def retried(self, fetch_snapshot):
+        """
+        fetch_snapshot(), retried with exponential backoff after retryable
+        errors, up to UPDATE_ATTEMPTS tries; other errors are raised at once
+        """
+        for attempt in range(self.UPDATE_ATTEMPTS):
+            if attempt > 0:
+                time.sleep(
+                    self.RETRY_BACKOFF * 2 ** (attempt - 1) * (1 + random())
+                )
+            metrics.collector.attempt()
+            try:
+                return fetch_snapshot()
+            except Exception as e:
+                if not self.retryable(e) or \
+                        attempt == self.UPDATE_ATTEMPTS - 1:
+                    raise
+
+    def try_update_item(self, zared_row, update=None):
+        """
+        update(zared_row), update_item by default; returns (what it
+        returned, None), or (None, the error) if it failed
+        """
+        update = update or self.update_item
+        metrics.collector.start_item(zared_row.name)
+        try:
+            result = update(zared_row)
+        except Exception as e:
+            error = '{type}: {error}'.format(type=type(e).__name__, error=e)
+            metrics.collector.finish_item(error)
+            return None, error
+        metrics.collector.finish_item()
+        return result, None
+
+    def update(self, zared_row):
+        self.record_update(zared_row.name, self.update_item(zared_row))
 
-    def update_all(self, ignored=False, bought=False, verbose=False):
-        to_update = self.zared
+    def read_checkpoint(self, selection):
+        """
+        the items already updated by a recent, interrupted run over the same
+        selection
+        """
+        try:
+            with open(self.CHECKPOINT_FILENAME, 'r') as f:
+                lines = f.read().splitlines()
+        except FileNotFoundError:
+            return set()
+        entries = []
+        for line in lines:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                # cut short when the run was interrupted
+                continue
+        if len(entries) == 0 or \
+                entries[0].get('selection') != selection or \
+                arrow.now().timestamp - entries[0]['started'] > \
+                self.CHECKPOINT_MAX_AGE:
+            return set()
+        return {
+            entry['canonical_url']
+            for entry in entries[1:]
+            if entry.get('error') is None
+        }
+
+    def open_checkpoint(self, selection, resume):
+        checkpoint = open(self.CHECKPOINT_FILENAME, 'a' if resume else 'w')
+        if not resume:
+            print(json.dumps({
+                'started': arrow.now().timestamp,
+                'selection': selection
+            }), file=checkpoint, flush=True)
+        return checkpoint
+
+    def record_result(self, checkpoint, canonical_url, result, run_log=None,
+                      record=True):
+        """
+        checkpoint and log an item's (timestamp, error), and with record,
+        write its timestamp to the catalog
+        """
+        timestamp, error = result
+        if error is None:
+            if record is True:
+                self.record_update(canonical_url, timestamp)
+        else:
+            warn('Could not update {canonical_url}: {error}'.format(
+                canonical_url=canonical_url,
+                error=error
+            ))
+        print(json.dumps({
+            'canonical_url': canonical_url,
+            'error': error
+        }), file=checkpoint, flush=True)
+        if run_log is not None:
+            print(json.dumps(dict(
+                metrics.collector.item_record(canonical_url),
+                type='item',
+                timestamp=timestamp
+            )), file=run_log)
+
+    def write_run_metrics(self, run_log, selected):
+        summary = dict(
+            metrics.collector.summary(),
+            type='run',
+            selected=selected
+        )
+        print(json.dumps(summary), file=run_log, flush=True)
+        try:
+            metrics.collector.write_prometheus(
+                self.METRICS_FILENAME, labels=self.METRICS_LABELS
+            )
+        except OSError as e:
+            warn('Could not write metrics to {filename}: {error}'.format(
+                filename=self.METRICS_FILENAME,
+                error=e
+            ))
+        return summary
+
+    def run_sharded(self, coordinator=None, workers=1, stale_for=60 * 60,
+                    verbose=False, rounds=None, pipeline=None):
+        """
+        keep updating the items of this worker's shards (see
+        shards.ShardCoordinator) once they are stale_for seconds old, while
+        other worker processes, here or on other hosts, do the same with
+        theirs; stops after `rounds` rounds, if given. Workers on other
+        hosts need the catalog's database in a rollback journal (see
+        Zared(journal_mode='DELETE')).
+        """
+        if coordinator is None:
+            coordinator = shards.ShardCoordinator()
+        coordinator.start()
+        # one of each per worker, named by its id (which a restarted worker
+        # gets back), so that workers neither resume each other's runs nor
+        # overwrite each other's metrics
+        self.CHECKPOINT_FILENAME = 'update_checkpoint_{worker}.jsonl'.format(
+            worker=coordinator.worker
+        )
+        root, extension = os.path.splitext(self.METRICS_FILENAME)
+        self.METRICS_FILENAME = '{root}_{worker}{extension}'.format(
+            root=root, worker=coordinator.worker, extension=extension
+        )
+        self.METRICS_LABELS = dict(
+            self.METRICS_LABELS, worker=coordinator.worker
+        )
+        try:
+            finished = 0
+            while rounds is None or finished < rounds:
+                started = time.monotonic()
+                # with the updates of other workers, whose shards this one
+                # may have taken over, and any items added since
+                self.zared = self.catalog.to_DataFrame()
+                self.update_all(
+                    verbose=verbose,
+                    workers=workers,
+                    stale_for=stale_for,
+                    owns=coordinator.owns,
+                    pipeline=pipeline
+                )
+                finished += 1
+                if rounds is None or finished < rounds:
+                    time.sleep(max(
+                        self.SHARDED_ROUND_SECONDS -
+                        (time.monotonic() - started),
+                        0
+                    ))
+        finally:
+            coordinator.stop()
+
+    def select(self, ignored=False, bought=False, audience_segment=None,
+               category_type=None, stale_for=None):
+        """
+        catalog rows matching the given filters, least recently updated
+        first; stale_for is in seconds
+        """
+        selected = self.zared
         if ignored is False:
-            to_update = to_update[~to_update['ignore']]
+            selected = selected[~selected['ignore']]
         if bought is False:
-            to_update = to_update[~to_update['bought']]
+            selected = selected[~selected['bought']]
+        if audience_segment is not None:
+            selected = selected[
+                selected['audience_segment'].str.lower() ==
+                audience_segment.lower()
+            ]
+        if category_type is not None:
+            selected = selected[
+                selected['type'].str.lower() == category_type.lower()
+            ]
+        if stale_for is not None:
+            selected = selected[
+                selected['last_updated'] <= arrow.now().timestamp - stale_for
+            ]
+        return selected.sort_values('last_updated', kind='mergesort')
+
+    def update_all(self, ignored=False, bought=False, verbose=False,
+                   workers=1, audience_segment=None, category_type=None,
+                   stale_for=None, max_items=None, time_budget=None,
+                   owns=None, pipeline=None):
+        """
+        update the selected items (see `select`), most stale first, stopping
+        after max_items items or once time_budget seconds have passed; if
+        given, owns(canonical_url) is checked just before each item starts,
+        and items it is false for are left to other workers (see
+        run_sharded). With a pipeline (see pipeline.UpdatePipeline), it
+        runs the update instead of `workers` threads.
+
+        An item whose fetches still fail after UPDATE_ATTEMPTS tries, or
+        that fails in any other way, is skipped.
+        Progress is checkpointed to CHECKPOINT_FILENAME as items finish, and
+        a run over the same selection started within CHECKPOINT_MAX_AGE of
+        an interrupted one picks up where it stopped.
+
+        Time spent in each phase of each item's update, HTTP responses,
+        bytes downloaded and retries are logged to RUN_LOG_FILENAME, and
+        the run's totals written to METRICS_FILENAME for Prometheus.
+        """
+        selection = {
+            'ignored': ignored,
+            'bought': bought,
+            'audience_segment': audience_segment,
+            'category_type': category_type,
+            'stale_for': stale_for,
+        }
+        to_update = self.select(**selection)
+        already_updated = self.read_checkpoint(selection)
+        to_update = to_update[~to_update.index.isin(already_updated)]
+        if owns is not None:
+            to_update = to_update[to_update.index.map(owns).astype(bool)]
+        if max_items is not None:
+            to_update = to_update.iloc[:max_items]
+        deadline = time.monotonic() + time_budget \
+            if time_budget is not None else None
         if verbose is True:
             start_time = arrow.now()
             print('Update started at {utc_epoch} ({local})'.format(
                 utc_epoch=start_time.timestamp,
                 local=start_time
             ))
-        self.zared.apply(self.update, axis=1)
+            if len(already_updated) > 0:
+                print('Resuming, {count} items already updated'.format(
+                    count=len(already_updated)
+                ))
+        attempted = 0
+        failed = 0
+        skipped = 0
+        checkpoint = self.open_checkpoint(
+            selection, resume=len(already_updated) > 0
+        )
+        run_log = open(self.RUN_LOG_FILENAME, 'a')
+        fetch.client.new_run()
+        metrics.collector.new_run()
+        try:
+            if pipeline is not None:
+                attempted, failed, skipped = pipeline.run(
+                    to_update, checkpoint, run_log,
+                    deadline=deadline, owns=owns
+                )
+            elif workers > 1:
+                # only the worker threads touch the per-item files; the
+                # catalog and checkpoint are written from this thread as each
+                # item completes. Items are handed out as workers free up, so
+                # that the budget is checked before each one starts
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    futures = {}
+                    for _, zared_row in to_update.iterrows():
+                        if deadline is not None and \
+                                time.monotonic() > deadline:
+                            break
+                        if len(futures) >= workers:
+                            done, _ = wait(
+                                futures, return_when=FIRST_COMPLETED
+                            )
+                            for future in done:
+                                self.record_result(
+                                    checkpoint,
+                                    futures.pop(future),
+                                    future.result(),
+                                    run_log
+                                )
+                                attempted += 1
+                                failed += future.result()[1] is not None
+                        if owns is not None and not owns(zared_row.name):
+                            skipped += 1
+                            continue
+                        futures[executor.submit(
+                            self.try_update_item, zared_row
+                        )] = zared_row.name
+                    for future in as_completed(futures):
+                        self.record_result(
+                            checkpoint, futures[future], future.result(),
+                            run_log
+                        )
+                        attempted += 1
+                        failed += future.result()[1] is not None
+            else:
+                for _, zared_row in to_update.iterrows():
+                    if deadline is not None and time.monotonic() > deadline:
+                        break
+                    if owns is not None and not owns(zared_row.name):
+                        skipped += 1
+                        continue
+                    result = self.try_update_item(zared_row)
+                    self.record_result(
+                        checkpoint, zared_row.name, result, run_log
+                    )
+                    attempted += 1
+                    failed += result[1] is not None
+        finally:
+            checkpoint.close()
+            fetch.client.new_run()
+            self.write_run_metrics(run_log, len(to_update))
+            run_log.close()
+        if attempted + skipped == len(to_update):
+            # finished, nothing to resume
+            os.remove(self.CHECKPOINT_FILENAME)
         if verbose is True:
             end_time = arrow.now()
             print('Update finished at {utc_epoch} ({local})'.format(
                 utc_epoch=end_time.timestamp,
                 local=end_time
             ))
-        self.to_disk()
+            print(
+                '{updated} of {selected} selected items updated, '
+                '{failed} failed'.format(
+                    updated=attempted - failed,
+                    selected=len(to_update),
+                    failed=failed
+                )
+            )
+            for line in metrics.collector.phase_table():
+                print(line)
+            print(
+                '{bytes:.1f} MB downloaded in {requests} requests, '
+                '{retries} retries'.format(
+                    bytes=metrics.collector.counter('bytes_downloaded') / 1e6,
+                    requests=metrics.collector.counter('http_responses'),
+                    retries=metrics.collector.counter('retries')
+                )
+            )
 
 if __name__ == '__main__':
-    z = Zared()
     parser = argparse.ArgumentParser()
     parser.add_argument('--update', action='store_true')
     parser.add_argument('--now', action='store_true')
+    parser.add_argument(
+        '--daemon',
+        help='Keep running, polling each item as often as it tends to change',
+        action='store_true'
+    )
+    parser.add_argument(
+        '--sharded',
+        help='Keep updating stale items (see --stale-minutes, default 60) '
+             'as one of several workers, here or on other hosts sharing '
+             'this directory, each taking its own share of the items',
+        action='store_true'
+    )
+    parser.add_argument(
+        '--worker-id',
+        help='Name of this --sharded worker (default the host name, '
+             'numbered from 2 for each more worker on the host)',
+        action='store',
+        type=str
+    )
+    parser.add_argument(
+        '--leases',
+        help='List the --sharded workers and how many shards each holds',
+        action='store_true'
+    )
+    parser.add_argument(
+        '--workers',
+        help='Number of items to update (default 1) or add (default {}) '
+             'concurrently'.format(Zared.ADD_WORKERS),
+        action='store',
+        type=int
+    )
+    parser.add_argument(
+        '--pipeline',
+        help='Update through a pipeline of --workers fetcher threads '
+             '(default {fetchers}), --parsers parser processes and one '
+             'writer'.format(fetchers=UpdatePipeline.FETCHERS),
+        action='store_true'
+    )
+    parser.add_argument(
+        '--parsers',
+        help='Number of processes parsing pages for --pipeline (default '
+             'one per CPU, 0 to parse in the fetcher threads)',
+        action='store',
+        type=int
+    )
+    parser.add_argument(
+        '--batch-size',
+        help='Snapshots --pipeline writes at a time (default {size})'.format(
+            size=UpdatePipeline.BATCH_SIZE
+        ),
+        action='store',
+        type=int
+    )
+    parser.add_argument(
+        '--segment',
+        help='Only update items in this audience segment, e.g. woman',
+        action='store',
+        type=str
+    )
+    parser.add_argument(
+        '--type',
+        help='Only update items of this type, e.g. dresses',
+        action='store',
+        type=str
+    )
+    parser.add_argument(
+        '--stale-minutes',
+        help='Only update items last updated at least this long ago',
+        action='store',
+        type=float
+    )
+    parser.add_argument(
+        '--max-items',
+        help='Update at most this many items (the most stale ones)',
+        action='store',
+        type=int
+    )
+    parser.add_argument(
+        '--time-budget',
+        help='Stop starting new updates after this many minutes',
+        action='store',
+        type=float
+    )
+    parser.add_argument(
+        '--rate-limit',
+        help='Requests per second allowed against a host, as HOST=RATE '
+             '(can be given more than once)',
+        action='append',
+        default=[]
+    )
+    parser.add_argument(
+        '--changes-only',
+        help='Only record prices / availabilities that changed since the '
+             'last update',
+        action='store_true'
+    )
+    parser.add_argument(
+        '--metrics-file',
+        help='Where to write the Prometheus metrics of --update runs, e.g. '
+             'in node_exporter\'s textfile collector directory',
+        action='store',
+        type=str
+    )
+    parser.add_argument(
+        '--migrate-history',
+        help='Move price / availability history from csv files to the '
+             'columnar store',
+        action='store_true'
+    )
+    parser.add_argument(
+        '--compact-history',
+        help='Fold recent updates into the columnar history files',
+        action='store_true'
+    )
+    parser.add_argument(
+        '--apply-retention',
+        help='Roll up history older than the raw tier into daily rows, and '
+             'archive or delete daily rows older than the daily tier (see '
+             '{filename})'.format(filename=retention.FILENAME),
+        action='store_true'
+    )
+    parser.add_argument(
+        '--raw-days',
+        help='Days of history --apply-retention keeps every snapshot of',
+        action='store',
+        type=int
+    )
+    parser.add_argument(
+        '--daily-days',
+        help='Days of history --apply-retention keeps daily rows of',
+        action='store',
+        type=int
+    )
+    parser.add_argument(
+        '--expired',
+        help='What --apply-retention does with daily rows older than that',
+        choices=['archive', 'delete']
+    )
+    parser.add_argument(
+        '--rebuild-summary',
+        help='Summarise every item from its whole history',
+        action='store_true'
+    )
+    parser.add_argument(
+        '--price-drops',
+        help='List items whose price dropped in the last this many hours',
+        action='store',
+        type=float
+    )
+    parser.add_argument(
+        '--restocks',
+        help='List items that came back in stock in the last this many hours',
+        action='store',
+        type=float
+    )
+    parser.add_argument(
+        '--list',
+        help='List the items being tracked',
+        action='store_true'
+    )
+    parser.add_argument(
+        '--status',
+        help='Show what is known about the item(s) at a url',
+        action='store',
+        type=str
+    )
     parser.add_argument(
         '--url',
         help='Add an item by providing its url',
@@ -161,17 +999,185 @@ if __name__ == '__main__':
     )
     parser.add_argument(
         '--color',
-        help='Specify a color for --url',
+        help='Specify a color for --url, or for every item of --listing',
+        action='store',
+        type=str
+    )
+    parser.add_argument(
+        '--locations',
+        help='Only track the stores nearest to these locations (from '
+             '{filename}, comma separated) for items being added'.format(
+                 filename=stores.LOCATIONS_FILENAME
+             ),
+        action='store',
+        type=str
+    )
+    parser.add_argument(
+        '--nearest-stores',
+        help='List the stores nearest to a point',
+        nargs=2,
+        metavar=('LATITUDE', 'LONGITUDE'),
+        type=float
+    )
+    parser.add_argument(
+        '--count',
+        help='How many stores --nearest-stores lists',
+        action='store',
+        type=int,
+        default=5
+    )
+    parser.add_argument(
+        '--urls',
+        help='Add every item in a file of urls, one per line, each '
+             'optionally followed by a color',
+        action='store',
+        type=str
+    )
+    parser.add_argument(
+        '--listing',
+        help='Add every item on a category listing page',
         action='store',
         type=str
     )
     args = parser.parse_args()
+    # sharded workers may be on other hosts, which WAL does not work across
+    z = Zared(journal_mode='DELETE' if args.sharded is True else None)
+
+    if args.changes_only is True:
+        Item.RECORDING = 'changes'
+
+    locations = args.locations.split(',') \
+        if args.locations is not None else None
+
+    if args.metrics_file is not None:
+        z.METRICS_FILENAME = args.metrics_file
 
-    if args.update is True:
+    for rate_limit in args.rate_limit:
+        host, rate = rate_limit.split('=')
+        fetch.rate_limiter.set_rate(host, float(rate))
+
+    pipeline = UpdatePipeline(
+        z,
+        fetchers=args.workers or UpdatePipeline.FETCHERS,
+        parsers=args.parsers,
+        batch_size=args.batch_size or UpdatePipeline.BATCH_SIZE
+    ) if args.pipeline is True else None
+
+    if args.daemon is True:
+        Scheduler(z, workers=args.workers or 1).run()
+    elif args.sharded is True:
+        z.run_sharded(
+            shards.ShardCoordinator(args.worker_id),
+            workers=args.workers or 1,
+            stale_for=(
+                args.stale_minutes * 60
+                if args.stale_minutes is not None else 60 * 60
+            ),
+            verbose=True,
+            pipeline=pipeline
+        )
+    elif args.leases is True:
+        for worker, count, expires in shards.ShardCoordinator().status():
+            print('{worker:<40} {count:>4} shards, lease until {expires}'
+                  .format(
+                      worker=worker,
+                      count=count,
+                      expires=time.strftime(
+                          '%Y-%m-%d %H:%M:%S', time.localtime(expires)
+                      )
+                  ))
+    elif args.update is True:
         if args.now is False:
             time.sleep(random() * 15 * 60)
-        z.update_all(verbose=True)
+        z.update_all(
+            verbose=True,
+            workers=args.workers or 1,
+            audience_segment=args.segment,
+            category_type=args.type,
+            stale_for=(
+                args.stale_minutes * 60
+                if args.stale_minutes is not None else None
+            ),
+            max_items=args.max_items,
+            time_budget=(
+                args.time_budget * 60
+                if args.time_budget is not None else None
+            ),
+            pipeline=pipeline
+        )
+    elif args.migrate_history is True:
+        z.migrate_history()
+    elif args.compact_history is True:
+        z.compact_history()
+    elif args.apply_retention is True:
+        policy = retention.RetentionPolicy.from_file()
+        policy = retention.RetentionPolicy(
+            raw_days=(
+                args.raw_days
+                if args.raw_days is not None else policy.raw_days
+            ),
+            daily_days=(
+                args.daily_days
+                if args.daily_days is not None else policy.daily_days
+            ),
+            expired=args.expired or policy.expired
+        )
+        z.apply_retention(policy, verbose=True)
+    elif args.rebuild_summary is True:
+        z.rebuild_summary()
+    elif args.price_drops is not None or args.restocks is not None:
+        summaries = z.summary(
+            dropped_since=(
+                arrow.now().timestamp - args.price_drops * 60 * 60
+                if args.price_drops is not None else None
+            ),
+            restocked_since=(
+                arrow.now().timestamp - args.restocks * 60 * 60
+                if args.restocks is not None else None
+            ),
+            audience_segment=args.segment,
+            category_type=args.type
+        )
+        print(summaries[[
+            'filename', 'previous_price', 'price', 'min_price',
+            'in_stock_count'
+        ]].to_string())
+    elif args.list is True:
+        for row in z.list_items():
+            print('{last_updated:<16}  {category:<24}  {name}{flags}'.format(
+                last_updated=time.strftime(
+                    '%Y-%m-%d %H:%M', time.localtime(row['last_updated'])
+                ) if row['last_updated'] is not None else '',
+                category='{audience_segment}/{type}'.format(**row),
+                name=row['filename'],
+                flags=(' (bought)' if row['bought'] else '') +
+                (' (ignored)' if row['ignore'] else '')
+            ))
+    elif args.status is not None:
+        for row in z.status(args.status):
+            print(json.dumps(row, indent=4, sort_keys=True))
+    elif args.nearest_stores is not None:
+        for distance, store in stores.get_registry().nearest(
+                args.nearest_stores[0], args.nearest_stores[1], args.count
+        ):
+            print('{id:>8} {distance:>8.1f} km  {region:<12} {address}'.format(
+                distance=distance, **store
+            ))
     elif args.url is not None:
-        z.add_item(args.url, args.color)
+        z.add_item(args.url, args.color, locations)
+    elif args.urls is not None or args.listing is not None:
+        urls = []
+        if args.urls is not None:
+            urls += z.read_url_list(args.urls)
+        if args.listing is not None:
+            urls += [
+                (url, args.color) for url in Item.listing_urls(args.listing)
+            ]
+        z.add_items(
+            urls,
+            workers=args.workers or Zared.ADD_WORKERS,
+            verbose=True,
+            locations=locations
+        )
 
     sys.exit(0)